@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+from time import time
+
+# Paths whose values identify the process behind a service. If any of them
+# changed, the cached items of the service are not used.
+FINGERPRINT = ('/Mgmt/ProcessName', '/Mgmt/ProcessVersion', '/ProductId')
+
+# Entries of services that were not seen for this long are dropped
+MAX_AGE = 30 * 24 * 3600
+
+
+class Catalogue(object):
+	""" The items of each service as found by a previous run, so that they
+	    can be published at startup before the services are scanned. It is
+	    a JSON file, keyed on service name. An entry holds the fingerprint
+	    of the service, its device instance, whether it had to be
+	    introspected, and the items with their last value. """
+	def __init__(self, path):
+		self.path = path
+		self.services = {}
+
+	def load(self):
+		try:
+			with open(self.path) as f:
+				self.services = json.load(f)
+		except (IOError, OSError, ValueError) as e:
+			logging.warning('[Catalogue] Not loaded: {}'.format(e))
+			self.services = {}
+		return self
+
+	def get(self, service):
+		return self.services.get(service)
+
+	def put(self, service, fingerprint, device_instance, items, introspected=False):
+		self.services[service] = dict(
+			fingerprint=list(fingerprint),
+			device_instance=device_instance,
+			introspected=introspected,
+			items=items,
+			seen=int(time()))
+
+	def matches(self, entry, fingerprint, device_instance):
+		return entry['device_instance'] == device_instance and entry['fingerprint'] == list(fingerprint)
+
+	def save(self):
+		""" Write the catalogue to a new file that replaces the old one,
+		    so that a crash never leaves half a catalogue. """
+		oldest = time() - MAX_AGE
+		self.services = {k: v for k, v in self.services.items() if v.get('seen', 0) >= oldest}
+		tmp = self.path + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(self.services, f, separators=(',', ':'))
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, self.path)
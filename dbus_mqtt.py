@@ -6,203 +6,189 @@ import json
 import logging
 import os
 import sys
-from time import time
+from time import time, monotonic
 import traceback
 import signal
 from dbus.mainloop.glib import DBusGMainLoop
 from lxml import etree
 from collections import OrderedDict
-from functools import partial, update_wrapper
+from functools import partial
 from gi.repository import GLib
 
-from itertools import zip_longest
+from itertools import count
 
 # Victron packages
 AppDir = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(1, os.path.join(AppDir, 'ext', 'velib_python'))
 from logger import setup_logging
 from ve_utils import get_vrm_portal_id, exit_on_error, wrap_dbus_value, unwrap_dbus_value, add_name_owner_changed_receiver
-from mqtt_gobject_bridge import MqttGObjectBridge
-from mosquitto_bridge_registrator import MosquittoBridgeRegistrator
+from publish_queue import SpillRing, LANE_CHANGE
+from rules import FilterRules, ItemRule, ItemRules, PathPatterns
+from payload import decode_write, decode_bulk_write
+from stats import Stats
+from signal_trace import TraceWriter, TraceReplayer, read_trace
+from catalogue import Catalogue, FINGERPRINT
+from shm_ring import Ring, RING_SIZE, MIN_RING_SIZE
+from outputs import MqttOutput, RingOutput, Egress, Subscriptions, Item, ServiceInfo, \
+	MAX_TOPIC_AGE, RATE_BOOST
 
 
 SoftwareVersion = '1.36'
 ServicePrefix = 'com.victronenergy.'
-VeDbusInvalid = dbus.Array([], signature=dbus.Signature('i'), variant_level=1)
-blocked_items = {('vebus', u'/Interfaces/Mk2/Tunnel'), ('paygo', '/LVD/Threshold')}
-
-MAX_TOPIC_AGE = 60
-
-class reify(object):
-	""" Decorator for class methods. Turns the method into a property that
-	    is evaluated once, and then replaces the property, effectively caching
-	    it and evaluating it only once. """
-	def __init__(self, wrapped):
-		self.wrapped = wrapped
-		update_wrapper(self, wrapped)
-	def __get__(self, inst, objtype=None):
-		if inst is None:
-			return self
-		val = self.wrapped(inst)
-		setattr(inst, self.wrapped.__name__, val)
-		return val
-
-class BaseTopic(object):
-	__slots__ = ('topic','timestamp', 'maxage')
-
-	def __init__(self, maxage):
-		self.timestamp = int(time())
-		self.maxage = maxage
-
-class WildcardTopic(BaseTopic):
-	def __init__(self, maxage):
-		super(WildcardTopic, self).__init__(maxage)
-		self.topic = None
-
-	def match(self, topic):
-		return True
-
-	def __eq__(self, other):
-		return isinstance(other, WildcardTopic)
-
-	def __hash__(self):
-		return hash(None)
-
-# payload example:
-# ["system/#","inverter/+/voltage"]
-# filter string can end in a # (test with "endswith"), or contain a `+`.
-class Topic(BaseTopic):
-	def __init__(self, t, maxage):
-		super(Topic, self).__init__(maxage)
-		self.topic = tuple(t)
-
-	def match(self, topic):
-		for x, y in zip_longest(self.topic, topic):
-			if None in (x, y):
-				return False
-			if '+' in (x, y):
-				continue
-			if '#' in (x, y):
-				return True
-			if x == y:
-				continue
-			return False
-		return True
+# Excluded ahead of the item rules
+blocked_items = [ItemRule(False, 'vebus', path=u'/Interfaces/Mk2/Tunnel'),
+	ItemRule(False, 'paygo', path='/LVD/Threshold')]
+# Items that can be read but do not send PropertiesChanged. A read of one
+# of these always goes to the D-Bus.
+unsignalled_items = PathPatterns([('vebus', '/Hub4/L*/AcPowerSetpoint')])
+
+SCAN_CONCURRENCY = 8
+REQUEST_WINDOW = 4
+# Seconds after the last change before the catalogue is saved
+CATALOGUE_DELAY = 10
+SPILL_SIZE = 1024 * 1024
+
+class ServiceScan(object):
+	""" An asynchronous scan of one service that is in progress. Cached
+	    holds the items from the catalogue that the scan must confirm,
+	    or None. A service without an item listing is introspected: then
+	    pending counts the calls that did not return yet, paths holds the
+	    items found, and error the first error. """
+	__slots__ = ('service', 'started', 'cached', 'pending', 'paths', 'error')
+
+	def __init__(self, service, cached=None):
+		self.service = service
+		self.started = time()
+		self.cached = cached
+		self.pending = 0
+		self.paths = []
+		self.error = None
+
+class Revalidation(object):
+	""" Checking whether the cached items of a service are still right.
+	    Values holds the replies for the device instance and the
+	    fingerprint. """
+	__slots__ = ('service', 'entry', 'values')
+
+	def __init__(self, service, entry):
+		self.service = service
+		self.entry = entry
+		self.values = {}
+
+class RequestQueue(object):
+	""" Asynchronous D-Bus requests to one service. Requests wait here until
+	    there is room in the window of calls in flight. Waiting requests
+	    with the same key coalesce, only the latest is sent. """
+	__slots__ = ('pending', 'inflight')
 
-	def __eq__(self, other):
-		return self.topic == other.topic
-
-	def __hash__(self):
-		return hash('/'.join(self.topic))
-
-class ExactTopic(Topic):
-	""" This is here because it is faster for matches without
-	    wildcards. """
-	def match(self, topic):
-		return self.topic == topic
-
-class Subscriptions(object):
 	def __init__(self):
-		self.topics = []
-
-	def subscribe_all(self, ttl=MAX_TOPIC_AGE):
-		# Put it first in the list for performance reasons
-		w = WildcardTopic(ttl)
-		try:
-			self.topics.remove(w)
-		except ValueError:
-			self.topics.insert(0, w)
-			return w
-
-		self.topics.insert(0, w)
-		return None
-
-	def subscribe(self, topic, ttl=MAX_TOPIC_AGE):
-		t = Topic(topic.split('/'), ttl) if '+' in topic or '#' in topic else ExactTopic(topic.split('/'), ttl)
-		# Removing and re-adding updates timestamp and potentially also ttl
-		try:
-			self.topics.remove(t)
-		except ValueError:
-			# topic wasn't in the list, add it
-			self.topics.append(t)
-			return t
-
-		# Topic was in the list, but removed. Re-add it.
-		self.topics.append(t)
-		return None
-
-	def match(self, t):
-		return any(topic.match(t) for topic in self.topics)
-
-	def cleanup(self, published, exceptions):
-		""" Remove expired topics from subscriptions. Return topics that
-		    should be unpublished. """
-		affected_topics = set()
-		now = int(time())
-		expired = [t for t in self.topics if max(0, now - t.timestamp) > t.maxage]
-		if expired:
-			for r in expired:
-				# Expire the topic
-				self.topics.remove(r)
-
-			if any(isinstance(t, WildcardTopic) for t in self.topics):
-				# No need to traverse everything, they will all match
-				return ()
-
-			# Find topics that should no longer be published
-			return list(filter(lambda t: not self.match(t.shorttopic), published - exceptions))
-
-		# Nothing was expired
-		return ()
-
-# Keep track of full and short topic
-class PublishedTopic(object):
-	def __init__(self, fulltopic):
-		self.fulltopic = fulltopic
-	@reify
-	def shorttopic(self):
-		return tuple(self.fulltopic.split('/')[2:])
-	def __eq__(self, other):
-		return isinstance(other, PublishedTopic) and self.fulltopic == other.fulltopic
-	def __hash__(self):
-		return hash(self.fulltopic)
-
-class DbusMqtt(MqttGObjectBridge):
+		# Key: (method, path) unless given otherwise, value: (method, path,
+		# signature, args, reply_handler, error_handler)
+		self.pending = OrderedDict()
+		self.inflight = 0
+
+class BulkWrite(object):
+	""" A bulk write waiting for the results of its paths. Key of results:
+	    topic as in the request, value: result object. """
+	__slots__ = ('output', 'topic', 'results', 'waiting')
+
+	def __init__(self, output, topic):
+		self.output = output
+		self.topic = topic
+		self.results = OrderedDict()
+		self.waiting = 0
+
+class DbusMqtt(object):
+	""" Keeps track of the items on the D-Bus and feeds them to one or more
+	    MqttOutput instances. The first output is configured by the
+	    arguments, outputs holds the keyword arguments of more. """
 	def __init__(self, mqtt_server=None, ca_cert=None, user=None, passwd=None, dbus_address=None,
-				keep_alive_interval=None, init_broker=False, debug=False):
+				keep_alive_interval=None, init_broker=False, debug=False, async_scan=False,
+				scan_concurrency=SCAN_CONCURRENCY, async_requests=False, request_window=REQUEST_WINDOW,
+				dbus_timeout=None, max_messages=0, max_bytes=0, rate_boost=RATE_BOOST,
+				filter_rules=None, persistent_session=False, stats_interval=0, trace=None,
+				catalogue=None, max_queue=0, spill=None, write_watch=False, outputs=(), item_rules=None,
+				lazy=False, read_max_age=0, egress=None):
 		self._dbus_address = dbus_address
 		self._dbus_conn = (dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()) \
 			if dbus_address is None \
 			else dbus.bus.BusConnection(dbus_address)
 		add_name_owner_changed_receiver(self._dbus_conn, self._dbus_name_owner_changed)
-		self._connected_to_cloud = False
+		# Counters and timings, published on N/<portal id>/$stats every
+		# stats_interval seconds
+		self._stats = Stats()
+		if stats_interval:
+			GLib.timeout_add(int(stats_interval * 1000), self._publish_stats)
+		# A TraceWriter that records incoming events, or None
+		self._trace = trace
+		if trace is not None:
+			GLib.timeout_add(60000, self._flush_trace)
 
 		# @todo EV Get portal ID from com.victronenergy.system?
 		self._system_id = get_vrm_portal_id()
-		self._system_id_topic = PublishedTopic('N/{}/system/0/Serial'.format(
-			self._system_id))
-		# Key: D-BUS Service + path, value: topic
-		self._topics = {}
-		# Key: topic, value: last value seen on D-Bus
-		self._values = {}
+		self._system_id_topic = 'N/{}/system/0/Serial'.format(self._system_id)
+		# Key: D-BUS Service + path, value: Item
+		self._items = {}
 		# Key: service_type/device_instance, value: D-Bus service name
 		self._services = {}
+		# Key: D-Bus service name, value: ServiceInfo
+		self._service_info = {}
 		# Key: short D-Bus service name (eg. 1:31), value: full D-Bus service name (eg. com.victronenergy.settings)
 		self._service_ids = {}
-		# Track subscriptions.
-		self._subscriptions = Subscriptions()
-		self._published = set()
-		# A queue of value changes, so that we may rate-limit this somewhat
-		self.queue = OrderedDict()
-		GLib.timeout_add(1000, self._timer_service_queue)
-		GLib.timeout_add(10000, self._expire_stale_topics)
-		self._last_queue_run = 0
-
-		if init_broker:
-			self._registrator = MosquittoBridgeRegistrator(self._system_id)
-			self._registrator.register()
-		else:
-			self._registrator = None
+		# Alias ids of new items
+		self._aliases = count(1)
+		# The brokers everything is published to, see MqttOutput
+		self._outputs = []
+		# Items and services left out by the item rules. Excluded holds the
+		# uids of excluded items that were seen, so that their signals are
+		# dropped after a single lookup. Signals of excluded services are
+		# dropped because they are not in _service_ids. Key: service name,
+		# value: (owner, device instance).
+		self._item_rules = None
+		self._set_item_rules(item_rules or ItemRules())
+		self._excluded = set()
+		self._excluded_services = {}
+		# Deadband and interval filtering. Held contains the items with a
+		# value that is held back by their filter.
+		self._filter_rules = filter_rules or FilterRules()
+		self._held = set()
+		if self._filter_rules:
+			GLib.timeout_add(1000, self._flush_held)
+		# Asynchronous scanning. Services waiting for a scan, and the scan
+		# currently in progress per service.
+		self._async_scan = async_scan
+		self._scan_concurrency = scan_concurrency
+		self._scan_queue = OrderedDict()
+		self._scans = {}
+		self._scans_running = 0
+		self._scan_batch_started = None
+		# Device instance lookups of dormant services in progress
+		self._lookups = 0
+		# Asynchronous W/ and R/ requests. Key: service name, value: RequestQueue
+		self._async_requests = async_requests
+		self._request_window = request_window
+		self._dbus_timeout = -1 if dbus_timeout is None else dbus_timeout
+		self._requests = {}
+		# Reads are answered with the cached value if it was confirmed no
+		# longer than read_max_age seconds ago. Unsignalled holds the uids
+		# of items that were seen to change without a signal. Key: service
+		# name, value: list of (output, Subscriptions) of wildcard reads
+		# waiting for GetItems.
+		self._read_max_age = read_max_age
+		self._unsignalled = set()
+		self._wildcard_reads = {}
+		# Items found by a previous run. Services that were introspected,
+		# and services whose cached items are being revalidated.
+		self._catalogue = catalogue
+		self._catalogue_timer = None
+		self._introspected = set()
+		self._revalidating = {}
+		# Lazy mode: only the device instance of a service is looked up,
+		# it is scanned once a subscription or read asks for it. Signals of
+		# dormant services are dropped because they are not in
+		# _service_ids. Key: service name, value: owner.
+		self._lazy = lazy
+		self._dormant = {}
 
 		self._dbus_conn.add_signal_receiver(self._on_dbus_value_changed,
 			dbus_interface='com.victronenergy.BusItem', signal_name='PropertiesChanged', path_keyword='path',
@@ -214,162 +200,336 @@ class DbusMqtt(MqttGObjectBridge):
 		for service in services:
 			if service.startswith('com.victronenergy.'):
 				self._service_ids[self._dbus_conn.get_name_owner(service)] = service
+				if lazy:
+					try:
+						self._add_dormant_service(service)
+					except:
+						logging.exception("_add_dormant_service")
+					continue
+				entry = None if catalogue is None else catalogue.get(service)
+				if entry is not None:
+					self._add_cached_service(service, entry)
+					continue
+				if async_scan:
+					self._scan_dbus_service_async(service)
+					continue
 				try:
 					self._scan_dbus_service(service)
 				except:
 					logging.exception("_scan_dbus_service")
 
-		self._keep_alive_interval = keep_alive_interval
-		MqttGObjectBridge.__init__(self, mqtt_server, "ve-dbus-mqtt-py", ca_cert, user, passwd, debug)
-
-	def publish(self, topic, value):
-		""" Publish to mqtt IF keepalive permits. Publish only topics that are currently alive. """
-		pt = PublishedTopic(topic)
-		if pt in self._published:
-			self._publish(topic, value)
-		elif self._subscriptions.match(pt.shorttopic):
-			self._published.add(pt)
-			self._publish(topic, value)
-
-	def _publish(self, topic, value):
-		# Put it into the queue
-		self.queue[topic] = value
-
-	def _unpublish(self, topic):
-		# Put it into the queue
-		self._published.discard(PublishedTopic(topic))
-		self.queue[topic] = None
+		if egress is not None:
+			# Two-process mode, egress is the (RingWriter, RingReader) of
+			# the rings to the Egress process, which has the outputs.
+			self._outputs.append(RingOutput(self, *egress))
+			return
+		self._outputs.append(MqttOutput(self, mqtt_server=mqtt_server, ca_cert=ca_cert, user=user,
+			passwd=passwd, keep_alive_interval=keep_alive_interval, init_broker=init_broker, debug=debug,
+			max_messages=max_messages, max_bytes=max_bytes, rate_boost=rate_boost,
+			persistent_session=persistent_session, max_queue=max_queue, spill=spill,
+			write_watch=write_watch))
+		for kwargs in outputs:
+			self._outputs.append(MqttOutput(self, debug=debug, **kwargs))
+
+	def publish(self, item, lane=LANE_CHANGE):
+		for output in self._outputs:
+			output.publish(item, lane)
+
+	def _unpublish(self, item):
+		for output in self._outputs:
+			output.unpublish(item)
 
 	def _publish_all(self):
-		for topic in sorted(self._values.keys()):
-			self.publish(topic, self._values[topic])
-
-	def __publish(self, *args, **kwargs):
-		# This method wraps the actual publishing to the broker and
-		# checks for a network error. If there is an error, it will
-		# reconnect the client, and try once more. The idea is
-		# to guard against the socketpair in paho getting into a bad
-		# state resulting in nothing working properly after that.
-		try:
-			return self._client.publish(*args, **kwargs)
-		except ConnectionError as e:
-			self._client.reconnect()
-			try:
-				return self._client.publish(*args, **kwargs)
-			except:
-				raise e
-
+		for output in self._outputs:
+			output.publish_all()
+
+	def _collect_stats(self, reset=False):
+		""" Counters and timings, and the current size of things. Those of
+		    the first output go without a prefix, those of the others are
+		    prefixed with output/<name>/. """
+		stats = self._stats.snapshot(reset)
+		stats['items'] = len(self._items)
+		stats['held'] = len(self._held)
+		stats['dormant'] = len(self._dormant)
+		for i, output in enumerate(self._outputs):
+			prefix = 'output/{}/'.format(output.name) if i else ''
+			for name, value in output.collect_stats(reset).items():
+				stats[prefix + name] = value
+		return stats
+
+	def _publish_stats(self):
+		""" Publish the stats on N/<portal id>/$stats/<name> of every output,
+		    not retained. Timings are summaries of the interval since the
+		    previous run. """
+		stats = self._collect_stats(reset=True)
+		for output in self._outputs:
+			output.publish_stats(stats)
+		return True
 
-	def _expire_stale_topics(self):
-		try:
-			for pt in self._subscriptions.cleanup(self._published, {self._system_id_topic}):
-				logging.debug("Expiring topic %s", pt.shorttopic)
-				self._unpublish(pt.fulltopic)
-		finally:
-			return True
+	def _flush_trace(self):
+		self._trace.flush()
+		return True
 
-	def _on_connect(self, client, userdata, dict, rc):
-		MqttGObjectBridge._on_connect(self, client, userdata, dict, rc)
-		logging.info('[Connected] Result code {}'.format(rc))
-		self._client.subscribe('R/{}/#'.format(self._system_id), 0)
-		self._client.subscribe('W/{}/#'.format(self._system_id), 0)
-		if self._registrator is not None and self._registrator.client_id is not None:
-			self._client.subscribe('$SYS/broker/connection/{}/state'.format(self._registrator.client_id), 0)
-
-		# Indicate that the new keepalive mechanism is supported
-		self._publish('N/{}/keepalive'.format(self._system_id), 1)
-
-		# Publish serial number once. It never changes, and it is retained in
-		# the broker. Lower down we take care not to unpublish it (should
-		# systemcalc be restarted).
-		self._publish(self._system_id_topic.fulltopic, self._system_id)
-
-		# Send all values at once, because values may have changed when we were disconnected.
-		self._publish_all()
-
-	def _on_message(self, client, userdata, msg):
-		MqttGObjectBridge._on_message(self, client, userdata, msg)
-		if msg.topic.startswith('$SYS/broker/connection/'):
-			if int(msg.payload) == 1:
-				logging.info('[Message] Connected to cloud broker')
-				self._connected_to_cloud = True
-			elif self._connected_to_cloud:
-				# As long as we have connection with the cloud server, we do not have to worry about
-				# authentication. After connection loss, we have to authenticate again, which is a nice
-				# moment to initialize the broker again in case our remote_password has been reset on the
-				# server, or if someone has unlinks VRM page.
-				logging.error('[Message] Lost connection with cloud broker')
-				self._connected_to_cloud = False
-				self._registrator.register()
-			return
-		try:
-			logging.debug('[Request] {}: {}'.format(msg.topic, str(msg.payload)))
-			action, system_id, path = msg.topic.split('/', 2)
-			if system_id != self._system_id:
-				raise Exception('Unknown system id')
-			topic = 'N/{}/{}'.format(system_id, path)
-			if action == 'W':
-				self._handle_write(topic, msg.payload)
-			elif action == 'R':
-				if path == 'system/0/Serial':
-					self._handle_serial_read(topic, msg.payload)
-				elif path == 'keepalive':
-					self._handle_keepalive(msg.payload)
-				else:
-					self._handle_read(topic)
-		except:
-			logging.error('[Request] Error in request: {} {}'.format(msg.topic, msg.payload))
-			traceback.print_exc()
-
-	def _handle_serial_read(self, topic, payload):
-		""" Currently a request for /Serial is considered a subscription for
-		    backwards compatibility. """
-		self._publish(topic, self._system_id)
-		if self._subscriptions.subscribe_all(self._keep_alive_interval) is not None:
-			self._publish_all()
-
-	def _handle_keepalive(self, payload):
-		if payload:
-			topics = json.loads(payload)
-			for topic in topics:
-				ob = self._subscriptions.subscribe(topic, self._keep_alive_interval)
-				# Publish only those that are directly matched by the newly
-				# added match. If we end up with overlap, it is no biggie. It
-				# is queued and rate-limited anyway.
-				if ob is not None:
-					for k, v in self._values.items():
-						pt = PublishedTopic(k)
-						if pt not in self._published and ob.match(pt.shorttopic):
-							self._published.add(pt)
-							self._publish(k, v)
-		else:
-			if self._subscriptions.subscribe_all(self._keep_alive_interval) is not None:
-				self._publish_all()
+	def dump_stats(self):
+		for name, value in sorted(self._collect_stats().items()):
+			logging.info('[Stats] {}: {}'.format(name, json.dumps(value)))
+
+	def _handle_request(self, output, action, topic, payload):
+		""" A W/ or R/ request, other than a keepalive, that came in on
+		    output. Topic is the N/ topic that goes with it. """
+		path = topic.split('/', 2)[2]
+		if action == 'W':
+			if path == '$bulk' or path.startswith('$bulk/'):
+				self._handle_bulk_write(output, topic, payload)
+			else:
+				self._handle_write(topic, payload)
+		elif action == 'R':
+			if '+' in path or '#' in path:
+				self._handle_wildcard_read(output, topic)
+			else:
+				self._handle_read(output, topic)
 
 	def _handle_write(self, topic, payload):
 		logging.debug('[Write] Writing {} to {}'.format(payload, topic))
-		value = json.loads(payload)['value']
+		value = decode_write(payload)
 		service, device_instance, path = self._get_uid_by_topic(topic)
 		if service is None:
 			raise Exception('Unknown service')
 
-		self._set_dbus_value(service, '/' + path, value)
-
-		# Run the queue as soon as possible
-		GLib.idle_add(self._service_queue)
+		if self._async_requests:
+			self._request(service, '/' + path, 'SetValue', 'v', [wrap_dbus_value(value)],
+				partial(self._on_write_reply, service + '/' + path), partial(self._on_request_error, topic))
+			return
 
-	def _handle_read(self, topic):
+		self._on_write_reply(service + '/' + path, self._set_dbus_value(service, '/' + path, value))
+
+	def _handle_bulk_write(self, output, topic, payload):
+		""" A write of several paths at once on W/<portal id>/$bulk[/<tag>].
+		    The payload maps topics such as vebus/276/Mode to values. The
+		    writes to one service are pipelined, services are written to in
+		    parallel. When all are done, the requesting output gets a
+		    message on N/<portal id>/$bulk[/<tag>] that maps each topic to
+		    {"result": <SetValue result>} or {"error": <D-Bus error>}. """
+		logging.debug('[Write] Bulk write {}'.format(topic))
+		bulk = BulkWrite(output, topic)
+		# Held until all writes are queued, some fail right away
+		bulk.waiting = 1
+		for t, value in decode_bulk_write(payload).items():
+			try:
+				service, device_instance, path = self._get_uid_by_topic('N/{}/{}'.format(self._system_id, t))
+			except ValueError:
+				bulk.results[t] = {'error': 'Invalid topic'}
+				continue
+			if service is None:
+				bulk.results[t] = {'error': 'Unknown service'}
+				continue
+			try:
+				value = wrap_dbus_value(value)
+			except (OverflowError, TypeError, ValueError):
+				# Eg. an integer beyond 64 bits
+				bulk.results[t] = {'error': 'Invalid value'}
+				continue
+			bulk.results[t] = None
+			bulk.waiting += 1
+			self._request(service, '/' + path, 'SetValue', 'v', [value],
+				partial(self._on_bulk_write_reply, bulk, t, service + '/' + path),
+				partial(self._on_bulk_write_error, bulk, t),
+				key=('SetValue', '/' + path, bulk))
+		self._stats.incr('write/bulk')
+		bulk.waiting -= 1
+		self._bulk_write_done(bulk)
+
+	def _on_bulk_write_reply(self, bulk, topic, uid, result):
+		bulk.results[topic] = {'result': int(result)}
+		bulk.waiting -= 1
+		self._on_write_reply(uid, result)
+		self._bulk_write_done(bulk)
+
+	def _on_bulk_write_error(self, bulk, topic, e):
+		bulk.results[topic] = {'error': e.get_dbus_name()}
+		bulk.waiting -= 1
+		self._bulk_write_done(bulk)
+
+	def _bulk_write_done(self, bulk):
+		if bulk.waiting == 0:
+			bulk.output.reply(bulk.topic, json.dumps(bulk.results))
+
+	def _on_write_reply(self, uid, result):
+		item = self._items.get(uid)
+		for output in self._outputs:
+			output.publish_write(item)
+
+	def _handle_read(self, output, topic):
 		logging.debug('[Read] Topic {}'.format(topic))
 		service, device_instance, path = self._get_uid_by_topic(topic)
 		if service is None:
 			raise Exception('Unknown service')
+		if self._lazy:
+			info = self._service_info[service]
+			info.lease = time() + MAX_TOPIC_AGE
+			if not info.active:
+				self._activate_service(info)
+		if self._read_max_age:
+			item = self._items.get(service + '/' + path)
+			if item is not None and self._fresh(item, monotonic()):
+				self._stats.incr('read/cached')
+				output.reply(topic, item.encode())
+				return
 
 		# Read a fresh value and make sure item is added. This is because a path
 		# may not always send PropertiesChanged (eg vebus/Hub4/L1/AcPowerSetpoint)
 		# but can nevertheless be read.
-		value = self._get_dbus_value(service, '/' + path)
-		if self._add_item(service, device_instance, path, value=value) == topic:
-			self.__publish(topic, json.dumps(dict(value=value)), retain=False)
+		if self._async_requests:
+			# Coalesce waiting reads per output, each must get its reply
+			self._request(service, '/' + path, 'GetValue', '', [],
+				partial(self._on_read_reply, output, topic, service, device_instance, path),
+				partial(self._on_request_error, topic), key=('GetValue', '/' + path, output))
+			return
+
+		self._on_read_reply(output, topic, service, device_instance, path,
+			self._get_dbus_value(service, '/' + path))
+
+	def _on_read_reply(self, output, topic, service, device_instance, path, value):
+		if self._read_max_age:
+			uid = service + '/' + path
+			item = self._items.get(uid)
+			if item is not None and item.updated is not None and item.value is not None and \
+					not (type(value) is type(item.value) and value == item.value):
+				# Changed without a signal, do not trust the cache for it
+				self._unsignalled.add(uid)
+		item = self._add_item(service, device_instance, path, value=value)
+		if item is not None and item.fulltopic == topic:
+			output.reply(topic, item.encode())
+
+	def _fresh(self, item, now):
+		""" Returns True if a read can be answered with the value of the
+		    item. """
+		updated = item.updated
+		if updated is None or now - updated > self._read_max_age or item.uid in self._unsignalled:
+			return False
+		t = item.shorttopic
+		return not unsignalled_items.matches(t[0], '/' + '/'.join(t[2:]))
+
+	def _handle_wildcard_read(self, output, topic):
+		""" A read of a topic with + or # wildcards, eg.
+		    R/<portal id>/battery/+/Dc/#. Every service that could match is
+		    read with a single GetItems, unless all matching items are
+		    cached and fresh. The reply is one N/ message per matching
+		    item, as for a read of each. """
+		logging.debug('[Read] Topic {}'.format(topic))
+		subscriptions = Subscriptions()
+		subscriptions.subscribe(topic.split('/', 2)[2], None)
+		now = monotonic()
+		for info in list(self._service_info.values()):
+			if not subscriptions.match_prefix(tuple(info.short_name.split('/'))):
+				continue
+			if self._lazy:
+				info.lease = time() + MAX_TOPIC_AGE
+				if not info.active:
+					# GetItems below does the scan
+					self._activate_service(info, scan=False)
+			if self._read_max_age:
+				items = [item for item in info.items if subscriptions.match(item.shorttopic)]
+				if items and all(self._fresh(item, now) for item in items):
+					self._stats.incr('read/cached', len(items))
+					for item in items:
+						output.reply(item.fulltopic, item.encode())
+					continue
+
+			# A GetItems that is on its way answers this read as well
+			reads = self._wildcard_reads.setdefault(info.name, [])
+			reads.append((output, subscriptions))
+			if len(reads) > 1:
+				continue
+			if self._async_requests:
+				self._request(info.name, '/', 'GetItems', '', [],
+					partial(self._on_wildcard_read_reply, info.name, True),
+					partial(self._on_wildcard_read_error, info.name, True))
+				continue
+			try:
+				items = self._get_dbus_items(info.name)
+			except dbus.exceptions.DBusException as e:
+				self._on_wildcard_read_error(info.name, True, e)
+			else:
+				self._on_wildcard_read_reply(info.name, True, items)
+
+	def _on_wildcard_read_reply(self, service, props, items):
+		""" Items is the result of GetItems if props is True, or else of
+		    GetValue on the root. """
+		reads = self._wildcard_reads.pop(service, ())
+		info = self._service_info.get(service)
+		if info is None or not isinstance(items, dict):
+			return
+		found = []
+		for path, value in items.items():
+			if props:
+				value = value.get('Value')
+			item = self._add_item(service, info.device_instance, path, value=value)
+			if item is not None and item.value is not None:
+				found.append(item)
+		for output, subscriptions in reads:
+			for item in found:
+				if subscriptions.match(item.shorttopic):
+					output.reply(item.fulltopic, item.encode())
+
+	def _on_wildcard_read_error(self, service, props, e):
+		if props and (e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject' or \
+				e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod'):
+			# No GetItems, fall back to GetValue on the root
+			if self._async_requests:
+				self._request(service, '/', 'GetValue', '', [],
+					partial(self._on_wildcard_read_reply, service, False),
+					partial(self._on_wildcard_read_error, service, False))
+				return
+			try:
+				values = self._get_dbus_value(service, '/')
+			except dbus.exceptions.DBusException as e:
+				self._on_wildcard_read_error(service, False, e)
+			else:
+				self._on_wildcard_read_reply(service, False, values)
+			return
+		self._wildcard_reads.pop(service, None)
+		logging.error('[Read] Could not read the items of {}: {}'.format(service, e))
+
+	def _on_request_error(self, topic, e):
+		logging.error('[Request] Error in request: {} {}'.format(topic, e))
+
+	def _request(self, service, path, method, signature, args, reply_handler, error_handler, key=None):
+		""" Queue an asynchronous call to a service. A waiting call with the
+		    same key, (method, path) by default, is replaced. """
+		q = self._requests.get(service)
+		if q is None:
+			q = self._requests[service] = RequestQueue()
+		q.pending[key or (method, path)] = (method, path, signature, args, reply_handler, error_handler)
+		self._dispatch_requests(service, q)
+
+	def _dispatch_requests(self, service, q):
+		while q.pending and q.inflight < self._request_window:
+			_, (method, path, signature, args, reply_handler, error_handler) = q.pending.popitem(last=False)
+			q.inflight += 1
+			started = monotonic()
+			try:
+				self._dbus_conn.call_async(service, path, None, method, signature, args,
+					partial(self._on_request_done, service, q, reply_handler, started),
+					partial(self._on_request_done, service, q, error_handler, started),
+					timeout=self._dbus_timeout)
+			except Exception as e:
+				# Eg. an invalid object path from a topic, there will be no
+				# reply to release the slot
+				q.inflight -= 1
+				if not isinstance(e, dbus.exceptions.DBusException):
+					e = dbus.exceptions.DBusException(str(e), name='org.freedesktop.DBus.Error.InvalidArgs')
+				error_handler(e)
+		if q.inflight == 0 and self._requests.get(service) is q:
+			del self._requests[service]
+
+	def _on_request_done(self, service, q, handler, started, *args):
+		q.inflight -= 1
+		self._stats.observe('dbus/request', monotonic() - started)
+		try:
+			handler(*args)
+		finally:
+			self._dispatch_requests(service, q)
 
 	def _get_uid_by_topic(self, topic):
 		action, system_id, service_type, device_instance, path = topic.split('/', 4)
@@ -380,38 +540,353 @@ class DbusMqtt(MqttGObjectBridge):
 	def _dbus_name_owner_changed(self, name, oldowner, newowner):
 		if not name.startswith('com.victronenergy.'):
 			return
+		if self._trace is not None:
+			self._trace.owner(name, oldowner, newowner)
 		if newowner != '':
-			self._scan_dbus_service(name, publish=True)
 			self._service_ids[newowner] = name
+			self._discover_service(name)
 		elif oldowner != '':
 			logging.info('[OwnerChange] Service disappeared: {}'.format(name))
-			for path, topic in list(self._topics.items()):
-				if path.startswith(name + '/'):
-					# Leave the serial number alone
-					if not topic.endswith('/system/0/Serial'):
-						self._unpublish(topic)
-					del self._topics[path]
-					del self._values[topic]
-			if name in self._services:
-				del self._services[name]
+			# Drop a pending scan, replies to one in progress will be ignored
+			self._scan_queue.pop(name, None)
+			self._scans.pop(name, None)
+			self._wildcard_reads.pop(name, None)
+			self._revalidating.pop(name, None)
+			self._excluded_services.pop(name, None)
+			self._dormant.pop(name, None)
+			self._remove_service(name)
 			if oldowner in self._service_ids:
 				del self._service_ids[oldowner]
 
+	def _register_service(self, service, device_instance):
+		""" Record the device instance of a service, returns its
+		    ServiceInfo. """
+		short_name = get_short_service_name(service, device_instance)
+		info = self._service_info.get(service)
+		if info is None:
+			info = self._service_info[service] = ServiceInfo(service, device_instance, short_name)
+		elif info.short_name != short_name:
+			# The items are published under the old device instance
+			logging.info('[Scanning] {} moved from {} to {}'.format(service, info.short_name, short_name))
+			active, lease = info.active, info.lease
+			self._remove_service(service)
+			info = self._service_info[service] = ServiceInfo(service, device_instance, short_name)
+			info.active, info.lease = active, lease
+		self._services[short_name] = service
+		return info
+
+	def _remove_service(self, name):
+		""" Unpublish and forget the items of a service. """
+		info = self._service_info.pop(name, None)
+		if info is None:
+			return
+		self._excluded.difference_update(info.excluded)
+		for item in info.items:
+			# Leave the serial number alone
+			if item.fulltopic != self._system_id_topic:
+				self._unpublish(item)
+			self._held.discard(item)
+			del self._items[item.uid]
+		if self._services.get(info.short_name) == name:
+			del self._services[info.short_name]
+		for output in self._outputs:
+			output.items_changed(info.short_name)
+
+	def _drop_item(self, info, item):
+		""" Unpublish and forget one item of a service. """
+		if item.fulltopic != self._system_id_topic:
+			self._unpublish(item)
+		self._held.discard(item)
+		del self._items[item.uid]
+		info.items.discard(item)
+		for output in self._outputs:
+			output.items_changed(info.short_name)
+
+	def _set_item_rules(self, rules):
+		self._item_rules = ItemRules(blocked_items + rules.rules)
+
+	def _excluded_service(self, service, device_instance):
+		""" Returns True if the item rules exclude the whole service. Its
+		    signals are ignored from then on. """
+		if not self._item_rules.excludes_service(get_service_type(service), device_instance):
+			return False
+		logging.info('[Rules] Excluding service {}'.format(service))
+		for owner, name in list(self._service_ids.items()):
+			if name == service:
+				del self._service_ids[owner]
+				self._excluded_services[service] = (owner, device_instance)
+		owner = self._dormant.pop(service, None)
+		if owner is not None:
+			self._excluded_services[service] = (owner, device_instance)
+		return True
+
+	def reload_item_rules(self, rules):
+		""" Apply new item rules. Items that are excluded now are
+		    unpublished and forgotten, services with items or as a whole no
+		    longer excluded are scanned again. """
+		logging.info('[Rules] Reloading item rules')
+		self._set_item_rules(rules)
+		rescan = set()
+		for service, (owner, device_instance) in list(self._excluded_services.items()):
+			if not self._item_rules.excludes_service(get_service_type(service), device_instance):
+				del self._excluded_services[service]
+				self._service_ids[owner] = service
+				rescan.add(service)
+		for info in self._service_info.values():
+			service_type = get_service_type(info.name)
+			for uid in list(info.excluded):
+				if self._item_rules.included(service_type, info.device_instance, uid[len(info.name):]):
+					info.excluded.discard(uid)
+					self._excluded.discard(uid)
+					rescan.add(info.name)
+
+		for info in list(self._service_info.values()):
+			if self._excluded_service(info.name, info.device_instance):
+				self._remove_service(info.name)
+				rescan.discard(info.name)
+				continue
+			service_type = get_service_type(info.name)
+			for item in list(info.items):
+				path = item.uid[len(info.name):]
+				if not self._item_rules.included(service_type, info.device_instance, path):
+					self._drop_item(info, item)
+					info.excluded.add(item.uid)
+					self._excluded.add(item.uid)
+
+		for service in rescan:
+			if service in self._service_ids.values():
+				self._discover_service(service)
+		self._schedule_catalogue_save()
+		return False
+
+	def _discover_service(self, service):
+		""" Scan a service that showed up, or in lazy mode look up only its
+		    device instance. """
+		info = self._service_info.get(service)
+		if self._lazy and (info is None or not info.active):
+			self._add_dormant_service(service)
+		elif self._async_scan:
+			self._scan_dbus_service_async(service)
+		else:
+			self._scan_dbus_service(service, publish=True)
+
+	def _add_dormant_service(self, service):
+		if self._async_scan:
+			self._lookups += 1
+			self._dbus_conn.call_async(service, '/DeviceInstance', None, 'GetValue', '', [],
+				partial(self._on_dormant_lookup, self._on_dormant_device_instance, service),
+				partial(self._on_dormant_lookup, self._on_dormant_device_instance_error, service))
+			return
+		try:
+			device_instance = self._get_device_instance(service)
+		except dbus.exceptions.DBusException as e:
+			self._scan_failed(service, e)
+		else:
+			self._on_dormant_device_instance(service, device_instance)
+
+	def _on_dormant_lookup(self, handler, service, result):
+		self._lookups -= 1
+		try:
+			handler(service, result)
+		finally:
+			self._check_scanning()
+
+	def _on_dormant_device_instance(self, service, value):
+		owners = [owner for owner, name in self._service_ids.items() if name == service]
+		if not owners:
+			# Gone in the meantime
+			return
+		try:
+			device_instance = int(value)
+		except TypeError:
+			device_instance = 0
+		if self._excluded_service(service, device_instance):
+			return
+		info = self._register_service(service, device_instance)
+		if info.active and info.items:
+			return
+		logging.info('[Lazy] {} is dormant'.format(service))
+		info.active = False
+		for owner in owners:
+			del self._service_ids[owner]
+			self._dormant[service] = owner
+		if self._subscribed(info):
+			self._activate_service(info)
+
+	def _on_dormant_device_instance_error(self, service, e):
+		if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject' or \
+			e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
+			self._on_dormant_device_instance(service, 0)
+			return
+		try:
+			self._scan_failed(service, e)
+		except dbus.exceptions.DBusException:
+			logging.exception("_add_dormant_service")
+
+	def _subscribed(self, info):
+		""" Returns True if a subscription could match items of the
+		    service. """
+		prefix = tuple(info.short_name.split('/'))
+		return any(output._subscriptions.match_prefix(prefix) for output in self._outputs)
+
+	def _activate_service(self, info, scan=True):
+		""" Lazy mode: scan a dormant service and follow its signals. """
+		logging.info('[Lazy] Activating {}'.format(info.name))
+		info.active = True
+		owner = self._dormant.pop(info.name, None)
+		if owner is not None:
+			self._service_ids[owner] = info.name
+		if not scan:
+			return
+		if self._async_scan:
+			self._scan_dbus_service_async(info.name)
+		else:
+			self._scan_dbus_service(info.name, publish=True)
+
+	def _deactivate_service(self, info):
+		""" Lazy mode: forget the items of a service and ignore its signals
+		    until it is asked for again. Nothing matches its items any more,
+		    so they have been unpublished already. """
+		logging.info('[Lazy] {} is dormant again'.format(info.name))
+		service = info.name
+		self._scan_queue.pop(service, None)
+		self._scans.pop(service, None)
+		for owner, name in list(self._service_ids.items()):
+			if name == service:
+				del self._service_ids[owner]
+				self._dormant[service] = owner
+		for item in info.items:
+			for output in self._outputs:
+				output.forget(item)
+			self._held.discard(item)
+			del self._items[item.uid]
+		self._excluded.difference_update(info.excluded)
+		info.items.clear()
+		info.excluded.clear()
+		info.active = False
+		for output in self._outputs:
+			output.items_changed(info.short_name)
+
+	def _scan_subscribed_services(self):
+		""" Lazy mode: called after subscriptions were added. """
+		if not self._lazy:
+			return
+		for info in list(self._service_info.values()):
+			if not info.active and self._subscribed(info):
+				self._activate_service(info)
+
+	def _drop_unsubscribed_services(self):
+		""" Lazy mode: called after subscriptions expired. """
+		if not self._lazy:
+			return
+		now = time()
+		for info in list(self._service_info.values()):
+			if info.active and now > info.lease and not self._subscribed(info):
+				self._deactivate_service(info)
+
+	def _add_cached_service(self, service, entry):
+		""" Add the items a service had at a previous run, and check in the
+		    background whether the service is still the same. """
+		device_instance = entry['device_instance']
+		if self._excluded_service(service, device_instance):
+			return
+		logging.info('[Catalogue] Using cached items of {}'.format(service))
+		self._register_service(service, device_instance)
+		if entry.get('introspected'):
+			self._introspected.add(service)
+		for path, value in entry['items'].items():
+			item = self._add_item(service, device_instance, path, wrap_dbus_value(value))
+			if item is not None:
+				# Not confirmed by the service yet
+				item.updated = None
+		rv = self._revalidating[service] = Revalidation(service, entry)
+		for path in ('/DeviceInstance',) + FINGERPRINT:
+			self._dbus_conn.call_async(service, path, None, 'GetValue', '', [],
+				partial(self._on_revalidate_value, rv, path),
+				partial(self._on_revalidate_value, rv, path, None))
+
+	def _on_revalidate_value(self, rv, path, value, e=None):
+		# A path that cannot be read counts as None
+		service = rv.service
+		if self._revalidating.get(service) is not rv:
+			return
+		rv.values[path] = None if value is None else unwrap_dbus_value(value)
+		if len(rv.values) <= len(FINGERPRINT):
+			return
+		del self._revalidating[service]
+		try:
+			device_instance = int(rv.values['/DeviceInstance'])
+		except TypeError:
+			device_instance = 0
+		if self._catalogue.matches(rv.entry, [rv.values[p] for p in FINGERPRINT], device_instance):
+			logging.info('[Catalogue] Cached items of {} are valid'.format(service))
+			if service in self._introspected:
+				# Refresh the values without walking the tree again
+				for item in list(self._service_info[service].items):
+					path = item.uid[len(service):]
+					self._request(service, path, 'GetValue', '', [],
+						partial(self._value_changed_inner, service, path),
+						partial(self._on_revalidate_error, service, item))
+			else:
+				self._scan_dbus_service_async(service, set(self._service_info[service].items))
+		else:
+			logging.info('[Catalogue] {} has changed, scanning again'.format(service))
+			self._remove_service(service)
+			self._introspected.discard(service)
+			self._scan_dbus_service_async(service)
+		self._schedule_catalogue_save()
+
+	def _on_revalidate_error(self, service, item, e):
+		if e.get_dbus_name() != 'org.freedesktop.DBus.Error.UnknownObject':
+			self._on_request_error(item.fulltopic, e)
+			return
+		info = self._service_info.get(service)
+		if info is not None and item in info.items:
+			logging.info('[Catalogue] Cached item {} is gone'.format(item.fulltopic))
+			self._drop_item(info, item)
+			self._schedule_catalogue_save()
+
+	def _prune_cached_items(self, scan, paths):
+		""" Drop the items from the catalogue that the scan did not find. """
+		info = self._service_info.get(scan.service)
+		if scan.cached is None or info is None:
+			return
+		found = set(scan.service + (p if p.startswith('/') else '/' + p) for p in paths)
+		for item in scan.cached:
+			if item.uid not in found and item in info.items:
+				logging.info('[Catalogue] Cached item {} is gone'.format(item.fulltopic))
+				self._drop_item(info, item)
+
+	def _schedule_catalogue_save(self):
+		if self._catalogue is not None and self._catalogue_timer is None:
+			self._catalogue_timer = GLib.timeout_add(CATALOGUE_DELAY * 1000, self._save_catalogue)
+
+	def _save_catalogue(self):
+		self._catalogue_timer = None
+		for service, info in self._service_info.items():
+			if service in self._revalidating or not info.items:
+				# Keep the entry as it is
+				continue
+			items = {item.uid[len(service):]: unwrap_dbus_value(item.value) for item in info.items}
+			fingerprint = [items.get(p) for p in FINGERPRINT]
+			if all(v is None for v in fingerprint):
+				# No way to tell whether the service changed
+				continue
+			self._catalogue.put(service, fingerprint, int(info.device_instance), items,
+				service in self._introspected)
+		try:
+			self._catalogue.save()
+		except (IOError, OSError) as e:
+			logging.error('[Catalogue] Could not save: {}'.format(e))
+		return False
+
 	def _scan_dbus_service(self, service, publish=False):
 		try:
 			logging.info('[Scanning] service: {}'.format(service))
-			try:
-				device_instance = int(self._get_dbus_value(service, '/DeviceInstance'))
-			except dbus.exceptions.DBusException as e:
-				if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject' or \
-					e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
-					device_instance = 0
-				else:
-					raise
-			except TypeError:
-				device_instance = 0
-			short_service_name = get_short_service_name(service, device_instance)
-			self._services[short_service_name] = service
+			device_instance = self._get_device_instance(service)
+			if self._excluded_service(service, device_instance):
+				return
+			self._register_service(service, device_instance)
 
 			# Scan using GetItems
 			try:
@@ -419,12 +894,8 @@ class DbusMqtt(MqttGObjectBridge):
 			except dbus.exceptions.DBusException:
 				pass
 			else:
-				if isinstance(items, dict):
-					for path, props in items.items():
-						value = props.get('Value')
-						topic = self._add_item(service, device_instance, path[1:], value)
-						if publish and topic is not None:
-							self.publish(topic, value)
+				self._add_scanned_items(service, device_instance, items, publish)
+				self._schedule_catalogue_save()
 				return
 
 			try:
@@ -433,37 +904,250 @@ class DbusMqtt(MqttGObjectBridge):
 				if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject' or \
 					e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
 					self._introspect(service, device_instance, '/', publish)
+					self._introspected.add(service)
+					self._schedule_catalogue_save()
 					logging.warning('[Scanning] {} does not provide an item listing'.format(service))
 					return
 				else:
 					raise
 
-			if isinstance(items, dict):
-				for path, value in items.items():
-					topic = self._add_item(service, device_instance, path, value=value)
-					if publish and topic is not None:
-						self.publish(topic, value)
+			self._add_scanned_values(service, device_instance, items, publish)
+			self._schedule_catalogue_save()
 
 		except dbus.exceptions.DBusException as e:
-			if e.get_dbus_name() == 'org.freedesktop.DBus.Error.ServiceUnknown' or \
-				e.get_dbus_name() == 'org.freedesktop.DBus.Error.Disconnected':
-				logging.info("[Scanning] Service disappeared while being scanned: %s", service)
-			elif e.get_dbus_name() == 'org.freedesktop.DBus.Error.NoReply':
-				logging.info("[Scanning] No response from service during scan: %s", service)
+			self._scan_failed(service, e)
+
+	def _get_device_instance(self, service):
+		try:
+			return int(self._get_dbus_value(service, '/DeviceInstance'))
+		except dbus.exceptions.DBusException as e:
+			if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject' or \
+				e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
+				return 0
+			raise
+		except TypeError:
+			return 0
+
+	def _scan_failed(self, service, e):
+		if e.get_dbus_name() == 'org.freedesktop.DBus.Error.ServiceUnknown' or \
+			e.get_dbus_name() == 'org.freedesktop.DBus.Error.Disconnected':
+			logging.info("[Scanning] Service disappeared while being scanned: %s", service)
+		elif e.get_dbus_name() == 'org.freedesktop.DBus.Error.NoReply':
+			logging.info("[Scanning] No response from service during scan: %s", service)
+		else:
+			raise e
+
+	def _add_scanned_items(self, service, device_instance, items, publish):
+		""" Add the result of GetItems. """
+		if isinstance(items, dict):
+			for path, props in items.items():
+				item = self._add_item(service, device_instance, path[1:], props.get('Value'))
+				if publish and item is not None:
+					self.publish(item)
+
+	def _add_scanned_values(self, service, device_instance, values, publish):
+		""" Add the result of GetValue on the root. """
+		if isinstance(values, dict):
+			for path, value in values.items():
+				item = self._add_item(service, device_instance, path, value=value)
+				if publish and item is not None:
+					self.publish(item)
+
+	def _scan_dbus_service_async(self, service, cached=None):
+		""" Queue a service for scanning. At most scan_concurrency services
+		    are scanned at the same time, using non-blocking calls, and
+		    each service is published as soon as its items come in. Cached
+		    items that the scan does not find are dropped. """
+		if self._scan_batch_started is None:
+			self._scan_batch_started = time()
+		# Supersede a scan that is in progress
+		scan = self._scans.pop(service, None)
+		if cached is None:
+			cached = self._scan_queue.get(service, None if scan is None else scan.cached)
+		self._scan_queue[service] = cached
+		self._start_scans()
+
+	def _start_scans(self):
+		while self._scan_queue and self._scans_running < self._scan_concurrency:
+			service, cached = self._scan_queue.popitem(last=False)
+			scan = self._scans[service] = ServiceScan(service, cached)
+			self._scans_running += 1
+			logging.info('[Scanning] service: {}'.format(service))
+			self._dbus_conn.call_async(service, '/DeviceInstance', None, 'GetValue', '', [],
+				partial(self._on_scan_device_instance, scan),
+				partial(self._on_scan_device_instance_error, scan))
+
+	def _scan_active(self, scan):
+		if self._scans.get(scan.service) is scan:
+			return True
+		# Service disappeared or is scanned again
+		self._scan_finished(scan)
+		return False
+
+	def _scan_finished(self, scan):
+		self._scans_running -= 1
+		if self._scans.get(scan.service) is scan:
+			del self._scans[scan.service]
+			elapsed = time() - scan.started
+			self._stats.observe('dbus/scan', elapsed)
+			logging.info('[Scanning] {} done in {:.0f} ms'.format(scan.service, elapsed * 1000))
+			self._schedule_catalogue_save()
+		self._start_scans()
+		if self._scans_running == 0 and not self._scan_queue and self._scan_batch_started is not None:
+			logging.info('[Scanning] All services done in {:.0f} ms'.format(
+				(time() - self._scan_batch_started) * 1000))
+			self._scan_batch_started = None
+		self._check_scanning()
+
+	def _scanning(self):
+		""" Returns True while services are being scanned, or dormant
+		    ones looked up. """
+		return self._scans_running > 0 or bool(self._scan_queue) or self._lookups > 0
+
+	def _check_scanning(self):
+		if not self._scanning():
+			for output in self._outputs:
+				output.scan_done()
+
+	def _on_scan_error(self, scan, e):
+		try:
+			self._scan_failed(scan.service, e)
+		except dbus.exceptions.DBusException:
+			logging.exception("_scan_dbus_service_async")
+		finally:
+			self._scan_finished(scan)
+
+	def _on_scan_device_instance(self, scan, value):
+		try:
+			device_instance = int(value)
+		except TypeError:
+			device_instance = 0
+		self._scan_items_async(scan, device_instance)
+
+	def _on_scan_device_instance_error(self, scan, e):
+		if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject' or \
+			e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
+			self._scan_items_async(scan, 0)
+		else:
+			self._on_scan_error(scan, e)
+
+	def _scan_items_async(self, scan, device_instance):
+		if not self._scan_active(scan):
+			return
+		service = scan.service
+		if self._excluded_service(service, device_instance):
+			self._scan_finished(scan)
+			return
+		self._register_service(service, device_instance)
+		self._dbus_conn.call_async(service, '/', 'com.victronenergy.BusItem', 'GetItems', '', [],
+			partial(self._on_scan_items, scan, device_instance),
+			partial(self._on_scan_items_error, scan, device_instance))
+
+	def _on_scan_items(self, scan, device_instance, items):
+		if not self._scan_active(scan):
+			return
+		try:
+			self._add_scanned_items(scan.service, device_instance, items, True)
+			if isinstance(items, dict):
+				self._prune_cached_items(scan, items)
+		finally:
+			self._scan_finished(scan)
+
+	def _on_scan_items_error(self, scan, device_instance, e):
+		# No GetItems, fall back to GetValue on the root
+		if not self._scan_active(scan):
+			return
+		self._dbus_conn.call_async(scan.service, '/', None, 'GetValue', '', [],
+			partial(self._on_scan_values, scan, device_instance),
+			partial(self._on_scan_values_error, scan, device_instance))
+
+	def _on_scan_values(self, scan, device_instance, values):
+		if not self._scan_active(scan):
+			return
+		try:
+			self._add_scanned_values(scan.service, device_instance, values, True)
+			if isinstance(values, dict):
+				self._prune_cached_items(scan, values)
+		finally:
+			self._scan_finished(scan)
+
+	def _on_scan_values_error(self, scan, device_instance, e):
+		if not self._scan_active(scan):
+			return
+		if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject' or \
+			e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
+			self._introspect_async(scan, device_instance, '/')
+		else:
+			self._on_scan_error(scan, e)
+
+	def _introspect_async(self, scan, device_instance, path):
+		""" Walk the object tree of a service with non-blocking calls, the
+		    scan is finished when the last one returned. """
+		scan.pending += 1
+		self._dbus_conn.call_async(scan.service, path, None, 'Introspect', '', [],
+			partial(self._on_introspect, scan, device_instance, path),
+			partial(self._on_introspect_error, scan))
+
+	def _on_introspect(self, scan, device_instance, path, value):
+		if self._scans.get(scan.service) is scan and scan.error is None:
+			tree = etree.fromstring(value)
+			nodes = tree.findall('node')
+			if len(nodes) == 0:
+				for iface in tree.findall('interface'):
+					if iface.attrib.get('name') == 'com.victronenergy.BusItem':
+						scan.pending += 1
+						self._dbus_conn.call_async(scan.service, path, None, 'GetValue', '', [],
+							partial(self._on_introspect_value, scan, device_instance, path),
+							partial(self._on_introspect_error, scan))
 			else:
-				raise
+				for child in nodes:
+					name = child.attrib.get('name')
+					if name is not None:
+						self._introspect_async(scan, device_instance,
+							path + name if path.endswith('/') else path + '/' + name)
+		self._introspect_done(scan)
+
+	def _on_introspect_value(self, scan, device_instance, path, value):
+		if self._scans.get(scan.service) is scan and scan.error is None:
+			scan.paths.append(path)
+			item = self._add_item(scan.service, device_instance, path, value=value)
+			if item is not None:
+				self.publish(item)
+		self._introspect_done(scan)
+
+	def _on_introspect_error(self, scan, e):
+		if scan.error is None:
+			scan.error = e
+		self._introspect_done(scan)
+
+	def _introspect_done(self, scan):
+		scan.pending -= 1
+		if scan.pending > 0:
+			return
+		if self._scans.get(scan.service) is not scan:
+			# Service disappeared or is scanned again
+			self._scan_finished(scan)
+		elif scan.error is not None:
+			self._on_scan_error(scan, scan.error)
+		else:
+			self._introspected.add(scan.service)
+			logging.warning('[Scanning] {} does not provide an item listing'.format(scan.service))
+			try:
+				self._prune_cached_items(scan, scan.paths)
+			finally:
+				self._scan_finished(scan)
 
 	def _introspect(self, service, device_instance, path, publish=True):
-		value = self._dbus_conn.call_blocking(service, path, None, 'Introspect', '', [])
+		value = self._call_blocking(service, path, None, 'Introspect', '', [])
 		tree = etree.fromstring(value)
 		nodes = tree.findall('node')
 		if len(nodes) == 0:
 			for iface in tree.findall('interface'):
 				if iface.attrib.get('name') == 'com.victronenergy.BusItem':
 					v = self._get_dbus_value(service, path)
-					topic = self._add_item(service, device_instance, path, value=v)
-					if publish and topic is not None:
-						self.publish(topic, v)
+					item = self._add_item(service, device_instance, path, value=v)
+					if publish and item is not None:
+						self.publish(item)
 		else:
 			for child in nodes:
 				name = child.attrib.get('name')
@@ -478,8 +1162,11 @@ class DbusMqtt(MqttGObjectBridge):
 		service = self._service_ids.get(service_id)
 		if service is None:
 			return
+		self._stats.incr('signals/' + service)
 
 		if isinstance(items, dict):
+			if self._trace is not None:
+				self._trace.items(service, items)
 			for path, changes in items.items():
 				try:
 					v = changes['Value']
@@ -492,86 +1179,109 @@ class DbusMqtt(MqttGObjectBridge):
 		service = self._service_ids.get(service_id)
 		if service is None:
 			return
+		self._stats.incr('signals/' + service)
 
 		value = changes.get("Value")
 		if value is None:
 			return
 
+		if self._trace is not None:
+			self._trace.value(service, path, value)
 		self._value_changed_inner(service, path, value)
 
 	def _value_changed_inner(self, service, path, value):
 		uid = service + path
-		topic = self._topics.get(uid)
-		if topic is None:
-			for service_short_name, service_name in self._services.items():
-				if service_name == service:
-					device_instance = service_short_name.split('/')[1]
-					self._add_item(service, device_instance, path)
-					logging.info('New item found: {}{}'.format(service_short_name, path))
-					topic = self._topics[uid]
-					break
-			else:
+		item = self._items.get(uid)
+		if item is None:
+			if uid in self._excluded:
 				return
-		self._values[topic] = value
-		self.publish(topic, value)
-
-	def _timer_service_queue(self):
-		if len(self.queue) > 0 and time() - self._last_queue_run > 1.5:
-			if self._service_queue():
-				# The queue is not empty
-				GLib.idle_add(self._service_queue)
-		return True
-
-	def _service_queue(self):
-		# If we are not connected, we cannot service the queue
-		if self._socket_watch is None:
-			return False
-
-		# To remain somewhat responsive, limit the number of items
-		# published and schedule the rest when idle again.
-		self._last_queue_run = time()
-		for _ in range(50):
-			try:
-				topic, value = self.queue.popitem(last=False)
-			except KeyError:
-				return False
-			else:
-				try:
-					self.__publish(topic,
-						None if value is None else json.dumps(dict(value=unwrap_dbus_value(value))),
-						retain=True)
-				except:
-					logging.error('[Queue] Error publishing: {} {}'.format(topic, value))
-					traceback.print_exc()
-
+			info = self._service_info.get(service)
+			if info is None or not info.active:
+				return
+			item = self._add_item(service, info.device_instance, path)
+			if item is None:
+				return
+			logging.info('New item found: {}{}'.format(info.short_name, path))
+			self._schedule_catalogue_save()
+		if self._read_max_age:
+			item.updated = monotonic()
+		if not item.set_value(value):
+			return
+		f = item.filter
+		if f is not None and not f.accept(value, monotonic()):
+			if f.due is not None:
+				self._held.add(item)
+			for output in self._outputs:
+				output.value_set(item)
+			return
+		self.publish(item)
+
+	def _flush_held(self):
+		""" Publish values that were held back by a filter, once they are
+		    due. """
+		now = monotonic()
+		for item in list(self._held):
+			f = item.filter
+			if f.due is None:
+				self._held.discard(item)
+			elif now >= f.due:
+				self._held.discard(item)
+				f.sent(item.value, now)
+				self.publish(item)
 		return True
 
 	def _add_item(self, service, device_instance, path, value=None):
 		if not path.startswith('/'):
 			path = '/' + path
 		uid = service + path
-		r = self._topics.get(uid)
-		if r is not None:
-			# Topic exist already
-			return r
-
+		item = self._items.get(uid)
+		if item is not None:
+			# Item exists already
+			if value is not None:
+				if item.set_value(value):
+					for output in self._outputs:
+						output.value_set(item)
+				if self._read_max_age:
+					item.updated = monotonic()
+			return item
+
+		info = self._service_info.get(service)
+		if info is None:
+			info = self._register_service(service, device_instance)
 		service_type = get_service_type(service)
-		if (service_type, path) in blocked_items:
+		if not self._item_rules.included(service_type, device_instance, path):
+			self._excluded.add(uid)
+			info.excluded.add(uid)
 			return None
 
-		self._topics[uid] = topic = 'N/{}/{}/{}{}'.format(self._system_id, service_type, device_instance, path)
-		self._values[topic] = value
-		return topic
+		self._items[uid] = item = Item(uid,
+			'N/{}/{}/{}{}'.format(self._system_id, service_type, device_instance, path), value,
+			next(self._aliases))
+		if value is not None and self._read_max_age:
+			item.updated = monotonic()
+		info.items.add(item)
+		if self._filter_rules:
+			item.filter = self._filter_rules.state_for(service_type, path)
+		for output in self._outputs:
+			output.items_changed(info.short_name)
+		return item
+
+	def _call_blocking(self, service, path, interface, method, signature, args):
+		started = monotonic()
+		try:
+			return self._dbus_conn.call_blocking(service, path, interface, method, signature, args)
+		finally:
+			self._stats.observe('dbus/blocking', monotonic() - started)
 
 	def _get_dbus_value(self, service, path):
-		return self._dbus_conn.call_blocking(service, path, None, 'GetValue', '', [])
+		return self._call_blocking(service, path, None, 'GetValue', '', [])
 
 	def _set_dbus_value(self, service, path, value):
 		value = wrap_dbus_value(value)
-		return self._dbus_conn.call_blocking(service, path, None, 'SetValue', 'v', [value])
+		return self._call_blocking(service, path, None, 'SetValue', 'v', [value])
 
 	def _get_dbus_items(self, service):
-		return self._dbus_conn.call_blocking(service, '/', 'com.victronenergy.BusItem', 'GetItems', '', [])
+		return self._call_blocking(service, '/', 'com.victronenergy.BusItem', 'GetItems', '', [])
 
 def get_service_type(service_name):
 	if not service_name.startswith(ServicePrefix):
@@ -589,6 +1299,54 @@ def get_short_service_name(service, device_instance):
 	return '{}/{}'.format(get_service_type(service), device_instance)
 
 
+# Keys of an entry in an outputs file, and the MqttOutput argument of each
+OUTPUT_OPTIONS = {
+	'name': 'name',
+	'server': 'mqtt_server',
+	'port': 'port',
+	'client-id': 'client_id',
+	'user': 'user',
+	'password': 'passwd',
+	'ca-cert': 'ca_cert',
+	'keep-alive': 'keep_alive_interval',
+	'max-messages': 'max_messages',
+	'max-bytes': 'max_bytes',
+	'rate-boost': 'rate_boost',
+	'persistent-session': 'persistent_session',
+	'max-queue': 'max_queue',
+	'write-watch': 'write_watch',
+	'publish-all': 'publish_all',
+}
+
+
+def load_outputs(path):
+	""" Read more brokers to publish to from a JSON file holding a list of
+	    objects, eg. [{"name": "scada", "server": "scada.example.com",
+	    "port": 8883, "ca-cert": "/data/scada.crt", "user": "gx",
+	    "password": "secret", "max-messages": 50, "publish-all": true}].
+	    See OUTPUT_OPTIONS for the keys, besides spill-file and spill-size.
+	    Returns a list of keyword arguments for MqttOutput. """
+	with open(path) as f:
+		entries = json.load(f)
+	outputs = []
+	for entry in entries:
+		entry = dict(entry)
+		spill_file = entry.pop('spill-file', None)
+		spill_size = entry.pop('spill-size', SPILL_SIZE)
+		unknown = set(entry) - set(OUTPUT_OPTIONS)
+		if unknown:
+			raise ValueError('Unknown output options: {}'.format(', '.join(sorted(unknown))))
+		kwargs = {OUTPUT_OPTIONS[k]: v for k, v in entry.items()}
+		kwargs.setdefault('name', kwargs.get('mqtt_server'))
+		# Like --keep-alive, 0 means that subscriptions never expire
+		keep_alive = kwargs.get('keep_alive_interval', MAX_TOPIC_AGE)
+		kwargs['keep_alive_interval'] = keep_alive if (keep_alive or 0) > 0 else None
+		if spill_file is not None:
+			kwargs['spill'] = SpillRing(spill_file, spill_size)
+		outputs.append(kwargs)
+	return outputs
+
+
 def dumpstacks(signal, frame):
 	import threading
 	id2name = dict((t.ident, t.name) for t in threading.enumerate())
@@ -596,9 +1354,47 @@ def dumpstacks(signal, frame):
 		logging.info ("=== {} ===".format(id2name[tid]))
 		traceback.print_stack(f=stack)
 
+def dump_stats(handler, signal, frame):
+	handler.dump_stats()
+
+def reload_item_rules(handler, path, signal, frame):
+	try:
+		rules = ItemRules.load(path)
+	except (IOError, OSError, ValueError) as e:
+		logging.error('[Rules] Not reloaded: {}'.format(e))
+		return
+	# Apply them from the main loop
+	GLib.idle_add(handler.reload_item_rules, rules)
+
 def exit(mainloop, signal, frame):
 	mainloop.quit()
 
+def egress_exited(mainloop, pid, status):
+	logging.error('[Ring] The egress process exited with status {}'.format(status))
+	mainloop.quit()
+
+def run_egress(args, keep_alive_interval, changes, requests):
+	""" The process that publishes to the brokers in two-process mode.
+	    Does not return. """
+	mainloop = GLib.MainLoop()
+	outputs = [dict(mqtt_server=args.mqtt_server, ca_cert=args.mqtt_certificate, user=args.mqtt_user,
+		passwd=args.mqtt_password, keep_alive_interval=keep_alive_interval, init_broker=args.init_broker,
+		debug=args.debug, max_messages=args.max_messages, max_bytes=args.max_bytes,
+		rate_boost=args.rate_boost, persistent_session=args.persistent_session, max_queue=args.max_queue,
+		spill=None if args.spill_file is None else SpillRing(args.spill_file, args.spill_size),
+		write_watch=args.write_watch)]
+	if args.outputs is not None:
+		outputs.extend(dict(kwargs, debug=args.debug) for kwargs in load_outputs(args.outputs))
+	Egress(changes, requests, outputs, closed=mainloop.quit)
+	signal.signal(signal.SIGINT, partial(exit, mainloop))
+	signal.signal(signal.SIGUSR1, dumpstacks)
+	try:
+		mainloop.run()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		os._exit(0)
+
 def main():
 	parser = argparse.ArgumentParser(description='Publishes values from the D-Bus to an MQTT broker')
 	parser.add_argument('-d', '--debug', help='set logging level to debug', action='store_true')
@@ -609,19 +1405,102 @@ def main():
 	parser.add_argument('-b', '--dbus', default=None, help='dbus address')
 	parser.add_argument('-k', '--keep-alive', default=MAX_TOPIC_AGE, help='keep alive interval in seconds', type=int)
 	parser.add_argument('-i', '--init-broker', action='store_true', help='Tries to setup communication with VRM MQTT broker')
+	parser.add_argument('--async-scan', action='store_true', help='scan D-Bus services without blocking, several at a time')
+	parser.add_argument('--scan-concurrency', default=SCAN_CONCURRENCY, type=int,
+		help='number of services scanned at the same time with --async-scan')
+	parser.add_argument('--async-requests', action='store_true', help='handle W/ and R/ requests without blocking')
+	parser.add_argument('--request-window', default=REQUEST_WINDOW, type=int,
+		help='number of requests in flight per service with --async-requests')
+	parser.add_argument('--dbus-timeout', default=None, type=float,
+		help='timeout in seconds for requests with --async-requests (default: the D-Bus default)')
+	parser.add_argument('--max-messages', default=0, type=float,
+		help='messages per second published to the broker, 0 for no limit')
+	parser.add_argument('--max-bytes', default=0, type=float,
+		help='bytes per second published to the broker, 0 for no limit')
+	parser.add_argument('--rate-boost', default=RATE_BOOST, type=float,
+		help='how many times the rate limits may be raised to drain a backlog')
+	parser.add_argument('--filter-rules', default=None,
+		help='JSON file with deadband and publish interval rules')
+	parser.add_argument('--item-rules', default=None,
+		help='JSON file with rules to include or exclude items, reloaded on SIGHUP')
+	parser.add_argument('--persistent-session', action='store_true',
+		help='keep the broker session, so that a reconnect only sends values that changed')
+	parser.add_argument('--stats-interval', default=0, type=float,
+		help='publish counters and timings on N/<portal id>/$stats every so many seconds, 0 to disable')
+	parser.add_argument('--catalogue', default=None,
+		help='file to keep the items of all services in, to publish them right away after a restart')
+	parser.add_argument('--max-queue', default=0, type=int,
+		help='number of messages kept while the broker is unreachable, 0 for no limit. '
+			'Removals of retained values are kept beyond it, unless there is a --spill-file')
+	parser.add_argument('--spill-file', default=None,
+		help='file for removals of retained values that do not fit in --max-queue')
+	parser.add_argument('--spill-size', default=SPILL_SIZE, type=int,
+		help='size of --spill-file in bytes')
+	parser.add_argument('--write-watch', action='store_true',
+		help='write to the broker as soon as the socket is writable, instead of from a timer')
+	parser.add_argument('--read-max-age', default=0, type=float,
+		help='answer R/ requests with the cached value if it is no older than this, in seconds')
+	parser.add_argument('--lazy', action='store_true',
+		help='scan a service and follow its values only while a subscription or read asks for it')
+	parser.add_argument('--outputs', default=None,
+		help='JSON file with more brokers to publish to, each with its own connection and limits')
+	parser.add_argument('--record', default=None,
+		help='append D-Bus signals and MQTT requests to this trace file')
+	parser.add_argument('--replay', default=None,
+		help='feed the events of this trace file into the bridge')
+	parser.add_argument('--replay-speed', default=1, type=float,
+		help='replay this many times faster than real time, 0 for as fast as possible')
+	parser.add_argument('--two-process', action='store_true',
+		help='publish to the brokers from a second process, fed through shared memory')
+	parser.add_argument('--ring-size', default=RING_SIZE, type=int,
+		help='size in bytes of the shared memory ring of --two-process')
 	args = parser.parse_args()
+	if args.two_process and (args.lazy or args.replay is not None):
+		parser.error('--two-process cannot be used with --lazy or --replay')
+	if args.ring_size < MIN_RING_SIZE:
+		parser.error('--ring-size must be at least {}'.format(MIN_RING_SIZE))
 
 	print("-------- dbus_mqtt, v{} is starting up --------".format(SoftwareVersion))
 	logger = setup_logging(args.debug)
+	keep_alive_interval = args.keep_alive if args.keep_alive > 0 else None
+
+	egress = None
+	if args.two_process:
+		# Fork before anything is connected
+		changes = Ring(args.ring_size)
+		requests = Ring(args.ring_size)
+		pid = os.fork()
+		if pid == 0:
+			run_egress(args, keep_alive_interval, changes.reader(), requests.writer())
+		egress = (changes.writer(), requests.reader())
 
 	mainloop = GLib.MainLoop()
 	# Have a mainloop, so we can send/receive asynchronous calls to and from dbus
 	DBusGMainLoop(set_as_default=True)
-	keep_alive_interval = args.keep_alive if args.keep_alive > 0 else None
+	if egress is not None:
+		GLib.child_watch_add(pid, partial(egress_exited, mainloop))
+	trace = None if args.record is None else TraceWriter(args.record)
 	handler = DbusMqtt(
 		mqtt_server=args.mqtt_server, ca_cert=args.mqtt_certificate, user=args.mqtt_user,
 		passwd=args.mqtt_password, dbus_address=args.dbus, keep_alive_interval=keep_alive_interval,
-		init_broker=args.init_broker, debug=args.debug)
+		init_broker=args.init_broker, debug=args.debug, async_scan=args.async_scan,
+		scan_concurrency=args.scan_concurrency, async_requests=args.async_requests,
+		request_window=args.request_window, dbus_timeout=args.dbus_timeout,
+		max_messages=args.max_messages, max_bytes=args.max_bytes, rate_boost=args.rate_boost,
+		filter_rules=None if args.filter_rules is None else FilterRules.load(args.filter_rules),
+		persistent_session=args.persistent_session, stats_interval=args.stats_interval, trace=trace,
+		catalogue=None if args.catalogue is None else Catalogue(args.catalogue).load(),
+		max_queue=args.max_queue,
+		# With --two-process the egress process has the outputs
+		spill=None if args.spill_file is None or egress is not None \
+			else SpillRing(args.spill_file, args.spill_size),
+		write_watch=args.write_watch,
+		outputs=() if args.outputs is None or egress is not None else load_outputs(args.outputs),
+		item_rules=None if args.item_rules is None else ItemRules.load(args.item_rules), lazy=args.lazy,
+		read_max_age=args.read_max_age, egress=egress)
+
+	if args.replay is not None:
+		TraceReplayer(handler, read_trace(args.replay), args.replay_speed).start()
 
 	# Quit the mainloop on ctrl+C
 	signal.signal(signal.SIGINT, partial(exit, mainloop))
@@ -629,11 +1508,21 @@ def main():
 	# Handle SIGUSR1 and dump a stack trace
 	signal.signal(signal.SIGUSR1, dumpstacks)
 
+	# Handle SIGUSR2 and log the stats
+	signal.signal(signal.SIGUSR2, partial(dump_stats, handler))
+
+	# Handle SIGHUP and reload the item rules
+	if args.item_rules is not None:
+		signal.signal(signal.SIGHUP, partial(reload_item_rules, handler, args.item_rules))
+
 	# Start and run the mainloop
 	try:
 		mainloop.run()
 	except KeyboardInterrupt:
 		pass
+	finally:
+		if trace is not None:
+			trace.close()
 
 if __name__ == '__main__':
 	main()
@@ -9,40 +9,56 @@ import ssl
 import sys
 import traceback
 from gi.repository import GLib
+from time import monotonic
 
 
 AppDir = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(1, os.path.join(AppDir, 'ext', 'velib_python'))
 from ve_utils import exit_on_error
+from stats import Stats
 
 
 class MqttGObjectBridge(object):
-	def __init__(self, mqtt_server=None, client_id="", ca_cert=None, user=None, passwd=None, debug=False):
+	""" Runs a paho client on the GLib main loop. Incoming data is read as
+	    soon as the socket is readable. Outgoing data is written by paho
+	    right away, and what does not fit in the socket, or was published
+	    from a paho callback, is written by a timer that runs every second.
+	    With write_watch, such data is written as soon as the socket is
+	    writable instead, and Nagle's algorithm is turned off so that small
+	    messages are not held back either. """
+	def __init__(self, mqtt_server=None, client_id="", ca_cert=None, user=None, passwd=None, debug=False,
+			clean_session=True, stats=None, write_watch=False, port=None):
 		self._ca_cert = ca_cert
 		self._mqtt_user = user
 		self._mqtt_passwd = passwd
 		self._mqtt_server = mqtt_server or '127.0.0.1'
-		self._client = paho.mqtt.client.Client(client_id)
+		# The default port of plain or TLS connections if None
+		self._mqtt_port = port
+		self._client = paho.mqtt.client.Client(client_id, clean_session=clean_session)
 		self._client.on_connect = self._on_connect
 		self._client.on_message = self._on_message
+		self._client.on_subscribe = self._on_subscribe
 		self._client.on_disconnect = self._on_disconnect
 		if debug:
 			self._client.on_log = self._on_log
 		self._socket_watch = None
 		self._socket_timer = None
+		self._use_write_watch = write_watch
+		self._write_watch = None
+		self._stats = Stats() if stats is None else stats
 		if self._init_mqtt():
 			GLib.timeout_add_seconds(5, exit_on_error, self._init_mqtt)
 
 	def _init_mqtt(self):
 		try:
-			logging.info('[Init] Connecting to local broker')
+			logging.info('[Init] Connecting to broker {}'.format(self._mqtt_server))
 			if self._mqtt_user is not None and self._mqtt_passwd is not None:
 				self._client.username_pw_set(self._mqtt_user, self._mqtt_passwd)
 			if self._ca_cert is None:
-				self._client.connect(self._mqtt_server, 1883, 60)
+				self._client.connect(self._mqtt_server, self._mqtt_port or 1883, 60)
 			else:
 				self._client.tls_set(self._ca_cert, cert_reqs=ssl.CERT_REQUIRED)
-				self._client.connect(self._mqtt_server, 8883, 60)
+				self._client.connect(self._mqtt_server, self._mqtt_port or 8883, 60)
 			self._init_socket_handlers()
 			return False
 		except socket.error as e:
@@ -55,6 +71,13 @@ class MqttGObjectBridge(object):
 			GLib.source_remove(self._socket_watch)
 		self._socket_watch = GLib.io_add_watch(self._client.socket().fileno(), GLib.IO_IN,
 			self._on_socket_in)
+		if self._use_write_watch:
+			try:
+				self._client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			except socket.error:
+				# Not a TCP socket
+				pass
+			self._flush()
 		if self._socket_timer is None:
 			self._socket_timer = GLib.timeout_add_seconds(1, exit_on_error, self._on_socket_timer)
 
@@ -62,27 +85,60 @@ class MqttGObjectBridge(object):
 		print(log)
 
 	def _on_socket_in(self, src, condition):
+		started = monotonic()
 		exit_on_error(self._client.loop_read)
+		self._stats.observe('mqtt/read', monotonic() - started)
+		# Answers queued by paho while reading
+		self._flush()
 		return True
 
+	def _flush(self):
+		""" Call after publishing. With write_watch, make sure that data
+		    paho could not write yet goes out as soon as possible. """
+		if self._use_write_watch and self._write_watch is None and self._socket_watch is not None \
+				and self._client.want_write():
+			self._write_watch = GLib.io_add_watch(self._client.socket().fileno(), GLib.IO_OUT,
+				self._on_socket_out)
+
+	def _remove_write_watch(self):
+		if self._write_watch is not None:
+			GLib.source_remove(self._write_watch)
+			self._write_watch = None
+
+	def _on_socket_out(self, src, condition):
+		started = monotonic()
+		exit_on_error(self._client.loop_write)
+		self._stats.observe('mqtt/write', monotonic() - started)
+		if self._client.want_write():
+			return True
+		self._write_watch = None
+		return False
+
 	def _on_socket_timer(self):
 		self._client.loop_misc()
+		started = monotonic()
 		while self._client.want_write():
 			if self._client.loop_write(10) != paho.mqtt.client.MQTT_ERR_SUCCESS:
 				break
+		self._stats.observe('mqtt/write', monotonic() - started)
 		return True
 
 	def _on_connect(self, client, userdata, dict, rc):
-		pass
+		self._stats.incr('mqtt/connects')
 
 	def _on_message(self, client, userdata, msg):
 		pass
 
+	def _on_subscribe(self, client, userdata, mid, granted_qos):
+		pass
+
 	def _on_disconnect(self, client, userdata, rc):
 		logging.error('[Disconnected] Lost connection to broker')
+		self._stats.incr('mqtt/disconnects')
 		if self._socket_watch is not None:
 			GLib.source_remove(self._socket_watch)
 			self._socket_watch = None
+		self._remove_write_watch()
 		logging.info('[Disconnected] Set timer')
 		GLib.timeout_add(5000, exit_on_error, self._reconnect)
 
@@ -0,0 +1,1377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" The outputs that the items on the D-Bus are published to: MqttOutput
+    talks to a broker, RingOutput hands everything to an Egress in another
+    process, which feeds the MqttOutputs there. """
+import dbus
+import heapq
+import json
+import logging
+import os
+import struct
+import sys
+import traceback
+from collections import OrderedDict
+from gi.repository import GLib
+from itertools import count, zip_longest
+from operator import attrgetter
+from time import time, monotonic
+
+AppDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, os.path.join(AppDir, 'ext', 'velib_python'))
+from ve_utils import get_vrm_portal_id, unwrap_dbus_value
+from mqtt_gobject_bridge import MqttGObjectBridge
+from publish_queue import PublishQueue, RateLimiter, LANE_REPLY, LANE_WRITE, LANE_CHANGE, LANE_BULK
+from payload import encode_json, encode_cbor, decode_cbor, CBOR_UNDEFINED
+from stats import Stats
+from mosquitto_bridge_registrator import MosquittoBridgeRegistrator
+
+
+VeDbusInvalid = dbus.Array([], signature=dbus.Signature('i'), variant_level=1)
+
+MAX_TOPIC_AGE = 60
+RATE_BOOST = 4
+# Number of messages published per run of the main loop
+QUEUE_SLICE = 50
+
+# Records of the two-process mode, from RingOutput to Egress and back
+RECORD_ITEM = 1           # alias, full topic, value
+RECORD_VALUE = 2          # alias, lane, value
+RECORD_UNPUBLISH = 3      # alias
+RECORD_DROP = 4           # alias
+RECORD_WRITE = 5          # alias
+RECORD_REPLY = 6          # output, topic, payload (empty if None)
+RECORD_CLEAR = 7          # topic
+RECORD_PUBLISH_ALL = 8
+RECORD_STATS = 9          # JSON
+RECORD_REQUEST = 10       # output, topic, payload
+RECORD_SET = 11           # alias, value, which is not published
+RECORD_SCANNED = 12
+_ring_header = struct.Struct('=B')
+_ring_alias = struct.Struct('=BI')
+_ring_value = struct.Struct('=BIB')
+_ring_item = struct.Struct('=BIH')
+_ring_request = struct.Struct('=BBH')
+
+class BaseTopic(object):
+	__slots__ = ('topic','timestamp', 'maxage', 'covered')
+
+	def __init__(self, maxage):
+		self.timestamp = int(time())
+		self.maxage = maxage
+		# Published topics that are kept alive by this subscription
+		self.covered = set()
+
+	@property
+	def deadline(self):
+		return None if self.maxage is None else self.timestamp + self.maxage
+
+class WildcardTopic(BaseTopic):
+	def __init__(self, maxage):
+		super(WildcardTopic, self).__init__(maxage)
+		self.topic = None
+
+	def match(self, topic):
+		return True
+
+	def __eq__(self, other):
+		return isinstance(other, WildcardTopic)
+
+	def __hash__(self):
+		return hash(None)
+
+# payload example:
+# ["system/#","inverter/+/voltage"]
+# filter string can end in a # (test with "endswith"), or contain a `+`.
+class Topic(BaseTopic):
+	def __init__(self, t, maxage):
+		super(Topic, self).__init__(maxage)
+		self.topic = tuple(t)
+
+	def match(self, topic):
+		for x, y in zip_longest(self.topic, topic):
+			if None in (x, y):
+				return False
+			if '+' in (x, y):
+				continue
+			if '#' in (x, y):
+				return True
+			if x == y:
+				continue
+			return False
+		return True
+
+	def __eq__(self, other):
+		return self.topic == other.topic
+
+	def __hash__(self):
+		return hash('/'.join(self.topic))
+
+class ExactTopic(Topic):
+	""" This is here because it is faster for matches without
+	    wildcards. """
+	def match(self, topic):
+		return self.topic == topic
+
+class SubscriptionNode(object):
+	""" One level of the subscription trie. Wildcard levels are stored as
+	    children named '+' and '#'. Topics holds the subscriptions whose
+	    filter ends at this node. """
+	__slots__ = ('children', 'topics')
+
+	def __init__(self):
+		self.children = {}
+		self.topics = {}
+
+class Subscriptions(object):
+	""" Keeps subscriptions in a trie keyed on topic levels, so that a match
+	    costs in the order of the topic depth rather than the number of
+	    subscriptions. """
+	def __init__(self):
+		self.wildcard = None
+		# Key: filter as a tuple of levels, value: Topic
+		self.topics = {}
+		self.root = SubscriptionNode()
+		# Min-heap of (deadline, seq, topic). Refreshing a subscription
+		# pushes a new entry, stale entries are skipped when popped.
+		self._expiry = []
+		self._seq = count()
+		# Items that are kept alive by a subscription. Key: Item, value:
+		# the subscription that covers it.
+		self.published = {}
+
+	def _schedule(self, t):
+		deadline = t.deadline
+		if deadline is not None:
+			heapq.heappush(self._expiry, (deadline, next(self._seq), t))
+
+	@staticmethod
+	def _path(levels):
+		# Topic.match stops looking at the first '#', so levels after it
+		# are not part of the trie path.
+		try:
+			return levels[:levels.index('#') + 1]
+		except ValueError:
+			return levels
+
+	def subscribe_all(self, ttl=MAX_TOPIC_AGE):
+		if self.wildcard is None:
+			self.wildcard = WildcardTopic(ttl)
+			self._schedule(self.wildcard)
+			return self.wildcard
+
+		# Refresh timestamp and potentially also ttl
+		self.wildcard.timestamp = int(time())
+		self.wildcard.maxage = ttl
+		self._schedule(self.wildcard)
+		return None
+
+	def subscribe(self, topic, ttl=MAX_TOPIC_AGE):
+		levels = tuple(topic.split('/'))
+		t = self.topics.get(levels)
+		if t is not None:
+			# Refresh timestamp and potentially also ttl
+			t.timestamp = int(time())
+			t.maxage = ttl
+			self._schedule(t)
+			return None
+
+		t = Topic(levels, ttl) if '+' in topic or '#' in topic else ExactTopic(levels, ttl)
+		node = self.root
+		for level in self._path(levels):
+			child = node.children.get(level)
+			if child is None:
+				child = node.children[level] = SubscriptionNode()
+			node = child
+		node.topics[levels] = t
+		self.topics[levels] = t
+		self._schedule(t)
+		return t
+
+	def _unsubscribe(self, t):
+		del self.topics[t.topic]
+		path = self._path(t.topic)
+		nodes = [self.root]
+		for level in path:
+			nodes.append(nodes[-1].children[level])
+		del nodes[-1].topics[t.topic]
+
+		# Prune nodes that no longer lead to a subscription
+		for i in range(len(path), 0, -1):
+			node = nodes[i]
+			if node.topics or node.children:
+				break
+			del nodes[i - 1].children[path[i - 1]]
+
+	def match(self, t):
+		return self.find(t) is not None
+
+	def find(self, t):
+		""" Return a subscription that matches the short topic t, or None. """
+		if self.wildcard is not None:
+			return self.wildcard
+		return self._find(self.root, t, 0)
+
+	def match_prefix(self, prefix):
+		""" Returns True if a subscription could match a topic of more
+		    levels than prefix, that starts with prefix. """
+		if self.wildcard is not None:
+			return True
+		return self._match_prefix(self.root, prefix, 0)
+
+	def _match_prefix(self, node, prefix, i):
+		children = node.children
+		if i == len(prefix):
+			return bool(children)
+		if '#' in children:
+			return True
+		child = children.get('+')
+		if child is not None and self._match_prefix(child, prefix, i + 1):
+			return True
+		child = children.get(prefix[i])
+		return child is not None and self._match_prefix(child, prefix, i + 1)
+
+	def _find(self, node, t, i):
+		if i == len(t):
+			return next(iter(node.topics.values()), None)
+		children = node.children
+		child = children.get('#')
+		if child is not None:
+			# A '#' matches one or more remaining levels
+			return next(iter(child.topics.values()))
+		child = children.get('+')
+		if child is not None:
+			r = self._find(child, t, i + 1)
+			if r is not None:
+				return r
+		child = children.get(t[i])
+		return None if child is None else self._find(child, t, i + 1)
+
+	def cover(self, pt, topic=None):
+		""" Record that published item pt is kept alive by a subscription,
+		    either the one passed in or any one that matches. Returns the
+		    subscription, or None if nothing matches. """
+		if topic is None:
+			topic = self.find(pt.shorttopic)
+		if topic is not None:
+			old = self.published.get(pt)
+			if old is not None and old is not topic:
+				old.covered.discard(pt)
+			topic.covered.add(pt)
+			self.published[pt] = topic
+		return topic
+
+	def uncover(self, pt):
+		""" Record that published item pt is no longer published. """
+		topic = self.published.pop(pt, None)
+		if topic is not None:
+			topic.covered.discard(pt)
+
+	def cleanup(self, exceptions):
+		""" Remove expired topics from subscriptions. Return items that
+		    should be unpublished, leaving alone those whose full topic is in
+		    exceptions. Only items that were covered by an expired
+		    subscription are matched again. """
+		now = int(time())
+		candidates = set()
+		while self._expiry and now > self._expiry[0][0]:
+			deadline, _, t = heapq.heappop(self._expiry)
+			if t.deadline != deadline:
+				# Refreshed since this entry was pushed
+				continue
+			if t is self.wildcard:
+				self.wildcard = None
+			elif self.topics.get(t.topic) is t:
+				self._unsubscribe(t)
+			else:
+				continue
+			candidates.update(t.covered)
+			t.covered = set()
+
+		# Find topics that should no longer be published
+		published = self.published
+		return [pt for pt in candidates if pt in published and pt.fulltopic not in exceptions \
+			and self.cover(pt) is None]
+
+class KeepaliveOptions(object):
+	""" Options that clients ask for in their keepalive. An option stays
+	    active for as long as it is repeated within the keepalive
+	    interval. """
+	def __init__(self):
+		# Key: option, value: deadline, or None if it never expires
+		self._deadlines = {}
+
+	def refresh(self, options, ttl=MAX_TOPIC_AGE):
+		""" Refresh options, return those that were not active before. """
+		added = [o for o in options if o not in self]
+		deadline = None if ttl is None else time() + ttl
+		for o in options:
+			self._deadlines[o] = deadline
+		return added
+
+	def expire(self):
+		""" Forget options that were not repeated in time, return them. """
+		now = time()
+		expired = [o for o, d in self._deadlines.items() if d is not None and now > d]
+		for o in expired:
+			del self._deadlines[o]
+		return expired
+
+	def __contains__(self, option):
+		deadline = self._deadlines.get(option, 0)
+		return deadline is None or time() <= deadline
+
+class Item(object):
+	""" Everything we track for one D-Bus item. It is created once, when the
+	    item is first seen, so that handling a value change needs only a
+	    single lookup. The levels of the short topic are interned, they are
+	    shared by many items. """
+	__slots__ = ('uid', 'fulltopic', 'shorttopic', 'value', 'updated', 'filter', 'payload', 'cbor', 'alias')
+
+	def __init__(self, uid, fulltopic, value=None, alias=None):
+		# D-Bus service + path
+		self.uid = uid
+		self.fulltopic = fulltopic
+		# Numeric id that stands for the topic, see alias_dictionary
+		self.alias = alias
+		# Topic without the N/<portal id> prefix, split into levels
+		self.shorttopic = tuple(sys.intern(x) for x in fulltopic.split('/')[2:])
+		# Last value seen on D-Bus
+		self.value = value
+		# Monotonic time the value was last confirmed by the service, or
+		# None if it was not. Only kept when reads may use the cache.
+		self.updated = None
+		# FilterState if a filter rule applies
+		self.filter = None
+		# Encoded value, cached until the value changes
+		self.payload = None
+		self.cbor = None
+
+	def set_value(self, value):
+		""" Returns False if the value did not change. """
+		if type(value) is type(self.value) and value == self.value:
+			return False
+		self.value = value
+		self.payload = self.cbor = None
+		return True
+
+	def encode(self):
+		payload = self.payload
+		if payload is None and self.value is not None:
+			payload = self.payload = encode_json(self.value)
+		return payload
+
+	def encode_cbor(self):
+		payload = self.cbor
+		if payload is None and self.value is not None:
+			payload = self.cbor = encode_cbor(self.value)
+		return payload
+
+class ServiceInfo(object):
+	""" One service that was scanned: its device instance, the short name
+	    (type/instance) it is published under, its items, and the uids of
+	    its items that are excluded. A service can be torn down without
+	    looking at the items of other services. In lazy mode a service is
+	    not active, it has no items, until something asks for it. """
+	__slots__ = ('name', 'device_instance', 'short_name', 'items', 'excluded', 'active', 'lease')
+
+	def __init__(self, name, device_instance, short_name):
+		self.name = name
+		self.device_instance = device_instance
+		self.short_name = short_name
+		self.items = set()
+		self.excluded = set()
+		self.active = True
+		# Lazy mode: time until which a read keeps the service active
+		self.lease = 0
+
+class MqttOutput(MqttGObjectBridge):
+	""" One broker the items are published to. Each output has its own
+	    connection, keepalive subscriptions, queue and rate limits, and
+	    keeps track of which items it publishes and which values the
+	    broker has. The items themselves, and everything on the D-Bus
+	    side, are shared: they belong to the DbusMqtt instance that feeds
+	    all outputs. """
+	def __init__(self, ingest, name='main', mqtt_server=None, port=None, client_id='ve-dbus-mqtt-py',
+				ca_cert=None, user=None, passwd=None, keep_alive_interval=None, init_broker=False,
+				debug=False, max_messages=0, max_bytes=0, rate_boost=RATE_BOOST, persistent_session=False,
+				max_queue=0, spill=None, write_watch=False, publish_all=False):
+		self._ingest = ingest
+		self.name = name
+		self._system_id = ingest._system_id
+		self._system_id_topic = ingest._system_id_topic
+		self._connected_to_cloud = False
+		# Track subscriptions.
+		self._subscriptions = Subscriptions()
+		self._keepalive_options = KeepaliveOptions()
+		self._keep_alive_interval = keep_alive_interval
+		if publish_all:
+			# Publish everything, without waiting for a keepalive
+			self._subscriptions.subscribe_all(None)
+		# A queue of value changes, so that we may rate-limit this somewhat.
+		# Key: topic, value: the Item, or a plain value for topics that do not
+		# belong to an item.
+		self.queue = PublishQueue()
+		# Items waiting in the queue. Key: Item, value: its lane.
+		self._dirty = {}
+		# Key: Item, value: the payload the broker has, as far as we know
+		self._sent = {}
+		self._rate_limiter = RateLimiter(max_messages, max_bytes, rate_boost)
+		self._queue_source = None
+		# When the queue was last found empty, for the age of the backlog
+		self._queue_since = None
+		# Limit on the queue while disconnected, and the SpillRing for
+		# messages that do not fit.
+		self._max_queue = max_queue
+		self._spill = spill
+		# Whether we connected before, and the subscription that tells
+		# whether the broker kept our retained values after a reconnect
+		self._was_connected = False
+		self._probe_mid = None
+		self._retained_seen = False
+		# Items published while the probe is out, a set, or None
+		self._probe_sent = None
+		# Services (type/instance) whose alias dictionary must be published
+		# before the next run of the queue
+		self._alias_pending = set()
+		# Retained alias dictionaries seen while services were still being
+		# scanned, checked once they are
+		self._alias_topics = set()
+		GLib.timeout_add(10000, self._expire_stale_topics)
+
+		if init_broker:
+			self._registrator = MosquittoBridgeRegistrator(self._system_id)
+			self._registrator.register()
+		else:
+			self._registrator = None
+
+		MqttGObjectBridge.__init__(self, mqtt_server, client_id, ca_cert, user, passwd, debug,
+			clean_session=not persistent_session, stats=Stats(), write_watch=write_watch, port=port)
+
+	def publish(self, item, lane=LANE_CHANGE):
+		""" Publish to mqtt IF keepalive permits. Publish only topics that are currently alive. """
+		queued = self._dirty.get(item)
+		if queued is not None:
+			# Already queued, the value is taken from the item when it is sent
+			self._stats.incr('queue/coalesced')
+			if lane < queued:
+				# Move up to the higher lane
+				self._dirty[item] = lane
+				self.queue.put(item.fulltopic, item, lane)
+			return
+		sent = self._sent.get(item)
+		if sent is not None and sent is item.payload:
+			# The broker has this value already
+			return
+		if item not in self._subscriptions.published:
+			started = monotonic()
+			topic = self._subscriptions.cover(item)
+			self._stats.observe('subscriptions/match', monotonic() - started)
+			if topic is None:
+				return
+		self._dirty[item] = lane
+		self._stats.incr('queue/queued')
+		self.queue.put(item.fulltopic, item, lane)
+		if self._queue_source is None:
+			self._schedule_queue()
+
+	def _publish(self, topic, value):
+		# Put it into the queue
+		self.queue.put(topic, value)
+		self._schedule_queue()
+
+	def unpublish(self, item):
+		# Put it into the queue
+		self._subscriptions.uncover(item)
+		self._dirty.pop(item, None)
+		self._sent.pop(item, None)
+		self.queue.put(item.fulltopic, None)
+		self._schedule_queue()
+
+	def forget(self, item):
+		""" Drop an item that is no longer published, without clearing it
+		    on the broker. """
+		self._subscriptions.uncover(item)
+		self._dirty.pop(item, None)
+		self._sent.pop(item, None)
+
+	def value_set(self, item):
+		""" The value of an item changed without being published, eg. by
+		    a read. Nothing to do, the queue takes values from the item. """
+		pass
+
+	def publish_all(self):
+		for item in sorted(self._ingest._items.values(), key=attrgetter('fulltopic')):
+			self.publish(item, LANE_BULK)
+
+	def publish_write(self, item):
+		# Send the written item ahead of everything else
+		if item is not None and item in self._subscriptions.published:
+			self._dirty[item] = LANE_WRITE
+			self.queue.put(item.fulltopic, item, LANE_WRITE)
+		# Run the queue as soon as possible
+		self._schedule_queue()
+
+	def reply(self, topic, payload):
+		self.queue.put(topic, payload, LANE_REPLY)
+		self._schedule_queue()
+
+	def __publish(self, *args, **kwargs):
+		# This method wraps the actual publishing to the broker and
+		# checks for a network error. If there is an error, it will
+		# reconnect the client, and try once more. The idea is
+		# to guard against the socketpair in paho getting into a bad
+		# state resulting in nothing working properly after that.
+		try:
+			return self._client.publish(*args, **kwargs)
+		except ConnectionError as e:
+			self._stats.incr('mqtt/reconnects')
+			self._client.reconnect()
+			try:
+				return self._client.publish(*args, **kwargs)
+			except:
+				raise e
+
+
+	def _expire_stale_topics(self):
+		try:
+			started = monotonic()
+			for option in self._keepalive_options.expire():
+				self._keepalive_option_expired(option)
+			for item in self._subscriptions.cleanup({self._system_id_topic}):
+				logging.debug("Expiring topic %s", item.shorttopic)
+				self.unpublish(item)
+			self._stats.observe('subscriptions/cleanup', monotonic() - started)
+			self._ingest._drop_unsubscribed_services()
+		finally:
+			return True
+
+	def collect_stats(self, reset=False):
+		""" Counters and timings of this output, and the current size of
+		    things. """
+		stats = self._stats.snapshot(reset)
+		stats['queue/depth'] = len(self.queue)
+		stats['queue/age'] = 0 if self._queue_since is None else round(monotonic() - self._queue_since, 3)
+		stats['subscriptions'] = len(self._subscriptions.topics) + (self._subscriptions.wildcard is not None)
+		if self._spill is not None:
+			stats['buffer/spilled'] = len(self._spill)
+		return stats
+
+	def publish_stats(self, stats):
+		for name, value in sorted(stats.items()):
+			self.queue.put('N/{}/$stats/{}'.format(self._system_id, name), json.dumps(dict(value=value)),
+				LANE_REPLY)
+		self._schedule_queue()
+
+	def _on_connect(self, client, userdata, dict, rc):
+		MqttGObjectBridge._on_connect(self, client, userdata, dict, rc)
+		logging.info('[Connected] {}: result code {}'.format(self.name, rc))
+		self._client.subscribe('R/{}/#'.format(self._system_id), 0)
+		self._client.subscribe('W/{}/#'.format(self._system_id), 0)
+		if self._registrator is not None and self._registrator.client_id is not None:
+			self._client.subscribe('$SYS/broker/connection/{}/state'.format(self._registrator.client_id), 0)
+
+		# Indicate that the new keepalive mechanism is supported
+		self._publish('N/{}/keepalive'.format(self._system_id), 1)
+
+		# Publish serial number once. It never changes, and it is retained in
+		# the broker. Lower down we take care not to unpublish it (should
+		# systemcalc be restarted).
+		self._publish(self._system_id_topic, self._system_id)
+
+		# Messages that did not fit in the queue while disconnected
+		if self._spill is not None:
+			for topic, value in self._spill.pop_all():
+				self.queue.put(topic, value)
+			self._schedule_queue()
+
+		# Send all values at once, because values may have changed when we were disconnected.
+		# Values the broker has already are skipped.
+		if dict.get('session present') or not self._was_connected:
+			self.publish_all()
+		else:
+			self._probe_retained()
+		self._was_connected = True
+
+	def _probe_retained(self):
+		""" Find out whether the broker still has our retained values, by
+		    subscribing to the serial number, which is always retained,
+		    followed by a second subscription. The broker handles them in
+		    order, so if the retained serial number did not come in when the
+		    second one is acknowledged, the broker has lost our values. """
+		self._retained_seen = False
+		self._probe_sent = set()
+		self._client.subscribe(self._system_id_topic, 0)
+		_, self._probe_mid = self._client.subscribe('N/{}/$probe'.format(self._system_id), 0)
+
+	def _on_subscribe(self, client, userdata, mid, granted_qos):
+		MqttGObjectBridge._on_subscribe(self, client, userdata, mid, granted_qos)
+		if mid != self._probe_mid:
+			return
+		self._probe_mid = None
+		self._client.unsubscribe(self._system_id_topic)
+		self._client.unsubscribe('N/{}/$probe'.format(self._system_id))
+		if not self._retained_seen:
+			logging.info('[Connected] {}: broker lost the retained values, publishing everything'.format(
+				self.name))
+			# Except what was published since the reconnect
+			confirmed = self._probe_sent
+			self._sent = {item: payload for item, payload in self._sent.items() if item in confirmed}
+		self._probe_sent = None
+		self.publish_all()
+
+	def _on_message(self, client, userdata, msg):
+		MqttGObjectBridge._on_message(self, client, userdata, msg)
+		if msg.topic == self._system_id_topic:
+			# Only the retained serial number is of interest, it answers
+			# _probe_retained.
+			if msg.retain:
+				self._retained_seen = True
+			return
+		if msg.topic.startswith('N/'):
+			if msg.retain:
+				if self._ingest._scanning():
+					# Services not scanned yet would be taken for gone
+					self._alias_topics.add(msg.topic)
+				else:
+					self._clear_stale_aliases(msg.topic)
+			return
+		if msg.topic.startswith('$SYS/broker/connection/'):
+			if int(msg.payload) == 1:
+				logging.info('[Message] Connected to cloud broker')
+				self._connected_to_cloud = True
+			elif self._connected_to_cloud:
+				# As long as we have connection with the cloud server, we do not have to worry about
+				# authentication. After connection loss, we have to authenticate again, which is a nice
+				# moment to initialize the broker again in case our remote_password has been reset on the
+				# server, or if someone has unlinks VRM page.
+				logging.error('[Message] Lost connection with cloud broker')
+				self._connected_to_cloud = False
+				self._registrator.register()
+			return
+		ingest = self._ingest
+		if ingest._trace is not None:
+			ingest._trace.request(msg.topic, msg.payload)
+		try:
+			logging.debug('[Request] {}: {}'.format(msg.topic, str(msg.payload)))
+			action, system_id, path = msg.topic.split('/', 2)
+			if system_id != self._system_id:
+				raise Exception('Unknown system id')
+			topic = 'N/{}/{}'.format(system_id, path)
+			if action == 'R' and path == 'system/0/Serial':
+				self._handle_serial_read(topic, msg.payload)
+				ingest._scan_subscribed_services()
+			elif action == 'R' and path == 'keepalive':
+				self._handle_keepalive(msg.payload)
+				ingest._scan_subscribed_services()
+			else:
+				ingest._handle_request(self, action, topic, msg.payload)
+		except:
+			logging.error('[Request] Error in request: {} {}'.format(msg.topic, msg.payload))
+			traceback.print_exc()
+
+	def _handle_serial_read(self, topic, payload):
+		""" Currently a request for /Serial is considered a subscription for
+		    backwards compatibility. """
+		self._publish(topic, self._system_id)
+		if self._subscriptions.subscribe_all(self._keep_alive_interval) is not None:
+			self.publish_all()
+
+	def _handle_keepalive(self, payload):
+		""" The payload is empty, to keep everything alive, or a list of
+		    topic filters. It can also be an object such as
+		    {"topics": [...], "keepalive-options": ["batch"]}, which keeps
+		    everything alive if topics is left out. Options:
+
+		    batch: besides the usual topics, publish each run of the queue as
+		        one message per service on B/<portal id>/<type>/<instance>,
+		        containing an object of path to value.
+		    cbor: besides the usual topics, publish each value as CBOR on
+		        C/<portal id>/<type>/<instance>/<path>, also retained, and
+		        cleared again once the option expires.
+		    alias: besides the usual topics, publish each value on
+		        A/<portal id>/<alias>, not retained. The retained
+		        N/<portal id>/$aliases/<type>/<instance> maps the aliases
+		        of a service to their paths. """
+		if payload:
+			topics = json.loads(payload)
+			if isinstance(topics, dict):
+				for option in self._keepalive_options.refresh(
+						topics.get('keepalive-options', ()), self._keep_alive_interval):
+					self._keepalive_option_added(option)
+				topics = topics.get('topics')
+				if topics is None:
+					self._handle_keepalive(None)
+					return
+			published = self._subscriptions.published
+			for topic in topics:
+				ob = self._subscriptions.subscribe(topic, self._keep_alive_interval)
+				# Publish only those that are directly matched by the newly
+				# added match. If we end up with overlap, it is no biggie. It
+				# is queued and rate-limited anyway.
+				if ob is not None:
+					for item in self._ingest._items.values():
+						if item not in published and ob.match(item.shorttopic):
+							self._subscriptions.cover(item, ob)
+							self.publish(item)
+		else:
+			if self._subscriptions.subscribe_all(self._keep_alive_interval) is not None:
+				self.publish_all()
+
+	def _keepalive_option_added(self, option):
+		# Give the new client a full picture
+		if option == 'batch':
+			self._publish_batches((item.fulltopic, item.value) for item in self._subscriptions.published)
+		elif option == 'cbor':
+			for item in self._subscriptions.published:
+				self._publish_cbor(item.fulltopic, item.encode_cbor(), True)
+		elif option == 'alias':
+			self._alias_pending.clear()
+			self._publish_aliases(None)
+			# Retained dictionaries of a previous run come back here, see
+			# _on_message
+			self._client.subscribe('N/{}/$aliases/#'.format(self._system_id), 0)
+			for item in self._subscriptions.published:
+				self._publish_alias(item.alias, item.encode())
+
+	def _keepalive_option_expired(self, option):
+		# Nobody keeps the retained CBOR topics up to date anymore
+		if option == 'cbor':
+			for item in self._subscriptions.published:
+				self._publish_cbor(item.fulltopic, None, True)
+
+	def items_changed(self, service):
+		""" Called when items of a service (type/instance) were added or
+		    removed. """
+		if 'alias' in self._keepalive_options:
+			self._alias_pending.add(service)
+			self._schedule_queue()
+
+	def scan_done(self):
+		""" Called when no services are being scanned anymore. """
+		topics, self._alias_topics = self._alias_topics, set()
+		for topic in topics:
+			self._clear_stale_aliases(topic)
+
+	def _clear_stale_aliases(self, topic):
+		""" Clear the retained alias dictionary of a service that is gone,
+		    its aliases may be in use by another one now. """
+		if topic.split('/', 3)[3] not in self._ingest._services:
+			self._publish(topic, None)
+
+	def _publish_aliases(self, services):
+		""" Publish the alias dictionaries of services, or of all services
+		    if None. That of a service without items is cleared. """
+		ingest = self._ingest
+		if services is None:
+			services = [info.short_name for info in ingest._service_info.values() if info.items]
+		for service in services:
+			info = ingest._service_info.get(ingest._services.get(service))
+			try:
+				self.__publish('N/{}/$aliases/{}'.format(self._system_id, service),
+					alias_dictionary(info.items) if info is not None and info.items else None, retain=True)
+			except:
+				self._stats.incr('publish/errors')
+				logging.error('[Queue] Error publishing the aliases of {}'.format(service))
+				traceback.print_exc()
+
+	def _publish_alias(self, alias, payload):
+		try:
+			self.__publish('A/{}/{}'.format(self._system_id, alias), payload, retain=False)
+		except:
+			self._stats.incr('publish/errors')
+			logging.error('[Queue] Error publishing alias {}'.format(alias))
+			traceback.print_exc()
+		else:
+			self._stats.incr('publish/aliases')
+
+	def _publish_cbor(self, topic, payload, retain):
+		try:
+			self.__publish('C' + topic[1:], payload, retain=retain)
+		except:
+			self._stats.incr('publish/errors')
+			logging.error('[Queue] Error publishing: {}'.format(topic))
+			traceback.print_exc()
+		else:
+			self._stats.incr('publish/cbor')
+
+	def _publish_batches(self, changes):
+		for topic, payload in batch_payloads(self._system_id, changes):
+			try:
+				self.__publish(topic, payload, retain=False)
+			except:
+				self._stats.incr('publish/errors')
+				logging.error('[Queue] Error publishing: {}'.format(topic))
+				traceback.print_exc()
+			else:
+				self._stats.incr('publish/batches')
+
+	def _schedule_queue(self, delay=0):
+		if self._queue_since is None:
+			self._queue_since = monotonic()
+		if self._max_queue and self._socket_watch is None and len(self.queue) > self._max_queue:
+			self._trim_queue()
+		if self._queue_source is None:
+			if delay > 0:
+				self._queue_source = GLib.timeout_add(int(delay * 1000) + 1, self._on_queue_source)
+			else:
+				self._queue_source = GLib.idle_add(self._on_queue_source)
+
+	def _trim_queue(self):
+		""" Keep the queue within max_queue while disconnected. Items go
+		    first, because the reconnect sends all values that changed
+		    anyway. Then replies, which are stale by then, and the other
+		    values, the keepalive and serial that the reconnect publishes
+		    again. Removals are never dropped, the broker would keep the
+		    retained value. They go to the spill file, to be published
+		    after the reconnect, or without one they stay in the queue,
+		    beyond max_queue. """
+		queue = self.queue
+		deferred = 0
+		for lane in queue.lanes[LANE_WRITE:]:
+			for topic in [t for t, v in lane.items() if isinstance(v, Item)]:
+				self._dirty.pop(lane.pop(topic), None)
+				deferred += 1
+		self._stats.incr('buffer/deferred', deferred)
+		excess = len(queue) - self._max_queue
+		if excess <= 0:
+			return
+		drops = len(queue.lanes[LANE_REPLY])
+		excess -= drops
+		queue.lanes[LANE_REPLY].clear()
+		for lane in queue.lanes[LANE_WRITE:]:
+			if excess <= 0:
+				break
+			for topic in [t for t, v in lane.items() if v is not None][:excess]:
+				del lane[topic]
+				drops += 1
+				excess -= 1
+		if self._spill is not None:
+			for lane in queue.lanes[LANE_WRITE:]:
+				if excess <= 0:
+					break
+				for topic in list(lane)[:excess]:
+					del lane[topic]
+					# Only lost when the oldest in the file is overwritten
+					drops += self._spill.push(topic, None)
+					excess -= 1
+		self._stats.incr('buffer/drops', drops)
+
+	def _on_queue_source(self):
+		self._queue_source = None
+		if self._service_queue():
+			# Messages left, continue when the rate limits allow it
+			self._schedule_queue(self._rate_limiter.wait())
+		return False
+
+	def _service_queue(self):
+		""" Publish queued messages, as far as the rate limits allow. Returns
+		    True if there are messages left. """
+		# If we are not connected, we cannot service the queue
+		if self._socket_watch is None:
+			return False
+
+		# To remain somewhat responsive, limit the number of items
+		# published and schedule the rest when idle again.
+		started = monotonic()
+		encoding = writing = 0
+		messages = size = 0
+		limiter = self._rate_limiter
+		limiter.refill(len(self.queue))
+		dirty = self._dirty
+		sent_payloads = self._sent
+		probe_sent = self._probe_sent
+		sent = [] if 'batch' in self._keepalive_options else None
+		cbor = 'cbor' in self._keepalive_options
+		aliases = 'alias' in self._keepalive_options
+		if aliases and self._alias_pending:
+			# Aliases must be known before they are used
+			services, self._alias_pending = self._alias_pending, set()
+			self._publish_aliases(services)
+		try:
+			for _ in range(QUEUE_SLICE):
+				if limiter.wait() > 0:
+					return True
+				try:
+					lane, topic, value = self.queue.pop()
+				except KeyError:
+					self._queue_since = None
+					return False
+				t0 = monotonic()
+				item = None
+				cbor_payload = None
+				if lane == LANE_REPLY:
+					# Replies are encoded already
+					payload = value
+				else:
+					if isinstance(value, Item):
+						item = value
+						dirty.pop(item, None)
+						value = item.value
+						payload = item.encode()
+					else:
+						payload = None if value is None else encode_json(value)
+					if sent is not None:
+						sent.append((topic, value))
+					if cbor and value is not None:
+						cbor_payload = encode_cbor(value) if item is None else item.encode_cbor()
+				t1 = monotonic()
+				try:
+					self.__publish(topic, payload, retain=lane != LANE_REPLY)
+				except:
+					self._stats.incr('publish/errors')
+					logging.error('[Queue] Error publishing: {} {}'.format(topic, value))
+					traceback.print_exc()
+				else:
+					if item is not None:
+						sent_payloads[item] = payload
+						if probe_sent is not None:
+							probe_sent.add(item)
+				if cbor and lane != LANE_REPLY:
+					self._publish_cbor(topic, cbor_payload, True)
+				if aliases and item is not None:
+					self._publish_alias(item.alias, payload)
+				writing += monotonic() - t1
+				encoding += t1 - t0
+				n = len(topic) + (0 if payload is None else len(payload))
+				messages += 1
+				size += n
+				limiter.consume(n)
+
+			return True
+		finally:
+			if sent:
+				self._publish_batches(sent)
+			self._flush()
+			stats = self._stats
+			stats.incr('publish/messages', messages)
+			stats.incr('publish/bytes', size)
+			if messages:
+				stats.observe('queue/encode', encoding)
+				stats.observe('queue/publish', writing)
+			stats.observe('queue/run', monotonic() - started)
+
+class RingRequester(object):
+	""" Where a request came from in two-process mode: an output of the
+	    egress process. Replies go back to it. """
+	__slots__ = ('ring', 'index')
+
+	def __init__(self, ring, index):
+		self.ring = ring
+		self.index = index
+
+	def __eq__(self, other):
+		return isinstance(other, RingRequester) and self.ring is other.ring and self.index == other.index
+
+	def __hash__(self):
+		return hash((id(self.ring), self.index))
+
+	def reply(self, topic, payload):
+		self.ring.send_reply(self.index, topic, payload)
+
+class RingOutput(object):
+	""" Takes the place of the outputs in the ingest process of the
+	    two-process mode. What would be published goes into the changes
+	    ring as records, for Egress. Items are sent once, after that
+	    records refer to them by alias. Requests come back over the
+	    requests ring. """
+	name = 'ring'
+
+	def __init__(self, ingest, changes, requests):
+		self._ingest = ingest
+		self._changes = changes
+		self._requests = requests
+		self._stats = Stats()
+		# Items the egress process knows, and per service (type/instance)
+		self._known = set()
+		self._known_services = {}
+		# Services whose items changed since the last commit
+		self._pending = set()
+		# Items whose value changed since the last commit, coalesced as in
+		# the queue of MqttOutput. Key: Item, value: lane.
+		self._dirty = {}
+		# Items whose value changed without being published
+		self._set = set()
+		# Whether the scan finished since the last commit
+		self._scan_done = False
+		self._commit_source = None
+		GLib.io_add_watch(changes.fileno(), GLib.IO_IN | GLib.IO_HUP, self._on_room)
+		GLib.io_add_watch(requests.fileno(), GLib.IO_IN | GLib.IO_HUP, self._on_requests)
+		# Hand over the items that were scanned before we were created
+		self._pending.update(ingest._services)
+		self._sync_services()
+		self.publish_all()
+		if not ingest._scanning():
+			self.scan_done()
+
+	def _put(self, record):
+		try:
+			if not self._changes.put(record):
+				self._stats.incr('ring/overflow')
+		except ValueError as e:
+			logging.error('[Ring] {}, dropped'.format(e))
+			self._stats.incr('ring/oversized')
+			return
+		self._stats.incr('ring/records')
+		if self._commit_source is None:
+			self._commit_source = GLib.idle_add(self._commit)
+
+	def _with_value(self, record, item):
+		""" Record followed by the value of item. A value that makes the
+		    record too big for the ring goes as invalid, so that the egress
+		    process still learns about the item. """
+		data = encode_cbor(item.value)
+		if len(record) + len(data) > self._changes.max_record:
+			logging.error('[Ring] Value of {} does not fit in the ring, sent as invalid'.format(item.fulltopic))
+			self._stats.incr('ring/oversized')
+			data = CBOR_UNDEFINED
+		return record + data
+
+	def _know(self, item):
+		""" Make sure the egress process has the item. """
+		if item in self._known:
+			return
+		self._known.add(item)
+		service = '/'.join(item.shorttopic[:2])
+		self._known_services.setdefault(service, set()).add(item)
+		topic = item.fulltopic.encode('utf-8')
+		self._put(self._with_value(_ring_item.pack(RECORD_ITEM, item.alias, len(topic)) + topic, item))
+
+	def _drop(self, item):
+		self._dirty.pop(item, None)
+		self._known.discard(item)
+		self._put(_ring_alias.pack(RECORD_DROP, item.alias))
+
+	def publish(self, item, lane=LANE_CHANGE):
+		dirty = self._dirty
+		if item in dirty:
+			self._stats.incr('ring/coalesced')
+			if lane < dirty[item]:
+				dirty[item] = lane
+			return
+		dirty[item] = lane
+		if self._commit_source is None:
+			self._commit_source = GLib.idle_add(self._commit)
+
+	def _put_value(self, item, lane):
+		self._know(item)
+		self._put(self._with_value(_ring_value.pack(RECORD_VALUE, item.alias, lane), item))
+
+	def _put_values(self):
+		dirty, self._dirty = self._dirty, {}
+		for item, lane in dirty.items():
+			self._put_value(item, lane)
+		changed, self._set = self._set, set()
+		for item in changed:
+			# Items sent later come with their value
+			if item in self._known and item not in dirty:
+				self._put(self._with_value(_ring_alias.pack(RECORD_SET, item.alias), item))
+
+	def value_set(self, item):
+		self._set.add(item)
+		if self._commit_source is None:
+			self._commit_source = GLib.idle_add(self._commit)
+
+	def unpublish(self, item):
+		self._dirty.pop(item, None)
+		if item in self._known:
+			self._put(_ring_alias.pack(RECORD_UNPUBLISH, item.alias))
+		else:
+			self._put(_ring_header.pack(RECORD_CLEAR) + item.fulltopic.encode('utf-8'))
+
+	def forget(self, item):
+		self._dirty.pop(item, None)
+		if item in self._known:
+			self._known_services['/'.join(item.shorttopic[:2])].discard(item)
+			self._drop(item)
+
+	def publish_all(self):
+		self._put(_ring_header.pack(RECORD_PUBLISH_ALL))
+
+	def publish_write(self, item):
+		if item is not None:
+			# The egress process publishes the value it has
+			lane = self._dirty.pop(item, None)
+			if lane is not None:
+				self._put_value(item, lane)
+			self._know(item)
+			self._put(_ring_alias.pack(RECORD_WRITE, item.alias))
+
+	def send_reply(self, index, topic, payload):
+		# The payload is None for an invalid value, a JSON payload is never
+		# empty
+		topic = topic.encode('utf-8')
+		self._put(_ring_request.pack(RECORD_REPLY, index, len(topic)) + topic +
+			(b'' if payload is None else payload.encode('utf-8')))
+
+	def items_changed(self, service):
+		self._pending.add(service)
+		if self._commit_source is None:
+			self._commit_source = GLib.idle_add(self._commit)
+
+	def scan_done(self):
+		# Sent after the items, see _commit
+		self._scan_done = True
+		if self._commit_source is None:
+			self._commit_source = GLib.idle_add(self._commit)
+
+	def collect_stats(self, reset=False):
+		stats = self._stats.snapshot(reset)
+		stats['ring/kept'] = self._changes.overflow
+		return stats
+
+	def publish_stats(self, stats):
+		self._put(_ring_header.pack(RECORD_STATS) + json.dumps(stats).encode('utf-8'))
+
+	def _sync_services(self):
+		""" Send the items that were added to a service, and drop those
+		    that were removed. """
+		ingest = self._ingest
+		pending, self._pending = self._pending, set()
+		for service in pending:
+			info = ingest._service_info.get(ingest._services.get(service))
+			items = set() if info is None else info.items
+			known = self._known_services.get(service, set())
+			for item in known - items:
+				self._drop(item)
+			for item in items - known:
+				self._know(item)
+			if info is None:
+				self._known_services.pop(service, None)
+			else:
+				self._known_services[service] = set(items)
+
+	def _commit(self):
+		self._commit_source = None
+		self._put_values()
+		self._sync_services()
+		if self._scan_done:
+			self._scan_done = False
+			self._put(_ring_header.pack(RECORD_SCANNED))
+		try:
+			self._changes.commit()
+		except EOFError:
+			logging.error('[Ring] The egress process is gone')
+		return False
+
+	def _on_room(self, fd, condition):
+		""" The egress process read records, kept ones may fit now. """
+		try:
+			self._changes.commit()
+		except EOFError:
+			logging.error('[Ring] The egress process is gone')
+			return False
+		return True
+
+	def _on_requests(self, fd, condition):
+		try:
+			records = self._requests.read()
+		except EOFError:
+			logging.error('[Ring] The egress process is gone')
+			return False
+		for record in records:
+			_, index, size = _ring_request.unpack_from(record)
+			start = _ring_request.size
+			topic = record[start:start + size].decode('utf-8')
+			payload = record[start + size:]
+			ingest = self._ingest
+			if ingest._trace is not None:
+				ingest._trace.request(topic, payload)
+			try:
+				ingest._handle_request(RingRequester(self, index), topic[0], 'N' + topic[1:], payload)
+			except:
+				logging.error('[Request] Error in request: {} {}'.format(topic, payload))
+				traceback.print_exc()
+		return True
+
+class Egress(object):
+	""" The MQTT side of the two-process mode. Keeps a copy of the items of
+	    the ingest process, fed by the records of RingOutput, and takes the
+	    place of DbusMqtt for the outputs, which hold the broker
+	    connections and do the encoding and rate limiting. Requests go
+	    back to the ingest process over the requests ring. Outputs holds
+	    the keyword arguments of each MqttOutput. """
+	def __init__(self, changes, requests, outputs, closed=None):
+		self._system_id = get_vrm_portal_id()
+		self._system_id_topic = 'N/{}/system/0/Serial'.format(self._system_id)
+		# Requests are recorded by the ingest process
+		self._trace = None
+		# Key: alias, value: Item
+		self._items = {}
+		# Key: service_type/device_instance, value: the same. There are no
+		# D-Bus service names here.
+		self._services = {}
+		self._service_info = {}
+		self._changes = changes
+		self._requests = requests
+		# Called when the ingest process is gone
+		self._closed = closed
+		self._commit_source = None
+		# Whether the ingest process finished scanning
+		self._scanned = False
+		self._outputs = [MqttOutput(self, **kwargs) for kwargs in outputs]
+		GLib.io_add_watch(changes.fileno(), GLib.IO_IN | GLib.IO_HUP, self._on_changes)
+		GLib.io_add_watch(requests.fileno(), GLib.IO_IN | GLib.IO_HUP, self._on_room)
+
+	def _handle_request(self, output, action, topic, payload):
+		topic = (action + topic[1:]).encode('utf-8')
+		if isinstance(payload, str):
+			payload = payload.encode('utf-8')
+		try:
+			self._requests.put(_ring_request.pack(RECORD_REQUEST, self._outputs.index(output), len(topic)) +
+				topic + payload)
+		except ValueError as e:
+			logging.error('[Ring] {}, request on {} dropped'.format(e, topic.decode('utf-8')))
+			return
+		if self._commit_source is None:
+			self._commit_source = GLib.idle_add(self._commit)
+
+	def _scan_subscribed_services(self):
+		pass
+
+	def _drop_unsubscribed_services(self):
+		pass
+
+	def _scanning(self):
+		return not self._scanned
+
+	def _commit(self):
+		self._commit_source = None
+		self._on_room(None, None)
+		return False
+
+	def _on_room(self, fd, condition):
+		try:
+			self._requests.commit()
+		except EOFError:
+			self._on_closed()
+			return False
+		return True
+
+	def _on_closed(self):
+		logging.error('[Ring] The ingest process is gone')
+		if self._closed is not None:
+			self._closed()
+
+	def _on_changes(self, fd, condition):
+		try:
+			records = self._changes.read()
+		except EOFError:
+			self._on_closed()
+			return False
+		items = self._items
+		outputs = self._outputs
+		for record in records:
+			kind = record[0]
+			if kind == RECORD_VALUE:
+				_, alias, lane = _ring_value.unpack_from(record)
+				item = items[alias]
+				data = record[_ring_value.size:]
+				item.value = _ring_decode(data)
+				item.payload = None
+				item.cbor = data
+				for output in outputs:
+					output.publish(item, lane)
+			elif kind == RECORD_SET:
+				item = items[_ring_alias.unpack_from(record)[1]]
+				data = record[_ring_alias.size:]
+				item.value = _ring_decode(data)
+				item.payload = None
+				item.cbor = data
+			elif kind == RECORD_ITEM:
+				_, alias, size = _ring_item.unpack_from(record)
+				start = _ring_item.size
+				self._add_item(alias, record[start:start + size].decode('utf-8'),
+					_ring_decode(record[start + size:]))
+			elif kind == RECORD_UNPUBLISH:
+				item = items[_ring_alias.unpack_from(record)[1]]
+				for output in outputs:
+					output.unpublish(item)
+			elif kind == RECORD_DROP:
+				self._remove_item(items.pop(_ring_alias.unpack_from(record)[1]))
+			elif kind == RECORD_WRITE:
+				item = items[_ring_alias.unpack_from(record)[1]]
+				for output in outputs:
+					output.publish_write(item)
+			elif kind == RECORD_REPLY:
+				_, index, size = _ring_request.unpack_from(record)
+				start = _ring_request.size
+				payload = record[start + size:]
+				outputs[index].reply(record[start:start + size].decode('utf-8'),
+					payload.decode('utf-8') if payload else None)
+			elif kind == RECORD_CLEAR:
+				topic = record[_ring_header.size:].decode('utf-8')
+				for output in outputs:
+					output._publish(topic, None)
+			elif kind == RECORD_PUBLISH_ALL:
+				for output in outputs:
+					output.publish_all()
+			elif kind == RECORD_SCANNED:
+				self._scanned = True
+				for output in outputs:
+					output.scan_done()
+			elif kind == RECORD_STATS:
+				self._publish_stats(json.loads(record[_ring_header.size:].decode('utf-8')))
+		return True
+
+	def _add_item(self, alias, topic, value):
+		item = self._items[alias] = Item(None, topic, value, alias)
+		service = '/'.join(item.shorttopic[:2])
+		info = self._service_info.get(service)
+		if info is None:
+			info = self._service_info[service] = ServiceInfo(service, int(item.shorttopic[1]), service)
+			self._services[service] = service
+		info.items.add(item)
+		for output in self._outputs:
+			output.items_changed(service)
+
+	def _remove_item(self, item):
+		service = '/'.join(item.shorttopic[:2])
+		info = self._service_info[service]
+		info.items.discard(item)
+		if not info.items:
+			del self._service_info[service]
+			del self._services[service]
+		for output in self._outputs:
+			output.forget(item)
+			output.items_changed(service)
+
+	def _publish_stats(self, stats):
+		""" Those of the ingest process, with the outputs added as in
+		    DbusMqtt._collect_stats. """
+		for i, output in enumerate(self._outputs):
+			prefix = 'output/{}/'.format(output.name) if i else ''
+			for name, value in output.collect_stats(True).items():
+				stats[prefix + name] = value
+		for output in self._outputs:
+			output.publish_stats(stats)
+
+def _ring_decode(data):
+	""" A value of a record. The invalid value comes as undefined. """
+	return VeDbusInvalid if data == CBOR_UNDEFINED else decode_cbor(data)
+
+
+def batch_payloads(system_id, changes):
+	""" Group (topic, value) pairs for N/ topics per service. Returns a list
+	    of (topic, payload), where the payload maps path to value. Removed
+	    topics have a null value, just like invalid values. """
+	batches = OrderedDict()
+	for topic, value in changes:
+		try:
+			_, _, service_type, device_instance, path = topic.split('/', 4)
+		except ValueError:
+			# Not an item, eg. N/<portal id>/keepalive
+			continue
+		key = 'B/{}/{}/{}'.format(system_id, service_type, device_instance)
+		batch = batches.get(key)
+		if batch is None:
+			batch = batches[key] = {}
+		batch['/' + path] = None if value is None else unwrap_dbus_value(value)
+	return [(topic, json.dumps(batch)) for topic, batch in batches.items()]
+
+
+def alias_dictionary(items):
+	""" The JSON object that maps the alias of each item of a service to
+	    its path. """
+	return json.dumps(OrderedDict((str(item.alias), '/' + '/'.join(item.shorttopic[2:]))
+		for item in sorted(items, key=attrgetter('alias'))), separators=(',', ':'))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import dbus
+import json
+import os
+import struct
+import sys
+from json.encoder import encode_basestring_ascii
+
+AppDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, os.path.join(AppDir, 'ext', 'velib_python'))
+from ve_utils import unwrap_dbus_value
+
+_float_repr = float.__repr__
+_int_repr = int.__repr__
+
+
+def _encode_float(value):
+	r = _float_repr(value)
+	if r[-1] in 'nf':
+		# nan and inf, leave those to json
+		return json.dumps(dict(value=float(value)))
+	return '{"value": ' + r + '}'
+
+def _encode_int(value):
+	return '{"value": ' + _int_repr(value) + '}'
+
+def _encode_bool(value):
+	return '{"value": true}' if value else '{"value": false}'
+
+def _encode_str(value):
+	return '{"value": ' + encode_basestring_ascii(value) + '}'
+
+_encoders = {
+	dbus.Double: _encode_float,
+	dbus.Byte: _encode_int,
+	dbus.Int16: _encode_int,
+	dbus.UInt16: _encode_int,
+	dbus.Int32: _encode_int,
+	dbus.UInt32: _encode_int,
+	dbus.Int64: _encode_int,
+	dbus.UInt64: _encode_int,
+	dbus.Boolean: _encode_bool,
+	dbus.String: _encode_str,
+	float: _encode_float,
+	int: _encode_int,
+	bool: _encode_bool,
+	str: _encode_str,
+}
+
+
+def encode_json(value):
+	""" Encode a D-Bus value as a {"value": ...} JSON payload. Gives exactly
+	    the same result as json.dumps(dict(value=unwrap_dbus_value(value))),
+	    but scalars take a shortcut past the type checks in
+	    unwrap_dbus_value and the temporary dict. """
+	encoder = _encoders.get(type(value))
+	if encoder is not None:
+		return encoder(value)
+	if isinstance(value, dbus.Array) and len(value) == 0:
+		# The invalid value (VeDbusInvalid)
+		return '{"value": null}'
+	return json.dumps(dict(value=unwrap_dbus_value(value)))
+
+
+# CBOR (RFC 8949), a binary alternative to the JSON payloads. A payload is
+# the bare value, without the {"value": ...} envelope. The invalid value is
+# encoded as undefined, to tell it apart from null.
+CBOR_FALSE = b'\xf4'
+CBOR_TRUE = b'\xf5'
+CBOR_NULL = b'\xf6'
+CBOR_UNDEFINED = b'\xf7'
+
+_pack_float = struct.Struct('>f').pack
+_pack_double = struct.Struct('>d').pack
+_unpack_float = struct.Struct('>f').unpack_from
+_unpack_double = struct.Struct('>d').unpack_from
+_unpack_half = struct.Struct('>e').unpack_from
+
+
+def _cbor_head(major, n):
+	""" The initial bytes of a data item: major type and argument. """
+	major <<= 5
+	if n < 24:
+		return bytes((major | n,))
+	if n < 0x100:
+		return bytes((major | 24, n))
+	if n < 0x10000:
+		return bytes((major | 25,)) + n.to_bytes(2, 'big')
+	if n < 0x100000000:
+		return bytes((major | 26,)) + n.to_bytes(4, 'big')
+	return bytes((major | 27,)) + n.to_bytes(8, 'big')
+
+def _cbor_float(value):
+	value = float(value)
+	try:
+		single = _pack_float(value)
+	except OverflowError:
+		# Beyond the range of single precision
+		return b'\xfb' + _pack_double(value)
+	if _unpack_float(single)[0] == value or value != value:
+		# No precision lost in single precision
+		return b'\xfa' + single
+	return b'\xfb' + _pack_double(value)
+
+def _cbor_int(value):
+	value = int(value)
+	if value >= 0:
+		return _cbor_head(0, value)
+	return _cbor_head(1, -1 - value)
+
+def _cbor_bool(value):
+	return CBOR_TRUE if value else CBOR_FALSE
+
+def _cbor_str(value):
+	b = value.encode('utf-8')
+	return _cbor_head(3, len(b)) + b
+
+def _cbor_array(value):
+	if len(value) == 0:
+		# The invalid value (VeDbusInvalid)
+		return CBOR_UNDEFINED
+	return _cbor_head(4, len(value)) + b''.join(encode_cbor(v) for v in value)
+
+def _cbor_dict(value):
+	return _cbor_head(5, len(value)) + b''.join(encode_cbor(k) + encode_cbor(v) for k, v in value.items())
+
+_cbor_encoders = {
+	dbus.Double: _cbor_float,
+	dbus.Byte: _cbor_int,
+	dbus.Int16: _cbor_int,
+	dbus.UInt16: _cbor_int,
+	dbus.Int32: _cbor_int,
+	dbus.UInt32: _cbor_int,
+	dbus.Int64: _cbor_int,
+	dbus.UInt64: _cbor_int,
+	dbus.Boolean: _cbor_bool,
+	dbus.String: _cbor_str,
+	dbus.Array: _cbor_array,
+	dbus.Dictionary: _cbor_dict,
+	float: _cbor_float,
+	int: _cbor_int,
+	bool: _cbor_bool,
+	str: _cbor_str,
+	list: _cbor_array,
+	tuple: _cbor_array,
+	dict: _cbor_dict,
+	type(None): lambda value: CBOR_NULL,
+}
+
+
+def encode_cbor(value):
+	""" Encode a D-Bus value, or a plain one, as CBOR. """
+	encoder = _cbor_encoders.get(type(value))
+	if encoder is None:
+		plain = unwrap_dbus_value(value)
+		encoder = _cbor_encoders.get(type(plain))
+		if encoder is None:
+			raise TypeError('Cannot encode {} as CBOR'.format(type(value).__name__))
+		value = plain
+	return encoder(value)
+
+
+def _cbor_argument(data, i):
+	""" Returns (major type, additional info, argument, next index). """
+	b = data[i]
+	major, info = b >> 5, b & 0x1f
+	i += 1
+	if info < 24:
+		return major, info, info, i
+	if info > 27:
+		raise ValueError('Unsupported CBOR item at {}'.format(i - 1))
+	size = 1 << (info - 24)
+	return major, info, int.from_bytes(data[i:i + size], 'big'), i + size
+
+def _decode_cbor(data, i):
+	major, info, n, i = _cbor_argument(data, i)
+	if major == 0:
+		return n, i
+	if major == 1:
+		return -1 - n, i
+	if major == 2:
+		return bytes(data[i:i + n]), i + n
+	if major == 3:
+		return bytes(data[i:i + n]).decode('utf-8'), i + n
+	if major == 4:
+		r = []
+		for _ in range(n):
+			v, i = _decode_cbor(data, i)
+			r.append(v)
+		return r, i
+	if major == 5:
+		r = {}
+		for _ in range(n):
+			k, i = _decode_cbor(data, i)
+			r[k], i = _decode_cbor(data, i)
+		return r, i
+	if major == 6:
+		# Tags are ignored
+		return _decode_cbor(data, i)
+	if info == 20:
+		return False, i
+	if info == 21:
+		return True, i
+	if info in (22, 23):
+		# null and undefined
+		return None, i
+	if info == 25:
+		return _unpack_half(data, i - 2)[0], i
+	if info == 26:
+		return _unpack_float(data, i - 4)[0], i
+	if info == 27:
+		return _unpack_double(data, i - 8)[0], i
+	raise ValueError('Unsupported CBOR item at {}'.format(i - 1))
+
+
+def decode_cbor(data):
+	""" Decode one CBOR data item into plain values. Definite lengths
+	    only. """
+	if isinstance(data, str):
+		data = data.encode('latin-1')
+	value, i = _decode_cbor(data, 0)
+	if i != len(data):
+		raise ValueError('Trailing data after CBOR item')
+	return value
+
+
+def decode_bulk_write(payload):
+	""" The topics and values of a bulk W/ payload: a JSON object such as
+	    {"settings/0/Settings/CGwacs/AcPowerSetPoint": -200}, or the same as
+	    a CBOR map, which starts with major type 5 where JSON cannot. """
+	first = payload[:1]
+	if first and ord(first) & 0xe0 == 0xa0:
+		return decode_cbor(payload)
+	return json.loads(payload)
+
+
+def decode_write(payload):
+	""" The value of a W/ payload: JSON such as {"value": 5}, or the same as
+	    a CBOR map, which starts with 0xa1 where JSON cannot. """
+	if payload[:1] in (b'\xa1', '\xa1'):
+		return decode_cbor(payload)['value']
+	return json.loads(payload)['value']
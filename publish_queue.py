@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import marshal
+import struct
+from collections import OrderedDict
+from time import monotonic
+
+# Lanes of the publish queue, in order of priority
+LANE_REPLY = 0	# Replies to R/ requests, not retained
+LANE_WRITE = 1	# Values that were just written through W/
+LANE_CHANGE = 2	# Value changes seen on D-Bus
+LANE_BULK = 3	# Republishing everything, eg. after (re)connecting
+LANES = 4
+
+
+class PublishQueue(object):
+	""" Messages waiting to be published, in lanes of decreasing priority.
+	    Each lane maps topic to value, so that changes to a topic that is
+	    still waiting coalesce. A retained topic is in one lane at a time,
+	    replies are kept apart because they use the same topics. """
+	def __init__(self):
+		self.lanes = [OrderedDict() for _ in range(LANES)]
+		self._retained = self.lanes[LANE_WRITE:]
+
+	def __len__(self):
+		return sum(len(lane) for lane in self.lanes)
+
+	def __bool__(self):
+		return any(self.lanes)
+
+	def put(self, topic, value, lane=LANE_CHANGE):
+		target = self.lanes[lane]
+		if lane != LANE_REPLY:
+			for l in self._retained:
+				if l and l is not target:
+					l.pop(topic, None)
+		target[topic] = value
+
+	def pop(self):
+		""" Return (lane, topic, value) for the oldest message in the first
+		    lane that is not empty. Raises KeyError if the queue is empty. """
+		for i, lane in enumerate(self.lanes):
+			if lane:
+				topic, value = lane.popitem(last=False)
+				return i, topic, value
+		raise KeyError('pop from an empty queue')
+
+	def clear(self):
+		for lane in self.lanes:
+			lane.clear()
+
+
+class SpillRing(object):
+	""" A ring of fixed size slots in a file, for messages that do not fit
+	    in the queue while the broker is unreachable. When the ring is
+	    full, the oldest message is overwritten. The file is scratch space,
+	    it is not read back after a restart. """
+	SLOT = 256
+	HEADER = struct.Struct('<H')
+
+	def __init__(self, path, size):
+		self.slots = max(1, size // self.SLOT)
+		self._file = open(path, 'w+b')
+		self._head = 0
+		self._count = 0
+
+	def __len__(self):
+		return self._count
+
+	def push(self, topic, value):
+		""" Returns the number of messages lost, which is 1 if this one
+		    does not fit in a slot or the oldest one was overwritten. """
+		try:
+			data = marshal.dumps((topic, value))
+		except ValueError:
+			return 1
+		if len(data) > self.SLOT - self.HEADER.size:
+			return 1
+		lost = 0
+		if self._count == self.slots:
+			self._head = (self._head + 1) % self.slots
+			self._count -= 1
+			lost = 1
+		self._file.seek(((self._head + self._count) % self.slots) * self.SLOT)
+		self._file.write(self.HEADER.pack(len(data)) + data)
+		self._count += 1
+		return lost
+
+	def pop_all(self):
+		""" Return all (topic, value) pairs, oldest first, and empty the
+		    ring. """
+		self._file.flush()
+		r = []
+		for i in range(self._count):
+			self._file.seek(((self._head + i) % self.slots) * self.SLOT)
+			size, = self.HEADER.unpack(self._file.read(self.HEADER.size))
+			r.append(marshal.loads(self._file.read(size)))
+		self._head = self._count = 0
+		return r
+
+
+class TokenBucket(object):
+	""" Allows rate units per second, in bursts of up to one second worth.
+	    Tokens may go negative when a message is larger than what is left,
+	    the debt is paid back before the next message. A rate of 0 means
+	    unlimited. """
+	def __init__(self, rate):
+		self.rate = rate
+		self.tokens = rate
+		self.stamp = monotonic()
+
+	def refill(self, now, factor=1):
+		if self.rate:
+			rate = self.rate * factor
+			self.tokens = min(rate, self.tokens + (now - self.stamp) * rate)
+		self.stamp = now
+
+	def consume(self, n):
+		if self.rate:
+			self.tokens -= n
+
+	def wait(self, need, factor=1):
+		""" Seconds until there are need tokens. """
+		if not self.rate or self.tokens >= need:
+			return 0
+		return (need - self.tokens) / (self.rate * factor)
+
+
+class RateLimiter(object):
+	""" Limits messages and bytes per second. When the backlog is more than
+	    the message rate drains in a second, both rates are raised in
+	    proportion, up to boost times, so that a backlog does not keep
+	    growing on a busy system. """
+	def __init__(self, messages=0, bytes=0, boost=1):
+		self.messages = TokenBucket(messages)
+		self.bytes = TokenBucket(bytes)
+		self.boost = max(1, boost)
+		self.factor = 1
+
+	def refill(self, backlog):
+		now = monotonic()
+		if self.messages.rate:
+			self.factor = min(self.boost, max(1, backlog / self.messages.rate))
+		self.messages.refill(now, self.factor)
+		self.bytes.refill(now, self.factor)
+
+	def consume(self, size):
+		self.messages.consume(1)
+		self.bytes.consume(size)
+
+	def wait(self):
+		""" Seconds until the next message may be sent. """
+		return max(self.messages.wait(1, self.factor), self.bytes.wait(0, self.factor))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import re
+
+# Held back values are flushed after this long when a rule has a deadband
+# but no max-interval, so retained values never stay stale.
+DEFAULT_MAX_INTERVAL = 60
+
+
+def glob_regex(pattern, level=False):
+	""" A regular expression for a glob pattern with * and ?. They match
+	    '/' as well, unless the pattern is for a single level. """
+	any_char = '[^/]' if level else '.'
+	return ''.join(any_char + '*' if c == '*' else any_char if c == '?' else re.escape(c) for c in pattern)
+
+
+class FilterRule(object):
+	""" Limits how often a value is published. Values that did not move by
+	    more than the deadband, or come within min_interval of the previous
+	    one, are held back. The latest value is always published once
+	    min_interval, or max_interval for a deadband, has passed. """
+	__slots__ = ('service', 'path', 'deadband', 'relative', 'min_interval', 'max_interval')
+
+	def __init__(self, service='*', path='*', deadband=None, relative_deadband=None,
+			min_interval=0, max_interval=None):
+		self.service = re.compile(glob_regex(service, True) + r'\Z')
+		self.path = re.compile('(?s)' + glob_regex(path) + r'\Z')
+		self.deadband = deadband
+		self.relative = relative_deadband
+		self.min_interval = min_interval
+		if max_interval is None and (deadband is not None or relative_deadband is not None):
+			max_interval = DEFAULT_MAX_INTERVAL
+		self.max_interval = max_interval
+
+	def matches(self, service_type, path):
+		return self.service.match(service_type) is not None and self.path.match(path) is not None
+
+	def within_deadband(self, last, value):
+		if not isinstance(value, (int, float)) or not isinstance(last, (int, float)):
+			return False
+		delta = abs(value - last)
+		if self.deadband is not None and delta <= self.deadband:
+			return True
+		return self.relative is not None and delta <= self.relative * abs(last)
+
+
+class FilterState(object):
+	""" What was last published for an item with a FilterRule. Due is when
+	    a held back value must be published, or None. """
+	__slots__ = ('rule', 'value', 'time', 'due')
+
+	def __init__(self, rule):
+		self.rule = rule
+		self.value = None
+		self.time = None
+		self.due = None
+
+	def accept(self, value, now):
+		""" Returns True if value should be published now. Otherwise it is
+		    dropped (unchanged) or held back until due. """
+		if self.time is None:
+			return self.sent(value, now)
+		if type(value) is type(self.value) and value == self.value:
+			self.due = None
+			return False
+		rule = self.rule
+		elapsed = now - self.time
+		if elapsed < rule.min_interval:
+			self.due = self.time + rule.min_interval
+			return False
+		if rule.within_deadband(self.value, value) and \
+				(rule.max_interval is None or elapsed < rule.max_interval):
+			self.due = None if rule.max_interval is None else self.time + rule.max_interval
+			return False
+		return self.sent(value, now)
+
+	def sent(self, value, now):
+		self.value = value
+		self.time = now
+		self.due = None
+		return True
+
+
+class FilterRules(object):
+	""" Filter rules from a JSON file holding a list of objects such as
+	    {"service": "vebus", "path": "/Ac/Out/*/P", "deadband": 5,
+	    "min-interval": 1, "max-interval": 60}. Service and path are glob
+	    patterns on the service type and D-Bus path, "relative-deadband" is
+	    a fraction of the last value. The first matching rule applies. """
+	def __init__(self, rules=()):
+		self.rules = list(rules)
+
+	@classmethod
+	def load(cls, path):
+		with open(path) as f:
+			config = json.load(f)
+		return cls(FilterRule(
+			service=r.get('service', '*'),
+			path=r.get('path', '*'),
+			deadband=r.get('deadband'),
+			relative_deadband=r.get('relative-deadband'),
+			min_interval=r.get('min-interval', 0),
+			max_interval=r.get('max-interval')) for r in config)
+
+	def __bool__(self):
+		return bool(self.rules)
+
+	def state_for(self, service_type, path):
+		""" Returns a FilterState for a new item, or None if no rule
+		    applies. """
+		for rule in self.rules:
+			if rule.matches(service_type, path):
+				return FilterState(rule)
+		return None
+
+
+class PathPatterns(object):
+	""" A set of (service type, path) glob patterns, such as ('vebus',
+	    '/Hub4/L*/AcPowerSetpoint'), compiled into one regular
+	    expression. """
+	def __init__(self, patterns):
+		self._regex = re.compile('(?s)(?:{})\\Z'.format('|'.join(
+			'{}(?=/){}'.format(glob_regex(service, True), glob_regex(path)) for service, path in patterns)))
+
+	def matches(self, service_type, path):
+		return self._regex.match(service_type + path) is not None
+
+
+class ItemRule(object):
+	""" Includes or excludes the items of services of a type and device
+	    instance, with a path. All three are glob patterns. """
+	__slots__ = ('include', 'service', 'instance', 'path')
+
+	def __init__(self, include, service='*', instance='*', path='*'):
+		self.include = include
+		self.service = service
+		self.instance = str(instance)
+		self.path = path
+
+	def regex(self):
+		""" Matches service type/device instance/path, eg. vebus/276/Mode. """
+		return '{}/{}(?=/){}'.format(glob_regex(self.service, True), glob_regex(self.instance, True),
+			glob_regex(self.path))
+
+	def matches_service(self, service_type, device_instance):
+		return re.match(glob_regex(self.service, True) + r'\Z', service_type) is not None and \
+			re.match(glob_regex(self.instance, True) + r'\Z', str(device_instance)) is not None
+
+
+class ItemRules(object):
+	""" Item rules from a JSON file holding a list of objects such as
+	    {"action": "exclude", "service": "vebus", "instance": 276, "path":
+	    "/Devices/*"}. Service and path are glob patterns on the service type
+	    and D-Bus path, instance is a device instance or a glob pattern;
+	    left out, they match anything. The first matching rule applies,
+	    items that match no rule are included. The rules are compiled into
+	    one regular expression, with a named group per rule. """
+	def __init__(self, rules=()):
+		self.rules = list(rules)
+		if self.rules:
+			self._regex = re.compile('(?s)(?:{})\\Z'.format('|'.join(
+				'(?P<r{}>{})'.format(i, r.regex()) for i, r in enumerate(self.rules))))
+		else:
+			self._regex = None
+
+	@classmethod
+	def load(cls, path):
+		with open(path) as f:
+			config = json.load(f)
+		rules = []
+		for r in config:
+			action = r.get('action', 'exclude')
+			if action not in ('include', 'exclude'):
+				raise ValueError('Unknown action: {}'.format(action))
+			rules.append(ItemRule(action == 'include',
+				service=r.get('service', '*'),
+				instance=r.get('instance', '*'),
+				path=r.get('path', '*')))
+		return cls(rules)
+
+	def __bool__(self):
+		return bool(self.rules)
+
+	def included(self, service_type, device_instance, path):
+		if self._regex is None:
+			return True
+		m = self._regex.match('{}/{}{}'.format(service_type, device_instance, path))
+		return m is None or self.rules[int(m.lastgroup[1:])].include
+
+	def excludes_service(self, service_type, device_instance):
+		""" Returns True if all items of the service are excluded, so that
+		    it need not be scanned at all. Excluding some paths does not
+		    decide that, the first include or whole-service exclude does. """
+		for rule in self.rules:
+			if rule.matches_service(service_type, device_instance):
+				if rule.include:
+					return False
+				if rule.path == '*':
+					return True
+		return False
@@ -0,0 +1,189 @@
+""" A ring of records in shared memory, from one process to another. The
+    records are written into an anonymous shared mmap. Positions go over
+    pipes: the writer sends how far the ring is filled, which also wakes
+    up the reader, and the reader sends back how far it has read, so that
+    the space can be used again. Since every position crosses a pipe, the
+    records are visible to the other side by the time it learns about
+    them, whatever the memory ordering of the CPU.
+
+    Create the Ring before forking, then call writer() in one process and
+    reader() in the other. Both ends are non-blocking, and have a fileno
+    to watch from the main loop. """
+from collections import deque
+import mmap
+import os
+import struct
+
+RING_SIZE = 4 * 1024 * 1024
+# Smallest ring that is accepted. A record can take up to half the ring.
+MIN_RING_SIZE = 64 * 1024
+
+_position = struct.Struct('=Q')
+_length = struct.Struct('=I')
+# Length that tells the reader to continue at the start of the ring
+_WRAP = 0xffffffff
+# Positions read from a pipe at once, a multiple of the size of one
+_PIPE_READ = 8192 * _position.size
+
+def _last_position(fd):
+	""" The last position written to the pipe, None if there is none, or
+	    EOFError if the other end is closed. """
+	try:
+		data = os.read(fd, _PIPE_READ)
+	except BlockingIOError:
+		return None
+	if not data:
+		raise EOFError
+	# Writes of a position are atomic, so data holds whole positions
+	return _position.unpack_from(data, len(data) - _position.size)[0]
+
+def _send_position(fd, position):
+	""" Returns False if the pipe is full. """
+	try:
+		os.write(fd, _position.pack(position))
+	except BlockingIOError:
+		return False
+	except BrokenPipeError:
+		raise EOFError
+	return True
+
+class Ring(object):
+	def __init__(self, size=RING_SIZE):
+		self.size = size
+		self._map = mmap.mmap(-1, size)
+		self._filled = os.pipe()
+		self._read = os.pipe()
+
+	def writer(self):
+		os.close(self._filled[0])
+		os.close(self._read[1])
+		return RingWriter(self._map, self.size, self._filled[1], self._read[0])
+
+	def reader(self):
+		os.close(self._filled[1])
+		os.close(self._read[0])
+		return RingReader(self._map, self.size, self._filled[0], self._read[1])
+
+class RingWriter(object):
+	""" The writing end. Positions count the bytes written since the
+	    start, the offset in the ring is the position modulo its size.
+	    Records that do not fit are kept until the reader made room. """
+	def __init__(self, buf, size, filled, read):
+		for fd in (filled, read):
+			os.set_blocking(fd, False)
+		self._buf = buf
+		self._size = size
+		self._filled = filled
+		self._read = read
+		self.head = 0
+		# How far the reader got, as far as we know
+		self._tail = 0
+		self._committed = 0
+		self._overflow = deque()
+		# Longest record that fits
+		self.max_record = size // 2 - _length.size
+
+	def fileno(self):
+		""" Becomes readable when the reader made room. """
+		return self._read
+
+	@property
+	def overflow(self):
+		return len(self._overflow)
+
+	def append(self, record):
+		""" Add a record to the ring, returns False if there is no room. """
+		n = _length.size + len(record)
+		if len(record) > self.max_record:
+			raise ValueError('Record of {} bytes does not fit in the ring'.format(len(record)))
+		offset = self.head % self._size
+		skip = self._size - offset if offset + n > self._size else 0
+		if self.head + skip + n - self._tail > self._size:
+			self.poll()
+			if self.head + skip + n - self._tail > self._size:
+				return False
+		buf = self._buf
+		if skip:
+			# A gap too small for a length is skipped by the reader as well
+			if skip >= _length.size:
+				_length.pack_into(buf, offset, _WRAP)
+			self.head += skip
+			offset = 0
+		_length.pack_into(buf, offset, len(record))
+		buf[offset + _length.size:offset + n] = record
+		self.head += n
+		return True
+
+	def put(self, record):
+		""" Add a record, or keep it until there is room. Returns False if
+		    it was kept. Raises ValueError for a record that never fits,
+		    before it is kept, so that it cannot hold up the others. """
+		if len(record) > self.max_record:
+			raise ValueError('Record of {} bytes does not fit in the ring'.format(len(record)))
+		if not self._overflow and self.append(record):
+			return True
+		self._overflow.append(record)
+		return False
+
+	def commit(self):
+		""" Let the reader know about the records added so far. Moves kept
+		    records into the ring first, as far as they fit. Returns True
+		    if all records are with the reader, otherwise try again once
+		    fileno is readable. """
+		overflow = self._overflow
+		while overflow and self.append(overflow[0]):
+			overflow.popleft()
+		if self.head != self._committed and _send_position(self._filled, self.head):
+			self._committed = self.head
+		self.poll()
+		return not overflow and self.head == self._committed
+
+	def poll(self):
+		""" Pick up how far the reader got. """
+		position = _last_position(self._read)
+		if position is not None:
+			self._tail = position
+
+class RingReader(object):
+	""" The reading end. """
+	def __init__(self, buf, size, filled, read):
+		for fd in (filled, read):
+			os.set_blocking(fd, False)
+		self._buf = buf
+		self._size = size
+		self._filled = filled
+		self._read = read
+		self.tail = 0
+		self._head = 0
+		self._unacknowledged = False
+
+	def fileno(self):
+		""" Becomes readable when records were committed. """
+		return self._filled
+
+	def read(self):
+		""" Returns the records committed since the last call, as bytes.
+		    Raises EOFError once the writer is gone. """
+		position = _last_position(self._filled)
+		if position is not None:
+			self._head = position
+		buf = self._buf
+		size = self._size
+		tail = self.tail
+		records = []
+		while tail < self._head:
+			offset = tail % size
+			if size - offset < _length.size:
+				tail += size - offset
+				continue
+			n, = _length.unpack_from(buf, offset)
+			if n == _WRAP:
+				tail += size - offset
+				continue
+			start = offset + _length.size
+			records.append(buf[start:start + n])
+			tail += _length.size + n
+		if tail != self.tail or self._unacknowledged:
+			self.tail = tail
+			self._unacknowledged = not _send_position(self._read, tail)
+		return records
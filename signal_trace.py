@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import marshal
+import os
+import struct
+import sys
+from time import time, monotonic
+from gi.repository import GLib
+
+AppDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, os.path.join(AppDir, 'ext', 'velib_python'))
+from ve_utils import wrap_dbus_value, unwrap_dbus_value
+
+# A trace file is MAGIC followed by records. A record is a header with the
+# time, the kind of event and the size of the data, followed by the data
+# in marshal format. Records are only ever appended.
+MAGIC = b'DMQTRACE'
+RECORD = struct.Struct('<dBI')
+
+VALUE = 1	# (service, path, value), a PropertiesChanged
+ITEMS = 2	# (service, {path: value}), an ItemsChanged
+OWNER = 3	# (name, old owner, new owner), a NameOwnerChanged
+REQUEST = 4	# (topic, payload), a message from the broker
+
+# Replaying as fast as possible, deliver this many events per main loop run
+REPLAY_SLICE = 100
+
+
+def plain(value):
+	""" Convert a D-Bus value to built-in types, which marshal can handle.
+	    The invalid value becomes None. """
+	value = unwrap_dbus_value(value)
+	if type(value) is bool or value is None:
+		return value
+	if isinstance(value, int):
+		return int(value)
+	if isinstance(value, float):
+		return float(value)
+	if isinstance(value, str):
+		return str(value)
+	if isinstance(value, dict):
+		return {str(k): plain(v) for k, v in value.items()}
+	if isinstance(value, (list, tuple)):
+		return [plain(v) for v in value]
+	return str(value)
+
+
+class TraceWriter(object):
+	""" Appends events to a trace file. Writes are buffered, so that a
+	    busy system costs little more than a marshal.dumps per event and
+	    the flash sees large writes only. """
+	def __init__(self, path, buffering=65536):
+		self._file = open(path, 'ab', buffering)
+		if self._file.tell() == 0:
+			self._file.write(MAGIC)
+
+	def write(self, kind, data):
+		payload = marshal.dumps(data)
+		self._file.write(RECORD.pack(time(), kind, len(payload)) + payload)
+
+	def value(self, service, path, value):
+		self.write(VALUE, (str(service), str(path), plain(value)))
+
+	def items(self, service, items):
+		self.write(ITEMS, (str(service), {str(path): plain(changes['Value'])
+			for path, changes in items.items() if 'Value' in changes}))
+
+	def owner(self, name, oldowner, newowner):
+		self.write(OWNER, (str(name), str(oldowner), str(newowner)))
+
+	def request(self, topic, payload):
+		self.write(REQUEST, (topic, payload))
+
+	def flush(self):
+		self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+
+def read_trace(path):
+	""" Yields (time, kind, data) for each record in a trace file. A
+	    record that was cut short, by a crash or because the file is still
+	    being written, ends the trace. """
+	with open(path, 'rb') as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise ValueError('Not a trace file: {}'.format(path))
+		while True:
+			header = f.read(RECORD.size)
+			if len(header) < RECORD.size:
+				return
+			t, kind, size = RECORD.unpack(header)
+			data = f.read(size)
+			if len(data) < size:
+				return
+			yield t, kind, marshal.loads(data)
+
+
+def is_trace(path):
+	with open(path, 'rb') as f:
+		return f.read(len(MAGIC)) == MAGIC
+
+
+class Message(object):
+	def __init__(self, topic, payload):
+		self.topic = topic
+		self.payload = payload
+
+
+def feed(bridge, kind, data):
+	""" Deliver one event to a DbusMqtt instance. Value changes bypass the
+	    lookup of the sender, so they apply to services of the same name
+	    on this bus. Requests arrive through the first output. """
+	if kind == VALUE:
+		service, path, value = data
+		bridge._value_changed_inner(service, path, wrap_dbus_value(value))
+	elif kind == ITEMS:
+		service, values = data
+		for path, value in values.items():
+			bridge._value_changed_inner(service, path, wrap_dbus_value(value))
+	elif kind == OWNER:
+		bridge._dbus_name_owner_changed(*data)
+	elif kind == REQUEST:
+		bridge._outputs[0]._on_message(None, None, Message(*data))
+
+
+class TraceReplayer(object):
+	""" Feeds the events of a trace into a DbusMqtt instance from the main
+	    loop, at speed times real time, or as fast as possible if speed is
+	    0. """
+	def __init__(self, bridge, events, speed=1):
+		self._bridge = bridge
+		self._events = iter(events)
+		self._speed = speed
+		self._next = next(self._events, None)
+		self._first = None if self._next is None else self._next[0]
+		self._started = None
+
+	def start(self):
+		logging.info('[Replay] Start')
+		self._started = monotonic()
+		self._schedule()
+
+	def _due(self, t):
+		return self._started + (t - self._first) / self._speed
+
+	def _schedule(self):
+		if self._next is None:
+			logging.info('[Replay] Done in {:.1f} s'.format(monotonic() - self._started))
+		elif self._speed <= 0:
+			GLib.idle_add(self._run)
+		else:
+			delay = self._due(self._next[0]) - monotonic()
+			GLib.timeout_add(max(0, int(delay * 1000)), self._run)
+
+	def _run(self):
+		for _ in range(REPLAY_SLICE):
+			if self._next is None:
+				break
+			t, kind, data = self._next
+			if self._speed > 0 and self._due(t) > monotonic():
+				break
+			try:
+				feed(self._bridge, kind, data)
+			except:
+				logging.exception('[Replay] Error in event: {} {}'.format(kind, data))
+			self._next = next(self._events, None)
+		self._schedule()
+		return False
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Durations up to 2^24 us (about 17 s) get their own bucket
+BUCKETS = 26
+
+
+class Histogram(object):
+	""" Durations in buckets of powers of two microseconds, cheap enough to
+	    add to for every message. Percentiles are the upper bound of their
+	    bucket, so they are accurate to within a factor two. """
+	__slots__ = ('buckets', 'count', 'total', 'max')
+
+	def __init__(self):
+		self.buckets = [0] * BUCKETS
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		self.buckets[min(int(seconds * 1000000).bit_length(), BUCKETS - 1)] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def percentile(self, p):
+		""" Returns the p-th percentile in seconds. """
+		if self.count == 0:
+			return 0.0
+		n = self.count * p / 100.0
+		seen = 0
+		for i, c in enumerate(self.buckets):
+			seen += c
+			if seen >= n:
+				return min(self.max, (1 << i) / 1000000.0)
+		return self.max
+
+	def summary(self):
+		""" Count, and mean, percentiles and max in milliseconds. """
+		ms = lambda s: round(s * 1000, 3)
+		return dict(count=self.count,
+			mean=ms(self.total / self.count) if self.count else 0.0,
+			p50=ms(self.percentile(50)),
+			p90=ms(self.percentile(90)),
+			p99=ms(self.percentile(99)),
+			max=ms(self.max))
+
+
+class Stats(object):
+	""" Counters and duration histograms, keyed on names such as
+	    queue/coalesced, which double as topic levels when the stats are
+	    published. """
+	def __init__(self):
+		self.counters = {}
+		self.histograms = {}
+
+	def incr(self, name, n=1):
+		counters = self.counters
+		counters[name] = counters.get(name, 0) + n
+
+	def observe(self, name, seconds):
+		h = self.histograms.get(name)
+		if h is None:
+			h = self.histograms[name] = Histogram()
+		h.add(seconds)
+
+	def snapshot(self, reset=False):
+		""" Returns counters and histogram summaries by name. With reset,
+		    histograms start over, so that they cover one interval, while
+		    counters keep counting. """
+		r = dict(self.counters)
+		for name, h in self.histograms.items():
+			r[name] = h.summary()
+		if reset:
+			self.histograms = {}
+		return r
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+""" Compare per-topic N/ notifications with batched B/ notifications for a
+    full republish: number of messages, bytes on the wire (MQTT 3.1.1
+    PUBLISH at QoS 0, without TLS framing) and values encoded per second. """
+import json
+import os
+import sys
+import timeit
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+import outputs
+
+PORTAL = 'd0ff500097c0'
+
+
+def wire_size(topic, payload):
+	topic = topic.encode('utf-8')
+	payload = b'' if payload is None else payload.encode('utf-8')
+	remaining = 2 + len(topic) + len(payload)
+	header = 2
+	while remaining >= 128 ** (header - 1):
+		header += 1
+	return header + remaining
+
+
+def make_changes(services, paths):
+	changes = []
+	for s in range(services):
+		for p in range(paths):
+			topic = 'N/{}/solarcharger/{}/Pv/{}/V'.format(PORTAL, 256 + s, p)
+			changes.append((topic, dbus.Double(p * 0.37, variant_level=1)))
+	return changes
+
+
+def per_topic(changes):
+	return [(topic, json.dumps(dict(value=dbus_mqtt.unwrap_dbus_value(value)))) for topic, value in changes]
+
+
+def batched(changes):
+	return outputs.batch_payloads(PORTAL, changes)
+
+
+def main():
+	print('{:>8} {:>9} {:>10} {:>12} {:>14}'.format('paths', 'mode', 'messages', 'bytes', 'values/s'))
+	for services, paths in ((10, 50), (40, 500)):
+		changes = make_changes(services, paths)
+		for name, encode in (('per-topic', per_topic), ('batched', batched)):
+			messages = encode(changes)
+			size = sum(wire_size(t, p) for t, p in messages)
+			elapsed = min(timeit.repeat(lambda: encode(changes), number=1, repeat=3))
+			print('{:>8} {:>9} {:>10} {:>12} {:>14.0f}'.format(len(changes), name, len(messages),
+				size, len(changes) / elapsed))
+
+
+if __name__ == '__main__':
+	main()
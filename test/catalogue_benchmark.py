@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+""" Time from start to the first full publish, with and without a catalogue
+    from a previous run, on a fake D-Bus where every call takes a while.
+    Half the services can only be introspected. Also shows how long the
+    cached items take to be revalidated in the background. """
+import os
+import sys
+import tempfile
+from time import monotonic, sleep
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+import fake_dbus
+from catalogue import Catalogue
+from fake_dbus import FakeBus, drain
+
+
+def make_bus(services, paths, latency):
+	bus = FakeBus(latency)
+	for i in range(services):
+		values = {'/Ac/L{}/P{}'.format(j % 3, j): dbus.Double(j * 0.5, variant_level=1) for j in range(paths)}
+		values['/Mgmt/ProcessName'] = dbus.String('/opt/bench/driver{}'.format(i), variant_level=1)
+		values['/Mgmt/ProcessVersion'] = dbus.String('1.0', variant_level=1)
+		values['/ProductId'] = dbus.Int32(0xA000 + i, variant_level=1)
+		bus.add_service('com.victronenergy.pvinverter.bench{}'.format(i), values,
+			device_instance=256 + i, listing=i % 2 == 0)
+	return bus
+
+
+def idle(m):
+	return not (m._revalidating or m._scans or m._scan_queue or m._requests or m._outputs[0].queue)
+
+
+def start(bus, catalogue):
+	fake_dbus.install(bus)
+	published = []
+	started = monotonic()
+	m = dbus_mqtt.DbusMqtt(catalogue=catalogue)
+	client = m._outputs[0]._client
+	client.on_publish = lambda topic, payload, retain: published.append(topic)
+	drain()
+	client.deliver('R/{}/keepalive'.format(m._system_id), b'')
+	drain()
+	first = monotonic() - started
+	count = len(published)
+	calls = bus.calls
+	while not idle(m):
+		drain()
+		sleep(0.0005)
+	return m, first, count, calls, monotonic() - started
+
+
+def main():
+	services, paths, latency = 10, 100, 0.0005
+	path = os.path.join(tempfile.mkdtemp(), 'catalogue.json')
+	print('{:>10} {:>12} {:>10} {:>12} {:>14}'.format('catalogue', 'first (ms)', 'published',
+		'D-Bus calls', 'settled (ms)'))
+
+	m, first, count, calls, settled = start(make_bus(services, paths, latency), None)
+	print('{:>10} {:>12.0f} {:>10} {:>12} {:>14.0f}'.format('none', first * 1000, count, calls,
+		settled * 1000))
+
+	# Save what a previous run would have left behind
+	m._catalogue = Catalogue(path)
+	m._save_catalogue()
+
+	m, first, count, calls, settled = start(make_bus(services, paths, latency), Catalogue(path).load())
+	print('{:>10} {:>12.0f} {:>10} {:>12} {:>14.0f}'.format('cached', first * 1000, count, calls,
+		settled * 1000))
+
+
+if __name__ == '__main__':
+	main()
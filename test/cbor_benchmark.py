@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+""" Bytes and encoding time of the JSON and CBOR payloads for a day of
+    value changes: topic and payload of each N/ message against those of
+    the C/ message that goes with it. Also the time to decode W/
+    payloads. Uses a trace as recorded with dbus_mqtt.py --record, or a
+    JSON lines trace as in replay_benchmark.py, or else a synthetic day
+    with values like those of a typical system. """
+import argparse
+import json
+import os
+import random
+import sys
+from time import process_time
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+from payload import encode_json, encode_cbor, decode_cbor
+from replay_benchmark import load_trace
+from signal_trace import VALUE, ITEMS
+
+PORTAL = 'd0ff500097c0'
+DAY = 24 * 3600
+
+
+def synthetic_day(changes_per_second):
+	""" Events over a day for a battery, a solar charger, an inverter and
+	    a grid meter. """
+	rnd = random.Random(1)
+	paths = [
+		('com.victronenergy.battery.ttyO1', '/Dc/0/Voltage', lambda: round(rnd.uniform(48, 56), 2)),
+		('com.victronenergy.battery.ttyO1', '/Dc/0/Current', lambda: round(rnd.uniform(-50, 50), 1)),
+		('com.victronenergy.battery.ttyO1', '/Soc', lambda: rnd.randrange(20, 100)),
+		('com.victronenergy.battery.ttyO1', '/Alarms/LowVoltage', lambda: rnd.choice((0, 1))),
+		('com.victronenergy.solarcharger.ttyO2', '/Yield/Power', lambda: rnd.randrange(0, 3000)),
+		('com.victronenergy.solarcharger.ttyO2', '/Pv/V', lambda: round(rnd.uniform(0, 150), 2)),
+		('com.victronenergy.solarcharger.ttyO2', '/State', lambda: rnd.choice((0, 3, 4, 5))),
+		('com.victronenergy.solarcharger.ttyO2', '/Load/I', lambda: None if rnd.random() < 0.1 else 0.5),
+		('com.victronenergy.vebus.ttyO3', '/Ac/Out/L1/P', lambda: rnd.randrange(0, 5000)),
+		('com.victronenergy.vebus.ttyO3', '/Ac/Out/L1/V', lambda: round(rnd.uniform(225, 235), 2)),
+		('com.victronenergy.vebus.ttyO3', '/Ac/ActiveIn/L1/F', lambda: round(rnd.uniform(49.9, 50.1), 3)),
+		('com.victronenergy.vebus.ttyO3', '/Mode', lambda: 3),
+		('com.victronenergy.grid.cgwacs_ttyUSB0', '/Ac/Power', lambda: round(rnd.uniform(-3000, 3000), 1)),
+		('com.victronenergy.grid.cgwacs_ttyUSB0', '/Ac/L1/Energy/Forward', lambda: round(rnd.uniform(0, 1e5), 2)),
+		('com.victronenergy.grid.cgwacs_ttyUSB0', '/ProductName', lambda: 'Carlo Gavazzi ET340'),
+		('com.victronenergy.system', '/Dc/Battery/ConsumedAmphours', lambda: [round(rnd.uniform(0, 100), 1)] * 2),
+	]
+	events = []
+	for i in range(int(DAY * changes_per_second)):
+		service, path, value = paths[rnd.randrange(len(paths))]
+		events.append((i / changes_per_second, VALUE, (service, path, value())))
+	return events
+
+
+def messages(events):
+	""" (N/ topic, D-Bus value) of each value change. """
+	r = []
+	for _, kind, data in events:
+		if kind == VALUE:
+			changes = [(data[0], data[1], data[2])]
+		elif kind == ITEMS:
+			changes = [(data[0], p, v) for p, v in data[1].items()]
+		else:
+			continue
+		for service, path, value in changes:
+			topic = 'N/{}/{}/0{}'.format(PORTAL, dbus_mqtt.get_service_type(service), path)
+			r.append((topic, dbus_mqtt.wrap_dbus_value(value)))
+	return r
+
+
+def measure(encode, values):
+	started = process_time()
+	payloads = [encode(v) for v in values]
+	return payloads, process_time() - started
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare JSON and CBOR payloads')
+	parser.add_argument('--trace', default=None, help='use this trace instead of a synthetic day')
+	parser.add_argument('--rate', default=5, type=float, help='value changes per second of the synthetic day')
+	args = parser.parse_args()
+
+	events = synthetic_day(args.rate) if args.trace is None else load_trace(args.trace)
+	msgs = messages(events)
+	values = [v for _, v in msgs]
+	topics = sum(len(t) for t, _ in msgs)
+
+	print('{} messages'.format(len(msgs)))
+	print('{:>6} {:>14} {:>14} {:>12} {:>12}'.format('', 'payload (MB)', 'message (MB)', 'encode (s)',
+		'decode (s)'))
+	for name, encode, decode, wrap in (
+			('json', encode_json, json.loads, lambda v: json.dumps(dict(value=v))),
+			('cbor', encode_cbor, decode_cbor, lambda v: encode_cbor(dict(value=v)))):
+		payloads, elapsed = measure(encode, values)
+		size = sum(len(p) for p in payloads)
+		writes = [wrap(dbus_mqtt.unwrap_dbus_value(v)) for v in values]
+		_, decoding = measure(decode, writes)
+		print('{:>6} {:>14.2f} {:>14.2f} {:>12.2f} {:>12.2f}'.format(name, size / 1e6, (size + topics) / 1e6,
+			elapsed, decoding))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+""" Cost of one flaky service going away and coming back, among many
+    others, for a range of table sizes. The churned service has the same
+    number of items each time, only the other services grow. Also shows
+    what a walk over the whole item table, as done before there was a
+    per-service index, costs at that size. """
+import argparse
+import os
+import sys
+from time import monotonic
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+import fake_dbus
+from fake_dbus import FakeBus, drain
+
+CHURNED = 'com.victronenergy.modbusclient.flaky'
+
+
+def run(paths, churned_items, rounds, async_scan):
+	bus = FakeBus.synthetic(paths)
+	values = {'/Path/{}'.format(j): dbus.Double(j, variant_level=1) for j in range(churned_items)}
+	bus.add_service(CHURNED, values, device_instance=1)
+	fake_dbus.install(bus)
+	m = dbus_mqtt.DbusMqtt(async_scan=async_scan)
+	drain()
+	m._outputs[0]._client.deliver('R/{}/keepalive'.format(m._system_id), b'')
+	drain()
+
+	teardown = rediscover = new_path = 0
+	for i in range(rounds):
+		started = monotonic()
+		bus.remove_service(CHURNED)
+		drain()
+		teardown += monotonic() - started
+
+		started = monotonic()
+		bus.add_service(CHURNED, values, device_instance=1)
+		drain()
+		rediscover += monotonic() - started
+
+		# A path that was not there at the scan
+		started = monotonic()
+		bus.emit_value(CHURNED, '/New/{}'.format(i), dbus.Double(i, variant_level=1))
+		new_path += monotonic() - started
+		drain()
+
+	prefix = CHURNED + '/'
+	started = monotonic()
+	for _ in range(rounds):
+		[uid for uid in m._items if uid.startswith(prefix)]
+	sweep = monotonic() - started
+	return [t / rounds * 1000 for t in (teardown, rediscover, new_path, sweep)]
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Churn one service out of many')
+	parser.add_argument('--paths', default='1000,10000,100000',
+		help='comma separated numbers of paths of the other services')
+	parser.add_argument('--churned-items', default=50, type=int)
+	parser.add_argument('--rounds', default=20, type=int)
+	parser.add_argument('--async-scan', action='store_true')
+	args = parser.parse_args()
+
+	print('{:>8} {:>14} {:>16} {:>15} {:>12}'.format('paths', 'teardown (ms)', 'rediscover (ms)',
+		'new path (ms)', 'sweep (ms)'))
+	for paths in (int(p) for p in args.paths.split(',')):
+		teardown, rediscover, new_path, sweep = run(paths, args.churned_items, args.rounds, args.async_scan)
+		print('{:>8} {:>14.3f} {:>16.3f} {:>15.3f} {:>12.3f}'.format(paths, teardown, rediscover, new_path,
+			sweep))
+
+
+if __name__ == '__main__':
+	main()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import dbus
 import json
+import mmap
 import os
+import socket
 import sys
 import time
 import unittest
@@ -10,7 +12,19 @@ import unittest
 test_dir = os.path.dirname(__file__)
 sys.path.insert(1, os.path.join(test_dir, '..'))
 import dbus_mqtt
+import fake_dbus
 import paho.mqtt.client
+import payload
+import mqtt_gobject_bridge
+import outputs
+import publish_queue
+import rules
+import catalogue
+import shm_ring
+import signal_trace
+import stats
+import tempfile
+from gi.repository import GLib
 
 
 TestHost = 'ernst-test'
@@ -102,7 +116,7 @@ class ConversionTest(unittest.TestCase):
 		self.assertEqual(dbus.Int32(value, variant_level=1), dbus_value)
 
 	def test_dbus_wrap_long_int(self):
-		value = 1121232124727312535L
+		value = 1121232124727312535
 		dbus_value = dbus_mqtt.wrap_dbus_value(value)
 		self.assertIsInstance(dbus_value, dbus.Int64)
 		self.assertEqual(dbus.Int64(value, variant_level=1), dbus_value)
@@ -166,7 +180,7 @@ class ConversionTest(unittest.TestCase):
 		self.assertEqual(int(dbus_value), value)
 
 	def test_dbus_unwrap_int64_large(self):
-		dbus_value = dbus.Int64(33232133232323L, variant_level=1)
+		dbus_value = dbus.Int64(33232133232323, variant_level=1)
 		value = dbus_mqtt.unwrap_dbus_value(dbus_value)
 		self.assertIsInstance(value, int)
 		self.assertEqual(int(dbus_value), value)
@@ -174,7 +188,7 @@ class ConversionTest(unittest.TestCase):
 	def test_dbus_unwrap_string(self):
 		dbus_value = dbus.String('abcd', variant_level=1)
 		value = dbus_mqtt.unwrap_dbus_value(dbus_value)
-		self.assertIsInstance(value, unicode)
+		self.assertIsInstance(value, str)
 		self.assertEqual(str(dbus_value), value)
 
 	def test_dbus_unwrap_array(self):
@@ -198,5 +212,1193 @@ class ConversionTest(unittest.TestCase):
 		self.assertIsInstance(value, dict)
 		self.assertEqual({'a':3.2, 'b':3.7}, value)
 
+def published_item(topic):
+	return outputs.Item(None, topic)
+
+class SubscriptionsTest(unittest.TestCase):
+	def test_exact(self):
+		s = outputs.Subscriptions()
+		s.subscribe('battery/512/Soc')
+		self.assertTrue(s.match(('battery', '512', 'Soc')))
+		self.assertFalse(s.match(('battery', '512')))
+		self.assertFalse(s.match(('battery', '512', 'Soc', 'x')))
+		self.assertFalse(s.match(('battery', '513', 'Soc')))
+
+	def test_plus(self):
+		s = outputs.Subscriptions()
+		s.subscribe('battery/+/Soc')
+		self.assertTrue(s.match(('battery', '512', 'Soc')))
+		self.assertTrue(s.match(('battery', '513', 'Soc')))
+		self.assertFalse(s.match(('battery', '513', 'Dc', '0')))
+
+	def test_hash(self):
+		s = outputs.Subscriptions()
+		s.subscribe('system/#')
+		self.assertTrue(s.match(('system', '0', 'Serial')))
+		self.assertTrue(s.match(('system', '0')))
+		# A '#' needs at least one more level, as before
+		self.assertFalse(s.match(('system',)))
+		self.assertFalse(s.match(('vebus', '0')))
+
+	def test_overlapping(self):
+		s = outputs.Subscriptions()
+		s.subscribe('vebus/+/Ac/Out/L1/P')
+		s.subscribe('vebus/276/Ac/#')
+		s.subscribe('vebus/276/Mode')
+		self.assertTrue(s.match(('vebus', '276', 'Ac', 'Out', 'L2', 'P')))
+		self.assertTrue(s.match(('vebus', '0', 'Ac', 'Out', 'L1', 'P')))
+		self.assertTrue(s.match(('vebus', '276', 'Mode')))
+		self.assertFalse(s.match(('vebus', '0', 'Mode')))
+
+	def test_match_prefix(self):
+		s = outputs.Subscriptions()
+		self.assertFalse(s.match_prefix(('battery', '512')))
+		s.subscribe('battery/+/Soc')
+		s.subscribe('vebus/276')
+		s.subscribe('system/#')
+		self.assertTrue(s.match_prefix(('battery', '512')))
+		self.assertFalse(s.match_prefix(('solarcharger', '0')))
+		# Matches only a topic of two levels, no item has one
+		self.assertFalse(s.match_prefix(('vebus', '276')))
+		self.assertTrue(s.match_prefix(('system', '0')))
+		s.subscribe('+/0/Serial')
+		self.assertTrue(s.match_prefix(('settings', '0')))
+		self.assertFalse(s.match_prefix(('settings', '1')))
+		s.subscribe_all()
+		self.assertTrue(s.match_prefix(('settings', '1')))
+
+	def test_subscribe_twice(self):
+		s = outputs.Subscriptions()
+		self.assertIsNotNone(s.subscribe('battery/+/Soc'))
+		self.assertIsNone(s.subscribe('battery/+/Soc'))
+		self.assertIsNotNone(s.subscribe_all())
+		self.assertIsNone(s.subscribe_all())
+
+	def test_cleanup(self):
+		s = outputs.Subscriptions()
+		s.subscribe('battery/+/Soc', -1)
+		s.subscribe('battery/512/#', 10)
+		published = [published_item('N/x/battery/512/Soc'),
+			published_item('N/x/battery/513/Soc')]
+		for pt in published:
+			self.assertIsNotNone(s.cover(pt))
+		expired = s.cleanup(set())
+		self.assertEqual([p.fulltopic for p in expired], ['N/x/battery/513/Soc'])
+		self.assertTrue(s.match(('battery', '512', 'Soc')))
+		self.assertFalse(s.match(('battery', '513', 'Soc')))
+		# Pruned from the trie
+		self.assertNotIn('+', s.root.children['battery'].children)
+		# Nothing left to expire
+		self.assertEqual(s.cleanup(set()), [])
+		# Unpublished in the meantime
+		s.subscribe('battery/+/Soc', -1)
+		s.cover(published[1])
+		s.uncover(published[1])
+		self.assertEqual(s.cleanup(set()), [])
+
+	def test_uncover(self):
+		s = outputs.Subscriptions()
+		t = s.subscribe('battery/#')
+		# An item that comes and goes, as with a restarting service
+		for _ in range(50):
+			pt = published_item('N/x/battery/512/Soc')
+			s.cover(pt)
+			s.uncover(pt)
+		self.assertEqual(t.covered, set())
+		self.assertEqual(s.published, {})
+		# Covered by a newer subscription instead
+		s.cover(pt)
+		u = s.subscribe('battery/512/Soc')
+		s.cover(pt, u)
+		self.assertEqual((t.covered, u.covered), (set(), {pt}))
+
+	def test_cleanup_refreshed(self):
+		s = outputs.Subscriptions()
+		pt = published_item('N/x/battery/512/Soc')
+		s.subscribe('battery/+/Soc', -1)
+		s.cover(pt)
+		s.subscribe('battery/+/Soc', 10)
+		self.assertEqual(s.cleanup(set()), [])
+		self.assertTrue(s.match(pt.shorttopic))
+
+	def test_cleanup_wildcard(self):
+		s = outputs.Subscriptions()
+		published = [published_item('N/x/battery/512/Soc'),
+			published_item('N/x/system/0/Serial')]
+		s.subscribe_all(-1)
+		for pt in published:
+			s.cover(pt)
+		s.subscribe('battery/#', 10)
+		expired = s.cleanup({'N/x/system/0/Serial'})
+		self.assertEqual(expired, [])
+		self.assertIsNone(s.wildcard)
+
+class AliasTest(unittest.TestCase):
+	def test_alias_dictionary(self):
+		items = [outputs.Item(None, 'N/x/battery/512/Dc/0/Voltage', alias=7),
+			outputs.Item(None, 'N/x/battery/512/Soc', alias=12)]
+		self.assertEqual(json.loads(outputs.alias_dictionary(items)),
+			{'7': '/Dc/0/Voltage', '12': '/Soc'})
+
+class ReadCacheTest(unittest.TestCase):
+	def test_fresh(self):
+		m = dbus_mqtt.DbusMqtt.__new__(dbus_mqtt.DbusMqtt)
+		m._read_max_age = 10
+		m._unsignalled = set()
+		item = outputs.Item('com.victronenergy.battery.ttyO1/Soc', 'N/x/battery/512/Soc',
+			dbus.Double(80, variant_level=1))
+		self.assertFalse(m._fresh(item, 100))
+		item.updated = 95
+		self.assertTrue(m._fresh(item, 100))
+		self.assertFalse(m._fresh(item, 106))
+		m._unsignalled.add(item.uid)
+		self.assertFalse(m._fresh(item, 100))
+		# Known not to send signals
+		item = outputs.Item('com.victronenergy.vebus.ttyO1/Hub4/L1/AcPowerSetpoint',
+			'N/x/vebus/276/Hub4/L1/AcPowerSetpoint', dbus.Double(0, variant_level=1))
+		item.updated = 95
+		self.assertFalse(m._fresh(item, 100))
+
+class FakeBusTest(unittest.TestCase):
+	""" DbusMqtt on the fake D-Bus and MQTT client of the benchmarks. """
+	def setUp(self):
+		self._saved = dbus.SystemBus, dbus.SessionBus, paho.mqtt.client.Client
+
+	def tearDown(self):
+		dbus.SystemBus, dbus.SessionBus, paho.mqtt.client.Client = self._saved
+
+	def start(self, bus, **kwargs):
+		fake_dbus.install(bus)
+		m = dbus_mqtt.DbusMqtt(**kwargs)
+		fake_dbus.drain()
+		return m
+
+	def keepalive(self, m, payload=b''):
+		m._outputs[0]._client.deliver('R/{}/keepalive'.format(m._system_id), payload)
+
+class AliasPublishTest(FakeBusTest):
+	def make_bus(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', {'/Soc': dbus.Double(80, variant_level=1)},
+			device_instance=512)
+		return bus
+
+	def test_publish(self):
+		m = self.start(self.make_bus())
+		self.keepalive(m, json.dumps({'keepalive-options': ['alias']}))
+		fake_dbus.drain()
+		client = m._outputs[0]._client
+		item = m._items['com.victronenergy.battery.ttyO1/Soc']
+		published = {p[1]: p[2:] for p in client.published}
+		self.assertEqual(json.loads(published['N/{}/$aliases/battery/512'.format(m._system_id)][0])[
+			str(item.alias)], '/Soc')
+		self.assertTrue(published['N/{}/$aliases/battery/512'.format(m._system_id)][1])
+		self.assertEqual(published['A/{}/{}'.format(m._system_id, item.alias)], ('{"value": 80.0}', False))
+
+	def test_stale_after_scan(self):
+		fake_dbus.install(self.make_bus())
+		m = dbus_mqtt.DbusMqtt(async_scan=True)
+		client = m._outputs[0]._client
+		# Retained by the broker from a previous run, before the scan is done
+		for service in ('battery/512', 'battery/513'):
+			client.deliver('N/{}/$aliases/{}'.format(m._system_id, service), b'{}', retain=True)
+		self.assertEqual([p for p in client.published if p[2] is None], [])
+		fake_dbus.drain()
+		self.assertEqual([p[1] for p in client.published if p[2] is None],
+			['N/{}/$aliases/battery/513'.format(m._system_id)])
+
+class QueueTest(FakeBusTest):
+	def test_coalesced_change_moves_up(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', {'/Soc': dbus.Double(80, variant_level=1)},
+			device_instance=512)
+		m = self.start(bus)
+		output = m._outputs[0]
+		# Everything goes into the bulk lane, the change must not wait there
+		self.keepalive(m)
+		lanes = output.queue.lanes
+		self.assertIn('N/{}/battery/512/Soc'.format(m._system_id), lanes[publish_queue.LANE_BULK])
+		bus.emit_value('com.victronenergy.battery.ttyO1', '/Soc', dbus.Double(81, variant_level=1))
+		self.assertNotIn('N/{}/battery/512/Soc'.format(m._system_id), lanes[publish_queue.LANE_BULK])
+		self.assertIn('N/{}/battery/512/Soc'.format(m._system_id), lanes[publish_queue.LANE_CHANGE])
+		# Not down again
+		output.publish_all()
+		self.assertIn('N/{}/battery/512/Soc'.format(m._system_id), lanes[publish_queue.LANE_CHANGE])
+
+	def test_trim_keeps_removals(self):
+		m = self.start(fake_dbus.FakeBus(), max_queue=2)
+		output = m._outputs[0]
+		output.queue.clear()
+		for i in range(3):
+			output.queue.put('N/x/battery/{}/Soc'.format(i), None)
+			output.queue.put('N/x/battery/{}/$stats'.format(i), 1, publish_queue.LANE_REPLY)
+			output.queue.put('N/x/keepalive/{}'.format(i), 1)
+		output._trim_queue()
+		self.assertEqual(sorted(output.queue.lanes[publish_queue.LANE_CHANGE]),
+			['N/x/battery/0/Soc', 'N/x/battery/1/Soc', 'N/x/battery/2/Soc'])
+		self.assertEqual(len(output.queue), 3)
+
+	def test_trim_spills_removals(self):
+		fd, path = tempfile.mkstemp()
+		os.close(fd)
+		self.addCleanup(os.unlink, path)
+		spill = publish_queue.SpillRing(path, 16 * publish_queue.SpillRing.SLOT)
+		m = self.start(fake_dbus.FakeBus(), max_queue=2, spill=spill)
+		output = m._outputs[0]
+		output.queue.clear()
+		for i in range(3):
+			output.queue.put('N/x/battery/{}/Soc'.format(i), None)
+			output.queue.put('N/x/keepalive/{}'.format(i), 1)
+		output._trim_queue()
+		self.assertEqual(list(output.queue.lanes[publish_queue.LANE_CHANGE]),
+			['N/x/battery/1/Soc', 'N/x/battery/2/Soc'])
+		# Published again after the reconnect
+		output._on_connect(output._client, None, {}, 0)
+		self.assertIn('N/x/battery/0/Soc', output.queue.lanes[publish_queue.LANE_CHANGE])
+		self.assertEqual(len(spill), 0)
+
+	def test_probe_keeps_confirmed(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', {'/Soc': dbus.Double(80, variant_level=1),
+			'/Dc/0/Voltage': dbus.Double(12, variant_level=1)}, device_instance=512)
+		m = self.start(bus)
+		output = m._outputs[0]
+		self.keepalive(m)
+		fake_dbus.drain()
+		# Reconnected, and a change went out before the probe came back
+		output._probe_retained()
+		bus.emit_value('com.victronenergy.battery.ttyO1', '/Soc', dbus.Double(81, variant_level=1))
+		output._service_queue()
+		output._on_subscribe(output._client, None, output._probe_mid, (0,))
+		self.assertEqual(list(output.queue.lanes[publish_queue.LANE_BULK]),
+			['N/{}/battery/512/Dc/0/Voltage'.format(m._system_id),
+			'N/{}/battery/512/DeviceInstance'.format(m._system_id)])
+
+	def test_cbor_cleared_on_expiry(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', {'/Soc': dbus.Double(80, variant_level=1)},
+			device_instance=512)
+		m = self.start(bus)
+		output = m._outputs[0]
+		self.keepalive(m, json.dumps({'keepalive-options': ['cbor']}))
+		fake_dbus.drain()
+		topic = 'C/{}/battery/512/Soc'.format(m._system_id)
+		client = output._client
+		self.assertEqual([p[2:] for p in client.published if p[1] == topic],
+			[(payload.encode_cbor(80.0), True)])
+		# Not repeated by the client
+		output._keepalive_options._deadlines['cbor'] = time.time() - 1
+		output._expire_stale_topics()
+		self.assertEqual([p[2:] for p in client.published if p[1] == topic][1:], [(None, True)])
+
+class RequestTest(FakeBusTest):
+	def test_read_from_two_outputs(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', {'/Soc': dbus.Double(80, variant_level=1)},
+			device_instance=512)
+		m = self.start(bus, async_requests=True, request_window=1, outputs=[dict(name='second')])
+		topic = 'R/{}/battery/512/Soc'.format(m._system_id)
+		clients = [output._client for output in m._outputs]
+		for client in clients:
+			client.published.clear()
+		# Another read is in flight, these two wait
+		clients[0].deliver('R/{}/battery/512/DeviceInstance'.format(m._system_id), b'')
+		clients[0].deliver(topic, b'')
+		clients[1].deliver(topic, b'')
+		fake_dbus.drain()
+		for client in clients:
+			self.assertIn(('N' + topic[1:], '{"value": 80.0}'), [p[1:3] for p in client.published])
+
+	def settings_bus(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.settings', {'/Settings/a': dbus.Int32(0, variant_level=1)})
+		call_async = bus.call_async
+		def checked_call_async(service, path, *args, **kwargs):
+			# As dbus-python does
+			if '-' in path:
+				raise ValueError('Invalid object path {}'.format(path))
+			return call_async(service, path, *args, **kwargs)
+		bus.call_async = checked_call_async
+		return bus
+
+	def test_invalid_path(self):
+		bus = self.settings_bus()
+		m = self.start(bus, async_requests=True, request_window=1)
+		client = m._outputs[0]._client
+		for _ in range(3):
+			client.deliver('W/{}/settings/0/Settings/a-b'.format(m._system_id), b'{"value": 1}')
+		# The window is free again
+		client.deliver('W/{}/settings/0/Settings/a'.format(m._system_id), b'{"value": 2}')
+		fake_dbus.drain()
+		self.assertEqual(bus.services['com.victronenergy.settings'].values['/Settings/a'], 2)
+		self.assertNotIn('com.victronenergy.settings', m._requests)
+
+	def test_bulk_write(self):
+		bus = self.settings_bus()
+		m = self.start(bus, async_requests=True)
+		client = m._outputs[0]._client
+		wrap = dbus_mqtt.wrap_dbus_value
+		def checked_wrap(value):
+			# As dbus.Int64 does
+			if isinstance(value, int) and abs(value) >= 2**63:
+				raise OverflowError('int too big')
+			return wrap(value)
+		dbus_mqtt.wrap_dbus_value = checked_wrap
+		self.addCleanup(setattr, dbus_mqtt, 'wrap_dbus_value', wrap)
+		client.deliver('W/{}/$bulk'.format(m._system_id), json.dumps({
+			'settings/0/Settings/a-b': 1,
+			'settings/0/Settings/b': 2**70,
+			'settings/0/Settings/a': 2,
+			'battery/512/Soc': 1}).encode())
+		fake_dbus.drain()
+		replies = [p[2] for p in client.published if p[1] == 'N/{}/$bulk'.format(m._system_id)]
+		self.assertEqual(len(replies), 1)
+		self.assertEqual(json.loads(replies[0]), {
+			'settings/0/Settings/a-b': {'error': 'org.freedesktop.DBus.Error.InvalidArgs'},
+			'settings/0/Settings/b': {'error': 'Invalid value'},
+			'settings/0/Settings/a': {'result': 0},
+			'battery/512/Soc': {'error': 'Unknown service'}})
+		self.assertEqual(bus.services['com.victronenergy.settings'].values['/Settings/a'], 2)
+
+class CatalogueRestartTest(FakeBusTest):
+	def setUp(self):
+		super(CatalogueRestartTest, self).setUp()
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'catalogue.json')
+
+	def tearDown(self):
+		super(CatalogueRestartTest, self).tearDown()
+		for name in os.listdir(self.dir):
+			os.unlink(os.path.join(self.dir, name))
+		os.rmdir(self.dir)
+
+	def restart(self, values, listing):
+		""" Run with values on the bus, and the catalogue of the last run. """
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', values, device_instance=512, listing=listing)
+		m = self.start(bus, catalogue=catalogue.Catalogue(self.path).load())
+		m._save_catalogue()
+		return m
+
+	def check_path_gone(self, listing):
+		values = {
+			'/Mgmt/ProcessName': dbus.String('dbus-battery', variant_level=1),
+			'/Mgmt/ProcessVersion': dbus.String('1.0', variant_level=1),
+			'/ProductId': dbus.Int32(0xB012, variant_level=1),
+			'/Soc': dbus.Double(80, variant_level=1),
+			'/Dc/1/Voltage': dbus.Double(12, variant_level=1)}
+		self.restart(values, listing)
+		del values['/Dc/1/Voltage']
+		m = self.restart(values, listing)
+		self.assertNotIn('com.victronenergy.battery.ttyO1/Dc/1/Voltage', m._items)
+		self.assertIn('com.victronenergy.battery.ttyO1/Soc', m._items)
+		# Cleared on the broker, and gone from the catalogue
+		topic = 'N/{}/battery/512/Dc/1/Voltage'.format(m._system_id)
+		self.assertEqual([p[2] for p in m._outputs[0]._client.published if p[1] == topic], [None])
+		items = catalogue.Catalogue(self.path).load().get('com.victronenergy.battery.ttyO1')['items']
+		self.assertNotIn('/Dc/1/Voltage', items)
+		self.assertIn('/Soc', items)
+
+	def test_path_gone(self):
+		self.check_path_gone(True)
+
+	def test_path_gone_introspected(self):
+		self.check_path_gone(False)
+
+class AsyncScanTest(FakeBusTest):
+	values = {
+		'/Soc': dbus.Double(80, variant_level=1),
+		'/Dc/0/Voltage': dbus.Double(12, variant_level=1),
+		'/Dc/0/Current': dbus.Double(-1, variant_level=1)}
+
+	def make_bus(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', self.values, device_instance=512)
+		bus.add_service('com.victronenergy.battery.ttyO2', self.values, device_instance=513, listing=False)
+		def call_blocking(*args, **kwargs):
+			raise AssertionError('blocking call')
+		bus.call_blocking = call_blocking
+		return bus
+
+	def check_items(self, m, services):
+		self.assertEqual(sorted(m._items), sorted(s + p for s in services
+			for p in list(self.values) + ['/DeviceInstance']))
+		self.assertEqual(m._scans_running, 0)
+		self.assertEqual(m._scans, {})
+
+	def test_scan(self):
+		m = self.start(self.make_bus(), async_scan=True, scan_concurrency=1)
+		self.check_items(m, ['com.victronenergy.battery.ttyO1', 'com.victronenergy.battery.ttyO2'])
+		self.assertEqual(m._introspected, {'com.victronenergy.battery.ttyO2'})
+
+	def test_gone_while_introspected(self):
+		bus = self.make_bus()
+		fake_dbus.install(bus)
+		m = dbus_mqtt.DbusMqtt(async_scan=True)
+		# Part of the tree was walked
+		for _ in range(3):
+			GLib.MainContext.default().iteration(False)
+		bus.remove_service('com.victronenergy.battery.ttyO2')
+		fake_dbus.drain()
+		self.check_items(m, ['com.victronenergy.battery.ttyO1'])
+
+	def test_introspected_again(self):
+		bus = self.make_bus()
+		fake_dbus.install(bus)
+		m = dbus_mqtt.DbusMqtt(async_scan=True)
+		for _ in range(3):
+			GLib.MainContext.default().iteration(False)
+		m._scan_dbus_service_async('com.victronenergy.battery.ttyO2')
+		fake_dbus.drain()
+		self.check_items(m, ['com.victronenergy.battery.ttyO1', 'com.victronenergy.battery.ttyO2'])
+
+class ServiceIndexTest(FakeBusTest):
+	values = {'/Soc': dbus.Double(80, variant_level=1)}
+
+	def lookup(self, m, service):
+		return m._get_uid_by_topic('N/{}/{}/Soc'.format(m._system_id, service))[0]
+
+	def test_appear_disappear(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', self.values, device_instance=512)
+		m = self.start(bus)
+		self.assertEqual(self.lookup(m, 'battery/512'), 'com.victronenergy.battery.ttyO1')
+		self.assertIsNone(self.lookup(m, 'battery/513'))
+		bus.add_service('com.victronenergy.battery.ttyO2', self.values, device_instance=513)
+		fake_dbus.drain()
+		self.assertEqual(self.lookup(m, 'battery/513'), 'com.victronenergy.battery.ttyO2')
+		bus.remove_service('com.victronenergy.battery.ttyO2')
+		fake_dbus.drain()
+		self.assertIsNone(self.lookup(m, 'battery/513'))
+		self.assertNotIn('com.victronenergy.battery.ttyO2', m._service_info)
+		self.assertNotIn('com.victronenergy.battery.ttyO2/Soc', m._items)
+		self.assertEqual(self.lookup(m, 'battery/512'), 'com.victronenergy.battery.ttyO1')
+
+	def test_device_instance_changed(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', self.values, device_instance=512)
+		m = self.start(bus)
+		self.keepalive(m)
+		fake_dbus.drain()
+		client = m._outputs[0]._client
+		# Back under a new owner, with another device instance
+		bus.add_service('com.victronenergy.battery.ttyO1', self.values, device_instance=513)
+		fake_dbus.drain()
+		self.assertIsNone(self.lookup(m, 'battery/512'))
+		self.assertEqual(self.lookup(m, 'battery/513'), 'com.victronenergy.battery.ttyO1')
+		self.assertEqual(m._items['com.victronenergy.battery.ttyO1/Soc'].fulltopic,
+			'N/{}/battery/513/Soc'.format(m._system_id))
+		self.assertEqual([p[2] for p in client.published if p[1] == 'N/{}/battery/512/Soc'.format(
+			m._system_id)][-1], None)
+		self.assertEqual([p[2] for p in client.published if p[1] == 'N/{}/battery/513/Soc'.format(
+			m._system_id)], ['{"value": 80.0}'])
+
+class LazyTest(FakeBusTest):
+	def setUp(self):
+		super(LazyTest, self).setUp()
+		self.bus = fake_dbus.FakeBus()
+		self.bus.add_service('com.victronenergy.battery.ttyO1', {'/Soc': dbus.Double(80, variant_level=1)},
+			device_instance=512)
+		self.bus.add_service('com.victronenergy.solarcharger.ttyO2',
+			{'/Yield/Power': dbus.Double(100, variant_level=1)}, device_instance=278)
+		self.m = self.start(self.bus, lazy=True, keep_alive_interval=60)
+		self.battery = self.m._service_info['com.victronenergy.battery.ttyO1']
+		self.solarcharger = self.m._service_info['com.victronenergy.solarcharger.ttyO2']
+		self.addCleanup(setattr, dbus_mqtt, 'time', dbus_mqtt.time)
+		self.addCleanup(setattr, outputs, 'time', outputs.time)
+		self.now = dbus_mqtt.time()
+
+	def later(self, seconds):
+		""" Move the clock of dbus_mqtt and its outputs forward. """
+		now = self.now
+		dbus_mqtt.time = outputs.time = lambda: now + seconds
+
+	def emit(self, service, path, value):
+		self.bus.emit_value(service, path, dbus.Double(value, variant_level=1))
+		fake_dbus.drain()
+
+	def test_subscription_activates(self):
+		self.assertFalse(self.battery.active)
+		self.assertEqual(self.battery.items, set())
+		self.keepalive(self.m, json.dumps(['battery/512/#']).encode())
+		fake_dbus.drain()
+		self.assertTrue(self.battery.active)
+		self.assertIn('com.victronenergy.battery.ttyO1/Soc', self.m._items)
+		self.emit('com.victronenergy.battery.ttyO1', '/Soc', 81)
+		self.assertEqual(self.m._items['com.victronenergy.battery.ttyO1/Soc'].value, 81)
+		# Not asked for, its signals are dropped
+		self.assertFalse(self.solarcharger.active)
+		self.emit('com.victronenergy.solarcharger.ttyO2', '/Yield/Power', 200)
+		self.assertNotIn('com.victronenergy.solarcharger.ttyO2/Yield/Power', self.m._items)
+
+	def test_read_lease(self):
+		client = self.m._outputs[0]._client
+		client.deliver('R/{}/solarcharger/278/Yield/Power'.format(self.m._system_id), b'')
+		fake_dbus.drain()
+		self.assertTrue(self.solarcharger.active)
+		self.assertIn(('N/{}/solarcharger/278/Yield/Power'.format(self.m._system_id), '{"value": 100.0}'),
+			[p[1:3] for p in client.published])
+		# Kept active while the lease lasts
+		self.later(dbus_mqtt.MAX_TOPIC_AGE - 1)
+		self.m._outputs[0]._expire_stale_topics()
+		self.assertTrue(self.solarcharger.active)
+		self.later(dbus_mqtt.MAX_TOPIC_AGE + 1)
+		self.m._outputs[0]._expire_stale_topics()
+		self.assertFalse(self.solarcharger.active)
+		self.assertNotIn('com.victronenergy.solarcharger.ttyO2/Yield/Power', self.m._items)
+
+	def test_subscription_expires(self):
+		self.keepalive(self.m, json.dumps(['battery/512/#']).encode())
+		fake_dbus.drain()
+		self.later(61)
+		output = self.m._outputs[0]
+		output._expire_stale_topics()
+		self.assertFalse(self.battery.active)
+		self.assertEqual(self.battery.items, set())
+		self.assertNotIn('com.victronenergy.battery.ttyO1/Soc', self.m._items)
+		self.assertEqual(output._subscriptions.published, {})
+		self.emit('com.victronenergy.battery.ttyO1', '/Soc', 82)
+		self.assertNotIn('com.victronenergy.battery.ttyO1/Soc', self.m._items)
+		# Asked for again
+		self.keepalive(self.m, json.dumps(['battery/512/#']).encode())
+		fake_dbus.drain()
+		self.assertTrue(self.battery.active)
+		self.assertEqual(self.m._items['com.victronenergy.battery.ttyO1/Soc'].value, 82)
+
+class ReloadRulesTest(FakeBusTest):
+	def setUp(self):
+		super(ReloadRulesTest, self).setUp()
+		self.bus = fake_dbus.FakeBus()
+		self.bus.add_service('com.victronenergy.vebus.ttyO1', {
+			'/Interfaces/Mk2/Tunnel': dbus.Int32(0, variant_level=1),
+			'/Soc': dbus.Double(80, variant_level=1)}, device_instance=276)
+		self.bus.add_service('com.victronenergy.battery.ttyO2', {
+			'/Soc': dbus.Double(70, variant_level=1)}, device_instance=512)
+		self.m = self.start(self.bus)
+
+	def reload(self, item_rules):
+		calls = self.bus.calls
+		self.m.reload_item_rules(item_rules)
+		fake_dbus.drain()
+		return self.bus.calls - calls
+
+	def test_unchanged(self):
+		# The blocked items stay excluded, nothing is scanned again
+		self.assertEqual(self.reload(rules.ItemRules()), 0)
+		self.assertIn('com.victronenergy.vebus.ttyO1/Interfaces/Mk2/Tunnel', self.m._excluded)
+
+	def test_item_included_again(self):
+		self.reload(rules.ItemRules([rules.ItemRule(False, 'battery', path='/Soc')]))
+		self.assertNotIn('com.victronenergy.battery.ttyO2/Soc', self.m._items)
+		self.assertEqual(self.reload(rules.ItemRules([rules.ItemRule(False, 'battery', path='/Soc')])), 0)
+		self.assertGreater(self.reload(rules.ItemRules()), 0)
+		self.assertIn('com.victronenergy.battery.ttyO2/Soc', self.m._items)
+		self.assertIn('com.victronenergy.vebus.ttyO1/Interfaces/Mk2/Tunnel', self.m._excluded)
+
+	def test_service_included_again(self):
+		self.reload(rules.ItemRules([rules.ItemRule(False, 'battery')]))
+		self.assertNotIn('com.victronenergy.battery.ttyO2', self.m._service_info)
+		self.assertEqual(self.reload(rules.ItemRules([rules.ItemRule(False, 'battery')])), 0)
+		self.assertGreater(self.reload(rules.ItemRules()), 0)
+		self.assertIn('com.victronenergy.battery.ttyO2/Soc', self.m._items)
+
+class TwoProcessTest(FakeBusTest):
+	""" Both processes of the two-process mode, in this process. """
+	def ring(self, size):
+		""" Both ends, without closing those of the other process. """
+		buf = mmap.mmap(-1, size)
+		filled = os.pipe()
+		read = os.pipe()
+		self.addCleanup(self.close, filled, read)
+		return shm_ring.RingWriter(buf, size, filled[1], read[0]), shm_ring.RingReader(buf, size, filled[0], read[1])
+
+	def close(self, filled, read):
+		""" Let the watches of both ends see the end of the ring before
+		    the pipes are gone, or they would watch pipes of later tests. """
+		os.close(filled[1])
+		os.close(read[1])
+		GLib.MainContext.default().iteration(False)
+		os.close(filled[0])
+		os.close(read[0])
+
+	def test_reply_none(self):
+		changes = self.ring(4096)
+		requests = self.ring(4096)
+		m = self.start(fake_dbus.FakeBus(), egress=(changes[0], requests[1]))
+		egress = outputs.Egress(changes[1], requests[0], [{}])
+		self.assertTrue(egress._scanning())
+		fake_dbus.drain()
+		# Told by the ingest process
+		self.assertFalse(egress._scanning())
+		# An item without a valid value has no payload
+		requester = outputs.RingRequester(m._outputs[0], 0)
+		requester.reply('N/x/battery/512/Soc', None)
+		requester.reply('N/x/battery/512/Dc/0/Voltage', '{"value": 12}')
+		fake_dbus.drain()
+		self.assertEqual([p[1:] for p in egress._outputs[0]._client.published if p[1].startswith('N/x/')],
+			[('N/x/battery/512/Soc', None, False), ('N/x/battery/512/Dc/0/Voltage', '{"value": 12}', False)])
+
+	def test_oversized_value(self):
+		bus = fake_dbus.FakeBus()
+		bus.add_service('com.victronenergy.battery.ttyO1', {'/Soc': dbus.Double(80, variant_level=1),
+			'/Info': dbus.String('x' * 3000, variant_level=1)}, device_instance=512)
+		changes = self.ring(4096)
+		requests = self.ring(4096)
+		m = self.start(bus, egress=(changes[0], requests[1]))
+		egress = outputs.Egress(changes[1], requests[0], [{}])
+		fake_dbus.drain()
+		values = {item.shorttopic: item.value for item in egress._items.values()}
+		self.assertEqual(values[('battery', '512', 'Info')], outputs.VeDbusInvalid)
+		self.assertEqual(values[('battery', '512', 'Soc')], 80)
+		self.assertEqual(m._outputs[0].collect_stats()['ring/oversized'], 1)
+		# The ring is not stuck on it
+		bus.emit_value('com.victronenergy.battery.ttyO1', '/Soc', dbus.Double(81, variant_level=1))
+		fake_dbus.drain()
+		self.assertEqual([item.value for item in egress._items.values()
+			if item.shorttopic == ('battery', '512', 'Soc')], [81])
+
+class PendingClient(fake_dbus.CaptureClient):
+	""" Keeps what is published as pending output, as paho does when the
+	    socket is full, until loop_write. Connected over TCP. """
+	def __init__(self, *args, **kwargs):
+		super(PendingClient, self).__init__(*args, **kwargs)
+		self._socket.close()
+		self._peer.close()
+		listener = socket.socket()
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		self._socket = socket.create_connection(listener.getsockname())
+		self._peer = listener.accept()[0]
+		listener.close()
+		self.pending = 0
+		self.writes = 0
+
+	def publish(self, topic, payload=None, qos=0, retain=False):
+		super(PendingClient, self).publish(topic, payload, qos, retain)
+		self.pending += 1
+
+	def want_write(self):
+		return self.pending > 0
+
+	def loop_write(self, max_packets=1):
+		self.writes += 1
+		self.pending = 0
+		return paho.mqtt.client.MQTT_ERR_SUCCESS
+
+class WriteWatchTest(FakeBusTest):
+	def bridge(self, write_watch):
+		paho.mqtt.client.Client = PendingClient
+		bridge = mqtt_gobject_bridge.MqttGObjectBridge(write_watch=write_watch)
+		fake_dbus.drain()
+		client = bridge._client
+		self.addCleanup(client._socket.close)
+		self.addCleanup(client._peer.close)
+		return bridge, client
+
+	def test_write_watch(self):
+		bridge, client = self.bridge(True)
+		self.assertTrue(client.socket().getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+		# Nothing to write, nothing to watch
+		bridge._flush()
+		self.assertIsNone(bridge._write_watch)
+		client.publish('N/x/a', '1')
+		bridge._flush()
+		watch = bridge._write_watch
+		self.assertIsNotNone(watch)
+		client.publish('N/x/b', '2')
+		bridge._flush()
+		self.assertEqual(bridge._write_watch, watch)
+		# Written once the socket is writable, then no longer watched
+		self.assertFalse(bridge._on_socket_out(client.socket().fileno(), GLib.IO_OUT))
+		self.assertEqual(client.writes, 1)
+		self.assertIsNone(bridge._write_watch)
+		# Gone with the connection
+		client.publish('N/x/c', '3')
+		bridge._flush()
+		bridge._on_disconnect(client, None, 1)
+		self.assertIsNone(bridge._write_watch)
+
+	def test_timer(self):
+		bridge, client = self.bridge(False)
+		self.assertFalse(client.socket().getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+		client.publish('N/x/a', '1')
+		bridge._flush()
+		self.assertIsNone(bridge._write_watch)
+		# Written by the timer
+		bridge._on_socket_timer()
+		self.assertEqual(client.writes, 1)
+
+class OutputsTest(unittest.TestCase):
+	def setUp(self):
+		fd, self.path = tempfile.mkstemp()
+		os.close(fd)
+
+	def tearDown(self):
+		os.unlink(self.path)
+
+	def _load(self, entries):
+		with open(self.path, 'w') as f:
+			json.dump(entries, f)
+		return dbus_mqtt.load_outputs(self.path)
+
+	def test_load(self):
+		outputs = self._load([
+			{'server': 'scada.example.com', 'port': 8883, 'user': 'gx', 'password': 'secret',
+				'max-messages': 50},
+			{'name': 'hmi', 'keep-alive': 0, 'publish-all': True}])
+		self.assertEqual(outputs[0], dict(name='scada.example.com', mqtt_server='scada.example.com',
+			port=8883, user='gx', passwd='secret', max_messages=50,
+			keep_alive_interval=dbus_mqtt.MAX_TOPIC_AGE))
+		self.assertEqual(outputs[1], dict(name='hmi', keep_alive_interval=None, publish_all=True))
+
+	def test_unknown_option(self):
+		with self.assertRaises(ValueError):
+			self._load([{'server': 'x', 'qos': 1}])
+
+class BatchTest(unittest.TestCase):
+	def test_batch_payloads(self):
+		batches = outputs.batch_payloads('x', [
+			('N/x/battery/512/Soc', dbus.Double(80.5, variant_level=1)),
+			('N/x/keepalive', 1),
+			('N/x/battery/512/Dc/0/Voltage', None),
+			('N/x/system/0/Serial', dbus.String('x', variant_level=1))])
+		self.assertEqual([t for t, p in batches], ['B/x/battery/512', 'B/x/system/0'])
+		self.assertEqual(json.loads(batches[0][1]), {'/Soc': 80.5, '/Dc/0/Voltage': None})
+		self.assertEqual(json.loads(batches[1][1]), {'/Serial': 'x'})
+
+	def test_keepalive_options(self):
+		options = outputs.KeepaliveOptions()
+		self.assertEqual(options.refresh(['batch'], 10), ['batch'])
+		self.assertEqual(options.refresh(['batch'], -1), [])
+		self.assertNotIn('batch', options)
+		self.assertEqual(options.refresh(['batch'], None), ['batch'])
+		self.assertIn('batch', options)
+
+class PublishQueueTest(unittest.TestCase):
+	def test_lanes(self):
+		q = publish_queue.PublishQueue()
+		q.put('a', 1, publish_queue.LANE_BULK)
+		q.put('b', 2)
+		q.put('c', 3, publish_queue.LANE_REPLY)
+		q.put('b', 4)
+		self.assertEqual(len(q), 3)
+		self.assertEqual(q.pop(), (publish_queue.LANE_REPLY, 'c', 3))
+		self.assertEqual(q.pop(), (publish_queue.LANE_CHANGE, 'b', 4))
+		self.assertEqual(q.pop(), (publish_queue.LANE_BULK, 'a', 1))
+		self.assertRaises(KeyError, q.pop)
+
+	def test_move_between_lanes(self):
+		q = publish_queue.PublishQueue()
+		q.put('a', 1, publish_queue.LANE_BULK)
+		q.put('a', 2, publish_queue.LANE_WRITE)
+		# A reply does not replace the retained message
+		q.put('a', 3, publish_queue.LANE_REPLY)
+		self.assertEqual(len(q), 2)
+		self.assertEqual(q.pop(), (publish_queue.LANE_REPLY, 'a', 3))
+		self.assertEqual(q.pop(), (publish_queue.LANE_WRITE, 'a', 2))
+		self.assertFalse(q)
+
+	def test_rate_limiter(self):
+		limiter = publish_queue.RateLimiter(messages=10, bytes=0, boost=4)
+		limiter.refill(0)
+		for _ in range(10):
+			self.assertEqual(limiter.wait(), 0)
+			limiter.consume(100)
+		self.assertGreater(limiter.wait(), 0)
+		self.assertLessEqual(limiter.wait(), 0.1)
+
+	def test_rate_limiter_backlog(self):
+		limiter = publish_queue.RateLimiter(messages=10, bytes=0, boost=4)
+		limiter.refill(1000)
+		self.assertEqual(limiter.factor, 4)
+		limiter.refill(20)
+		self.assertEqual(limiter.factor, 2)
+
+	def test_bytes(self):
+		limiter = publish_queue.RateLimiter(messages=0, bytes=1000)
+		limiter.refill(0)
+		limiter.consume(1500)
+		self.assertGreater(limiter.wait(), 0.4)
+
+	def test_spill_ring(self):
+		fd, path = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			ring = publish_queue.SpillRing(path, 3 * publish_queue.SpillRing.SLOT)
+			self.assertEqual(ring.push('N/x/battery/0/Soc', None), 0)
+			self.assertEqual(ring.push('N/x/keepalive', 1), 0)
+			self.assertEqual(ring.push('N/x/system/0/Serial', 'x'), 0)
+			# Full, the oldest is overwritten
+			self.assertEqual(ring.push('N/x/battery/0/Dc/0/V', None), 1)
+			# Too large for a slot
+			self.assertEqual(ring.push('N/x/y', 'z' * 300), 1)
+			self.assertEqual(len(ring), 3)
+			self.assertEqual(ring.pop_all(), [('N/x/keepalive', 1), ('N/x/system/0/Serial', 'x'),
+				('N/x/battery/0/Dc/0/V', None)])
+			self.assertEqual(len(ring), 0)
+			self.assertEqual(ring.pop_all(), [])
+		finally:
+			os.unlink(path)
+
+class FilterRulesTest(unittest.TestCase):
+	def test_match(self):
+		r = rules.FilterRules([rules.FilterRule('vebus', '/Ac/Out/*/P', deadband=5),
+			rules.FilterRule(path='/Dc/0/Current', min_interval=2)])
+		self.assertIs(r.state_for('vebus', '/Ac/Out/L1/P').rule, r.rules[0])
+		self.assertIs(r.state_for('battery', '/Dc/0/Current').rule, r.rules[1])
+		self.assertIsNone(r.state_for('battery', '/Soc'))
+
+	def test_same_globs_as_item_rules(self):
+		# * and ? run across the levels of a path, [ is not special
+		for service, pattern, service_type, path, matches in [
+				('vebus', '/Ac/*', 'vebus', '/Ac/Out/L1/P', True),
+				('vebus', '/Ac/?/P', 'vebus', '/Ac/1/P', True),
+				('vebus', '/Ac/[1]/P', 'vebus', '/Ac/1/P', False),
+				('vebus', '/Ac/[1]/P', 'vebus', '/Ac/[1]/P', True),
+				('bat*', '/Soc', 'battery', '/Soc', True),
+				('bat*', '/Soc', 'vebus', '/Soc', False)]:
+			f = rules.FilterRules([rules.FilterRule(service, pattern)])
+			i = rules.ItemRules([rules.ItemRule(False, service, path=pattern)])
+			self.assertEqual(f.state_for(service_type, path) is not None, matches, pattern)
+			self.assertEqual(not i.included(service_type, 0, path), matches, pattern)
+
+	def test_deadband(self):
+		f = rules.FilterState(rules.FilterRule(deadband=1, max_interval=10))
+		self.assertTrue(f.accept(10.0, 0))
+		self.assertFalse(f.accept(10.5, 1))
+		self.assertEqual(f.due, 10)
+		self.assertTrue(f.accept(11.5, 2))
+		self.assertIsNone(f.due)
+		self.assertTrue(f.accept(11.6, 12))
+
+	def test_relative_deadband(self):
+		f = rules.FilterState(rules.FilterRule(relative_deadband=0.1))
+		self.assertEqual(f.rule.max_interval, rules.DEFAULT_MAX_INTERVAL)
+		self.assertTrue(f.accept(100, 0))
+		self.assertFalse(f.accept(109, 1))
+		self.assertTrue(f.accept(111, 2))
+
+	def test_min_interval(self):
+		f = rules.FilterState(rules.FilterRule(min_interval=2))
+		self.assertTrue(f.accept('a', 0))
+		self.assertFalse(f.accept('b', 1))
+		self.assertEqual(f.due, 2)
+		# Back to what was published, nothing to flush
+		self.assertFalse(f.accept('a', 1.5))
+		self.assertIsNone(f.due)
+		self.assertTrue(f.accept('b', 2))
+
+	def test_unchanged(self):
+		f = rules.FilterState(rules.FilterRule())
+		self.assertTrue(f.accept(1, 0))
+		self.assertFalse(f.accept(1, 100))
+		self.assertTrue(f.accept(1.0, 100))
+
+class ItemRulesTest(unittest.TestCase):
+	def test_first_match(self):
+		r = rules.ItemRules([rules.ItemRule(True, 'vebus', path='/Devices/0/*'),
+			rules.ItemRule(False, 'vebus', path='/Devices/*'),
+			rules.ItemRule(False, 'modbusclient')])
+		self.assertTrue(r.included('vebus', 276, '/Devices/0/Version'))
+		self.assertFalse(r.included('vebus', 276, '/Devices/1/Version'))
+		self.assertTrue(r.included('vebus', 276, '/Ac/Out/L1/P'))
+		self.assertFalse(r.included('modbusclient', 0, '/Scan'))
+		self.assertTrue(r.included('battery', 512, '/Soc'))
+
+	def test_instance(self):
+		r = rules.ItemRules([rules.ItemRule(False, instance=512)])
+		self.assertFalse(r.included('battery', 512, '/Soc'))
+		# A pattern on one level does not run into the path
+		self.assertTrue(r.included('battery', 5120, '/Soc'))
+		self.assertTrue(r.excludes_service('battery', 512))
+		self.assertFalse(r.excludes_service('battery', 5120))
+
+	def test_excludes_service(self):
+		r = rules.ItemRules([rules.ItemRule(True, 'settings', path='/Settings/Vrmlogger/*'),
+			rules.ItemRule(False, 'settings')])
+		# Some items are still included
+		self.assertFalse(r.excludes_service('settings', 0))
+		self.assertFalse(r.included('settings', 0, '/Settings/System/TimeZone'))
+		self.assertFalse(rules.ItemRules().excludes_service('settings', 0))
+
+	def test_excludes_service_after_blocked(self):
+		# The blocked items come first, they must not hide the service rule
+		r = rules.ItemRules(dbus_mqtt.blocked_items + [rules.ItemRule(False, 'vebus'),
+			rules.ItemRule(False, 'paygo', instance=0)])
+		self.assertTrue(r.excludes_service('vebus', 276))
+		self.assertTrue(r.excludes_service('paygo', 0))
+		self.assertFalse(r.excludes_service('paygo', 1))
+		self.assertFalse(rules.ItemRules(dbus_mqtt.blocked_items).excludes_service('vebus', 276))
+
+class PathPatternsTest(unittest.TestCase):
+	def test_matches(self):
+		p = rules.PathPatterns([('vebus', '/Hub4/L*/AcPowerSetpoint')])
+		self.assertTrue(p.matches('vebus', '/Hub4/L1/AcPowerSetpoint'))
+		self.assertFalse(p.matches('vebus', '/Hub4/L1/AcPowerSetpointX'))
+		self.assertFalse(p.matches('vebus2', '/Hub4/L1/AcPowerSetpoint'))
+		self.assertFalse(p.matches('battery', '/Hub4/L1/AcPowerSetpoint'))
+
+class EncoderTest(unittest.TestCase):
+	""" encode_json must give the same bytes as unwrapping and json.dumps.
+	    The values are those of the test_dbus_unwrap_* cases, and a few
+	    more. """
+	values = [
+		dbus.Double(1.23, variant_level=1),
+		dbus.Byte(245, variant_level=1),
+		dbus.Int16(12, variant_level=1),
+		dbus.Int32(123, variant_level=1),
+		dbus.Int32(3323213, variant_level=1),
+		dbus.Int64(3323213, variant_level=1),
+		dbus.Int64(33232133232323, variant_level=1),
+		dbus.String('abcd', variant_level=1),
+		dbus.Array([dbus.Int32(3, variant_level=1), dbus.Int32(7, variant_level=1)], variant_level=1),
+		dbus.Array([], variant_level=1),
+		dbus.Dictionary({
+			dbus.String('a', variant_level=1): dbus.Double(3.2, variant_level=1),
+			dbus.String('b', variant_level=1): dbus.Double(3.7, variant_level=1)},
+			variant_level=1),
+		outputs.VeDbusInvalid,
+		dbus.Boolean(True, variant_level=1),
+		dbus.Boolean(False, variant_level=1),
+		dbus.UInt32(4000000000, variant_level=1),
+		dbus.Double(-0.0, variant_level=1),
+		dbus.Double(1e22, variant_level=1),
+		dbus.Double(float('nan'), variant_level=1),
+		dbus.Double(float('-inf'), variant_level=1),
+		dbus.String(u'\xe9t\xe9 "\\ \n', variant_level=1),
+		'd0ff500097c0',
+		1,
+	]
+
+	def test_same_as_json(self):
+		for value in self.values:
+			expected = json.dumps(dict(value=dbus_mqtt.unwrap_dbus_value(value)))
+			self.assertEqual(payload.encode_json(value), expected)
+
+	def test_round_trip(self):
+		for value in self.values:
+			decoded = json.loads(payload.encode_json(value))['value']
+			unwrapped = dbus_mqtt.unwrap_dbus_value(value)
+			if unwrapped == unwrapped:
+				self.assertEqual(decoded, unwrapped)
+
+	def test_cbor_round_trip(self):
+		for value in self.values:
+			decoded = payload.decode_cbor(payload.encode_cbor(value))
+			unwrapped = dbus_mqtt.unwrap_dbus_value(value)
+			if unwrapped == unwrapped:
+				self.assertEqual(decoded, unwrapped)
+
+	def test_cbor(self):
+		self.assertEqual(payload.encode_cbor(dbus.Int32(-500)), b'\x39\x01\xf3')
+		# Single precision when nothing is lost
+		self.assertEqual(payload.encode_cbor(dbus.Double(1.5)), b'\xfa\x3f\xc0\x00\x00')
+		self.assertEqual(len(payload.encode_cbor(dbus.Double(0.1))), 9)
+		# Beyond single precision range
+		for v in (1e39, -1e39):
+			data = payload.encode_cbor(dbus.Double(v))
+			self.assertEqual(data[:1], b'\xfb')
+			self.assertEqual(payload.decode_cbor(data), v)
+		# Invalid is undefined, not null
+		self.assertEqual(payload.encode_cbor(dbus.Array([], signature=dbus.Signature('i'))), b'\xf7')
+		self.assertEqual(payload.encode_cbor(None), b'\xf6')
+		value = dbus.Dictionary({'a': dbus.Array([dbus.Int32(1), dbus.Double(2.25)])})
+		self.assertEqual(payload.decode_cbor(payload.encode_cbor(value)), {'a': [1, 2.25]})
+
+	def test_ring_decode(self):
+		# What the egress process publishes is what the ingest process would
+		for value in self.values:
+			decoded = outputs._ring_decode(payload.encode_cbor(value))
+			self.assertEqual(payload.encode_json(decoded), payload.encode_json(value))
+
+	def test_decode_write(self):
+		self.assertEqual(payload.decode_write(b'{"value": 5}'), 5)
+		self.assertEqual(payload.decode_write(payload.encode_cbor({'value': 5})), 5)
+
+	def test_decode_bulk_write(self):
+		writes = {'settings/0/Settings/CGwacs/AcPowerSetPoint': -200, 'vebus/276/Mode': 3}
+		self.assertEqual(payload.decode_bulk_write(json.dumps(writes).encode()), writes)
+		self.assertEqual(payload.decode_bulk_write(payload.encode_cbor(writes)), writes)
+		# Major type 5 with a long count
+		writes = dict(('vebus/276/X{}'.format(i), i) for i in range(30))
+		self.assertEqual(payload.decode_bulk_write(payload.encode_cbor(writes)), writes)
+
+class StatsTest(unittest.TestCase):
+	def test_counters(self):
+		s = stats.Stats()
+		s.incr('queue/queued')
+		s.incr('queue/queued')
+		s.incr('publish/bytes', 40)
+		self.assertEqual(s.snapshot(), {'queue/queued': 2, 'publish/bytes': 40})
+
+	def test_histogram(self):
+		h = stats.Histogram()
+		for us in range(1, 101):
+			h.add(us / 1000000.0)
+		self.assertEqual(h.count, 100)
+		# Upper bounds of the power of two buckets, capped at the max
+		self.assertEqual(h.percentile(50), 64 / 1000000.0)
+		self.assertEqual(h.percentile(99), 100 / 1000000.0)
+		self.assertEqual(h.summary()['max'], 0.1)
+
+	def test_reset(self):
+		s = stats.Stats()
+		s.incr('mqtt/connects')
+		s.observe('queue/run', 0.002)
+		self.assertEqual(s.snapshot(reset=True)['queue/run']['count'], 1)
+		self.assertEqual(s.snapshot(), {'mqtt/connects': 1})
+
+class SignalTraceTest(unittest.TestCase):
+	def setUp(self):
+		fd, self.path = tempfile.mkstemp()
+		os.close(fd)
+		os.unlink(self.path)
+
+	def tearDown(self):
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+	def test_round_trip(self):
+		w = signal_trace.TraceWriter(self.path)
+		w.value('com.victronenergy.battery.ttyO1', '/Soc', dbus.Double(81.5, variant_level=1))
+		w.items('com.victronenergy.battery.ttyO1', {
+			'/Dc/0/Voltage': {'Value': dbus.Double(12.5, variant_level=1), 'Text': '12.5V'},
+			'/Alarms': {'Text': ''}})
+		w.owner('com.victronenergy.battery.ttyO1', ':1.2', '')
+		w.request('R/d0ff500097c0/keepalive', b'')
+		w.close()
+		# Appending to an existing trace
+		w = signal_trace.TraceWriter(self.path)
+		w.value('com.victronenergy.system', '/Relay/0/State', outputs.VeDbusInvalid)
+		w.close()
+
+		events = [(kind, data) for _, kind, data in signal_trace.read_trace(self.path)]
+		self.assertEqual(events, [
+			(signal_trace.VALUE, ('com.victronenergy.battery.ttyO1', '/Soc', 81.5)),
+			(signal_trace.ITEMS, ('com.victronenergy.battery.ttyO1', {'/Dc/0/Voltage': 12.5})),
+			(signal_trace.OWNER, ('com.victronenergy.battery.ttyO1', ':1.2', '')),
+			(signal_trace.REQUEST, ('R/d0ff500097c0/keepalive', b'')),
+			(signal_trace.VALUE, ('com.victronenergy.system', '/Relay/0/State', None))])
+
+	def test_truncated(self):
+		w = signal_trace.TraceWriter(self.path)
+		for i in range(3):
+			w.value('com.victronenergy.battery.ttyO1', '/Soc', dbus.Int32(i, variant_level=1))
+		w.close()
+		with open(self.path, 'r+b') as f:
+			f.truncate(os.path.getsize(self.path) - 2)
+		self.assertEqual(len(list(signal_trace.read_trace(self.path))), 2)
+
+	def test_plain(self):
+		value = signal_trace.plain(dbus.Dictionary({
+			dbus.String('a'): dbus.Array([dbus.Int32(1), dbus.Boolean(True)])}, variant_level=1))
+		self.assertEqual(value, {'a': [1, True]})
+		self.assertIs(type(value['a'][1]), bool)
+
+class CatalogueTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'catalogue.json')
+
+	def tearDown(self):
+		for name in os.listdir(self.dir):
+			os.unlink(os.path.join(self.dir, name))
+		os.rmdir(self.dir)
+
+	def test_round_trip(self):
+		c = catalogue.Catalogue(self.path)
+		c.put('com.victronenergy.vebus.ttyO1', ['mk2-dbus', 'v3.1', 9763], 276,
+			{'/Mgmt/ProcessName': 'mk2-dbus', '/Soc': 81.5, '/Relay/0': None}, introspected=True)
+		c.save()
+		self.assertEqual(os.listdir(self.dir), ['catalogue.json'])
+
+		c = catalogue.Catalogue(self.path).load()
+		entry = c.get('com.victronenergy.vebus.ttyO1')
+		self.assertEqual(entry['items'], {'/Mgmt/ProcessName': 'mk2-dbus', '/Soc': 81.5, '/Relay/0': None})
+		self.assertTrue(entry['introspected'])
+		self.assertTrue(c.matches(entry, ('mk2-dbus', 'v3.1', 9763), 276))
+		self.assertFalse(c.matches(entry, ('mk2-dbus', 'v3.2', 9763), 276))
+		self.assertFalse(c.matches(entry, ('mk2-dbus', 'v3.1', 9763), 0))
+		self.assertIsNone(c.get('com.victronenergy.system'))
+
+	def test_missing(self):
+		c = catalogue.Catalogue(self.path).load()
+		self.assertEqual(c.services, {})
+
+	def test_prune(self):
+		c = catalogue.Catalogue(self.path)
+		c.put('com.victronenergy.battery.ttyO1', ['dbus-battery', '1.0', None], 512, {})
+		c.put('com.victronenergy.battery.ttyO2', ['dbus-battery', '1.0', None], 513, {})
+		c.services['com.victronenergy.battery.ttyO2']['seen'] -= catalogue.MAX_AGE + 1
+		c.save()
+		self.assertEqual(list(catalogue.Catalogue(self.path).load().services), ['com.victronenergy.battery.ttyO1'])
+
+class RingTest(unittest.TestCase):
+	def ring(self, size):
+		""" Both ends in this process. """
+		buf = mmap.mmap(-1, size)
+		filled = os.pipe()
+		read = os.pipe()
+		self.fds = filled + read
+		return shm_ring.RingWriter(buf, size, filled[1], read[0]), shm_ring.RingReader(buf, size, filled[0], read[1])
+
+	def tearDown(self):
+		for fd in self.fds:
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+	def test_wrap(self):
+		writer, reader = self.ring(64)
+		records = [bytes([i]) * (i % 7 + 1) for i in range(100)]
+		received = []
+		for i in range(0, len(records), 3):
+			for record in records[i:i + 3]:
+				self.assertTrue(writer.put(record))
+			self.assertTrue(writer.commit())
+			received.extend(reader.read())
+		self.assertEqual(received, records)
+
+	def test_overflow(self):
+		writer, reader = self.ring(64)
+		records = [bytes([i]) * 10 for i in range(10)]
+		for record in records:
+			writer.put(record)
+		self.assertFalse(writer.commit())
+		self.assertEqual(writer.overflow, 6)
+		received = reader.read()
+		self.assertEqual(received, records[:4])
+		# Records are not committed before those kept
+		self.assertFalse(writer.put(b'x'))
+		while writer.overflow:
+			writer.commit()
+			received.extend(reader.read())
+		self.assertEqual(received, records + [b'x'])
+		self.assertRaises(ValueError, writer.append, b'x' * 40)
+
+	def test_too_big(self):
+		writer, reader = self.ring(64)
+		records = [b'a' * 20, b'b' * 20, b'c' * 20]
+		for record in records:
+			writer.put(record)
+		self.assertEqual(writer.overflow, 1)
+		# Not kept, it would hold up the records after it
+		self.assertRaises(ValueError, writer.put, b'x' * 29)
+		self.assertEqual(writer.overflow, 1)
+		received = []
+		while writer.overflow or not received:
+			writer.commit()
+			received.extend(reader.read())
+		self.assertEqual(received, records)
+
+	def test_closed(self):
+		writer, reader = self.ring(64)
+		writer.put(b'last')
+		writer.commit()
+		os.close(self.fds[1])
+		self.assertEqual(reader.read(), [b'last'])
+		self.assertRaises(EOFError, reader.read)
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+""" Stand-ins for the D-Bus connection and the paho client, so that DbusMqtt
+    can be driven in-process, without a bus or a broker. Used by the
+    benchmarks. """
+import os
+import socket
+import sys
+from time import monotonic, sleep
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus.exceptions
+import paho.mqtt.client
+from gi.repository import GLib
+
+SERVICE_TYPES = ('battery', 'solarcharger', 'vebus', 'tank', 'temperature', 'grid', 'pvinverter')
+
+
+def unknown_object(path):
+	return dbus.exceptions.DBusException('Unknown object: {}'.format(path),
+		name='org.freedesktop.DBus.Error.UnknownObject')
+
+
+def unknown_method(method):
+	return dbus.exceptions.DBusException('Unknown method: {}'.format(method),
+		name='org.freedesktop.DBus.Error.UnknownMethod')
+
+
+class FakeService(object):
+	""" A service that exports its items like vedbus does: GetValue and
+	    GetItems on the root, GetValue and SetValue on each item. Without
+	    listing, it behaves like an old service that can only be
+	    introspected. """
+	def __init__(self, name, owner, values, listing=True):
+		self.name = name
+		self.owner = owner
+		# Key: path, value: D-Bus value
+		self.values = values
+		self.listing = listing
+
+	def introspect(self, path):
+		if path in self.values:
+			return '<node><interface name="com.victronenergy.BusItem"/></node>'
+		prefix = path.rstrip('/') + '/'
+		children = sorted(set(p[len(prefix):].split('/')[0] for p in self.values if p.startswith(prefix)))
+		if not children:
+			raise unknown_object(path)
+		return '<node>{}</node>'.format(''.join('<node name="{}"/>'.format(c) for c in children))
+
+	def call(self, path, method, args):
+		if method == 'Introspect':
+			return self.introspect(path)
+		if path == '/' and not self.listing:
+			raise unknown_method(method)
+		if path == '/':
+			if method == 'GetItems':
+				return dbus.Dictionary({p: dbus.Dictionary({'Value': v, 'Text': dbus.String(v)})
+					for p, v in self.values.items()}, signature='sa{sv}')
+			if method == 'GetValue':
+				return dbus.Dictionary({p[1:]: v for p, v in self.values.items()}, signature='sv')
+		if path not in self.values:
+			raise unknown_object(path)
+		if method == 'GetValue':
+			return self.values[path]
+		if method == 'SetValue':
+			self.values[path] = args[0]
+			return dbus.Int32(0)
+		raise unknown_object(path)
+
+
+class FakeBus(object):
+	""" Takes the place of the D-Bus connection of DbusMqtt. Asynchronous
+	    calls are answered from the main loop, signals are delivered when
+	    emit_* is called. """
+	def __init__(self, latency=0):
+		# Key: service name, value: FakeService
+		self.services = {}
+		# Key: signal name, value: list of (handler, keywords)
+		self.receivers = {}
+		# Seconds each call takes
+		self.latency = latency
+		self.calls = 0
+		self._owners = 0
+
+	@classmethod
+	def synthetic(cls, paths, items_per_service=100):
+		""" A bus with paths items in total, spread over services of
+		    items_per_service items each. """
+		bus = cls()
+		n = 0
+		i = 0
+		while n < paths:
+			count = min(items_per_service, paths - n)
+			values = {'/Path/{}'.format(j): dbus.Double(j * 0.5, variant_level=1) for j in range(count)}
+			bus.add_service('com.victronenergy.{}.bench{}'.format(SERVICE_TYPES[i % len(SERVICE_TYPES)], i),
+				values, device_instance=256 + i)
+			n += count
+			i += 1
+		return bus
+
+	def add_service(self, name, values, device_instance=0, listing=True):
+		self._owners += 1
+		values = dict(values)
+		values.setdefault('/DeviceInstance', dbus.Int32(device_instance, variant_level=1))
+		service = self.services[name] = FakeService(name, ':1.{}'.format(self._owners), values, listing)
+		for handler, _ in self.receivers.get('NameOwnerChanged', ()):
+			handler(name, '', service.owner)
+		return service
+
+	def remove_service(self, name):
+		service = self.services.pop(name)
+		for handler, _ in self.receivers.get('NameOwnerChanged', ()):
+			handler(name, service.owner, '')
+
+	def list_names(self):
+		return list(self.services)
+
+	def get_name_owner(self, name):
+		return self.services[name].owner
+
+	def add_signal_receiver(self, handler, signal_name=None, **kwargs):
+		self.receivers.setdefault(signal_name, []).append((handler, kwargs))
+
+	def call_blocking(self, service, path, interface, method, signature, args, **kwargs):
+		self.calls += 1
+		if self.latency:
+			sleep(self.latency)
+		return self._call(service, path, method, args)
+
+	def _call(self, service, path, method, args):
+		try:
+			s = self.services[service]
+		except KeyError:
+			raise dbus.exceptions.DBusException('Unknown service: {}'.format(service),
+				name='org.freedesktop.DBus.Error.ServiceUnknown')
+		return s.call(path, method, args)
+
+	def call_async(self, service, path, interface, method, signature, args, reply_handler,
+			error_handler, **kwargs):
+		def reply():
+			try:
+				result = self._call(service, path, method, args)
+			except dbus.exceptions.DBusException as e:
+				error_handler(e)
+			else:
+				reply_handler(result)
+			return False
+		self.calls += 1
+		if self.latency:
+			GLib.timeout_add(max(1, int(self.latency * 1000)), reply)
+		else:
+			GLib.idle_add(reply)
+
+	def emit_value(self, service, path, value):
+		""" PropertiesChanged for one item. """
+		s = self.services[service]
+		s.values[path] = value
+		for handler, kw in self.receivers.get('PropertiesChanged', ()):
+			handler({'Value': value, 'Text': dbus.String(value)},
+				**{kw['path_keyword']: path, kw['sender_keyword']: s.owner})
+
+	def emit_items(self, service, values):
+		""" ItemsChanged for several items of one service. """
+		s = self.services[service]
+		s.values.update(values)
+		changes = {p: {'Value': v, 'Text': dbus.String(v)} for p, v in values.items()}
+		for handler, kw in self.receivers.get('ItemsChanged', ()):
+			handler(changes, **{kw['sender_keyword']: s.owner})
+
+
+class Message(object):
+	def __init__(self, topic, payload, retain=False):
+		self.topic = topic
+		self.payload = payload
+		self.retain = retain
+
+
+class CaptureClient(object):
+	""" Takes the place of paho.mqtt.client.Client. The connection is
+	    accepted from the main loop, and published messages are kept in
+	    published as (time, topic, payload, retain), or passed to
+	    on_publish if it is set. """
+	def __init__(self, client_id='', clean_session=True, **kwargs):
+		self.on_connect = self.on_message = self.on_disconnect = self.on_log = None
+		self.on_subscribe = self.on_publish = None
+		self.published = []
+		self.subscribed = []
+		# The bridge watches the socket, this one never becomes readable
+		self._socket, self._peer = socket.socketpair()
+
+	def connect(self, host, port=1883, keepalive=60):
+		GLib.idle_add(self._connack)
+		return 0
+
+	def reconnect(self):
+		return self.connect(None)
+
+	def _connack(self):
+		self.on_connect(self, None, {'session present': 0}, 0)
+		return False
+
+	def deliver(self, topic, payload, retain=False):
+		""" A message from the broker, eg. a keepalive. """
+		self.on_message(self, None, Message(topic, payload, retain))
+
+	def publish(self, topic, payload=None, qos=0, retain=False):
+		if self.on_publish is not None:
+			self.on_publish(topic, payload, retain)
+		else:
+			self.published.append((monotonic(), topic, payload, retain))
+
+	def subscribe(self, topic, qos=0):
+		self.subscribed.append(topic)
+		mid = len(self.subscribed)
+		if self.on_subscribe is not None:
+			GLib.idle_add(self._suback, mid, qos)
+		return (paho.mqtt.client.MQTT_ERR_SUCCESS, mid)
+
+	def _suback(self, mid, qos):
+		self.on_subscribe(self, None, mid, (qos,))
+		return False
+
+	def unsubscribe(self, topic):
+		if topic in self.subscribed:
+			self.subscribed.remove(topic)
+		return (paho.mqtt.client.MQTT_ERR_SUCCESS, len(self.subscribed))
+
+	def socket(self):
+		return self._socket
+
+	def username_pw_set(self, username, password=None):
+		pass
+
+	def tls_set(self, *args, **kwargs):
+		pass
+
+	def want_write(self):
+		return False
+
+	def loop_read(self):
+		return paho.mqtt.client.MQTT_ERR_SUCCESS
+
+	def loop_write(self, max_packets=1):
+		return paho.mqtt.client.MQTT_ERR_SUCCESS
+
+	def loop_misc(self):
+		return paho.mqtt.client.MQTT_ERR_SUCCESS
+
+
+def install(bus):
+	""" Make DbusMqtt use bus, and CaptureClient instead of paho. """
+	dbus.SystemBus = dbus.SessionBus = lambda: bus
+	paho.mqtt.client.Client = CaptureClient
+
+
+def drain():
+	""" Run the main loop until nothing is left to do right now. """
+	context = GLib.MainContext.default()
+	while context.pending():
+		context.iteration(False)
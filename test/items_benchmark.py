@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+""" Memory use and cost per value change of the item table, for 50k items.
+    Compares the per-item Item records with the three parallel tables
+    (_topics, _values and a set of PublishedTopic) used before. The item
+    table is built by DbusMqtt on the fake D-Bus of replay_benchmark.py,
+    the memory of the bus itself is not counted. """
+import os
+import sys
+import timeit
+import tracemalloc
+from collections import OrderedDict
+from itertools import cycle
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+import fake_dbus
+from fake_dbus import FakeBus, drain
+
+N = 50000
+PORTAL = 'd0ff500097c0'
+
+
+class PublishedTopic(object):
+	""" The previous topic wrapper, with its cached short topic. """
+	def __init__(self, fulltopic):
+		self.fulltopic = fulltopic
+		self._short = None
+	@property
+	def shorttopic(self):
+		if self._short is None:
+			self._short = tuple(self.fulltopic.split('/')[2:])
+		return self._short
+	def __eq__(self, other):
+		return isinstance(other, PublishedTopic) and self.fulltopic == other.fulltopic
+	def __hash__(self):
+		return hash(self.fulltopic)
+
+
+class OldTables(object):
+	def __init__(self, paths):
+		self._topics = {}
+		self._values = {}
+		self._published = set()
+		self.queue = OrderedDict()
+		for service, path, di in paths:
+			self._topics[service + path] = topic = 'N/{}/{}/{}{}'.format(
+				PORTAL, dbus_mqtt.get_service_type(service), di, path)
+			self._values[topic] = dbus.Double(0.0)
+			pt = PublishedTopic(topic)
+			pt.shorttopic
+			self._published.add(pt)
+
+	def clear(self):
+		self.queue.clear()
+
+	def value_changed(self, service, path, value):
+		topic = self._topics.get(service + path)
+		self._values[topic] = value
+		pt = PublishedTopic(topic)
+		if pt in self._published:
+			self.queue[topic] = value
+
+
+class NewTables(object):
+	""" DbusMqtt on the fake D-Bus, with everything subscribed. The queue
+	    is not run while measuring. """
+	def __init__(self, paths):
+		self.mqtt = dbus_mqtt.DbusMqtt()
+		drain()
+		output = self.mqtt._outputs[0]
+		output._client.deliver('R/{}/keepalive'.format(self.mqtt._system_id), b'')
+		drain()
+		self._output = output
+		self.value_changed = self.mqtt._value_changed_inner
+
+	def clear(self):
+		self._output.queue.clear()
+		self._output._dirty.clear()
+
+
+def make_bus(paths):
+	bus = FakeBus()
+	values = {}
+	for service, path, di in paths:
+		values.setdefault((service, di), {})[path] = dbus.Double(0.0, variant_level=1)
+	for (service, di), v in values.items():
+		bus.add_service(service, v, device_instance=di)
+	fake_dbus.install(bus)
+	return bus
+
+
+def make_paths():
+	paths = []
+	for i in range(N):
+		service = 'com.victronenergy.battery.tty{}'.format(i // 500)
+		paths.append((service, '/Cell/{}/Voltage'.format(i % 500), i // 500))
+	return paths
+
+
+def measure(cls, paths):
+	make_bus(paths)
+	tracemalloc.start()
+	tables = cls(paths)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	# Alternate, so that every call is a real change
+	values = cycle([dbus.Double(3.3), dbus.Double(4.4)])
+	changes = paths[::10]
+	change = tables.value_changed
+	def run():
+		value = next(values)
+		for service, path, di in changes:
+			change(service, path, value)
+		# Pretend the queue was sent
+		tables.clear()
+	elapsed = min(timeit.repeat(run, number=1, repeat=5))
+	return size, elapsed / len(changes) * 1e6
+
+
+def main():
+	paths = make_paths()
+	print('{:>6} {:>12} {:>16}'.format('', 'memory (MB)', 'change (us/op)'))
+	for name, cls in (('before', OldTables), ('after', NewTables)):
+		size, per_change = measure(cls, paths)
+		print('{:>6} {:>12.1f} {:>16.2f}'.format(name, size / 1e6, per_change))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+""" What lazy mode saves on an idle system, one that nobody subscribes to:
+    the time to start up, the memory held afterwards, and the time spent
+    on the D-Bus signals the services keep sending. Then the same after a
+    client subscribed to one service. Uses the fake D-Bus of
+    replay_benchmark.py. """
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+from time import process_time
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+import fake_dbus
+from fake_dbus import FakeBus, drain
+
+
+def run(paths, signals, lazy, async_scan):
+	bus = FakeBus.synthetic(paths)
+	fake_dbus.install(bus)
+	gc.collect()
+	tracemalloc.start()
+	started = process_time()
+	m = dbus_mqtt.DbusMqtt(lazy=lazy, async_scan=async_scan)
+	drain()
+	startup = process_time() - started
+	memory = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	rnd = random.Random(1)
+	services = sorted(bus.services)
+	changes = [(rnd.choice(services), '/Path/{}'.format(rnd.randrange(100)),
+		dbus.Double(rnd.random(), variant_level=1)) for _ in range(signals)]
+	started = process_time()
+	for service, path, value in changes:
+		bus.emit_value(service, path, value)
+	drain()
+	idle = (process_time() - started) / signals * 1e6
+
+	m._outputs[0]._client.deliver('R/{}/keepalive'.format(m._system_id),
+		'["{}/#"]'.format(sorted(m._services)[0]).encode())
+	drain()
+	return startup * 1000, memory / 1e6, idle, len(m._items)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Cost of an idle system with and without lazy mode')
+	parser.add_argument('--paths', default='1000,10000,100000',
+		help='comma separated numbers of paths on the bus')
+	parser.add_argument('--signals', default=20000, type=int, help='value changes sent while idle')
+	parser.add_argument('--async-scan', action='store_true')
+	args = parser.parse_args()
+
+	print('{:>8} {:>6} {:>14} {:>13} {:>18} {:>18}'.format('paths', 'mode', 'startup (ms)', 'memory (MB)',
+		'per signal (us)', 'items subscribed'))
+	for paths in (int(p) for p in args.paths.split(',')):
+		for lazy in (False, True):
+			startup, memory, idle, items = run(paths, args.signals, lazy, args.async_scan)
+			print('{:>8} {:>6} {:>14.1f} {:>13.2f} {:>18.2f} {:>18}'.format(paths, 'lazy' if lazy else 'eager',
+				startup, memory, idle, items))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+""" Compare encoding values with unwrap_dbus_value and json.dumps against
+    payload.encode_json, for the value types found on a typical system. """
+import json
+import os
+import sys
+import timeit
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+import payload
+
+
+def make_values(n):
+	kinds = [
+		lambda i: dbus.Double(i * 0.37, variant_level=1),
+		lambda i: dbus.Int32(i, variant_level=1),
+		lambda i: dbus.String('value {}'.format(i), variant_level=1),
+		lambda i: dbus.Array([], signature=dbus.Signature('i'), variant_level=1),
+		lambda i: dbus.Boolean(i & 1, variant_level=1),
+		lambda i: dbus.Double(i * 1.5, variant_level=1),
+		lambda i: dbus.Int32(i * 3, variant_level=1),
+		lambda i: dbus.Byte(i & 0xff, variant_level=1),
+	]
+	return [kinds[i % len(kinds)](i) for i in range(n)]
+
+
+def unwrap_dumps(values):
+	return [json.dumps(dict(value=dbus_mqtt.unwrap_dbus_value(v))) for v in values]
+
+
+def encode_json(values):
+	encode = payload.encode_json
+	return [encode(v) for v in values]
+
+
+def main():
+	values = make_values(10000)
+	assert unwrap_dumps(values) == encode_json(values)
+	print('{:>14} {:>14}'.format('encoder', 'values/s'))
+	for name, encode in (('unwrap+dumps', unwrap_dumps), ('encode_json', encode_json)):
+		elapsed = min(timeit.repeat(lambda: encode(values), number=1, repeat=5))
+		print('{:>14} {:>14.0f}'.format(name, len(values) / elapsed))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+""" What a dashboard that reads everything at startup costs: one R/ per
+    path against one wildcard R/ per service, each with and without the
+    value cache. Every D-Bus call takes --latency seconds, as a round trip
+    to a busy service would. Uses the fake D-Bus of replay_benchmark.py. """
+import argparse
+import os
+import sys
+from time import monotonic
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus_mqtt
+import fake_dbus
+from fake_dbus import FakeBus, drain
+
+
+def run(services, items, latency, read_max_age, wildcard):
+	bus = FakeBus.synthetic(services * items, items)
+	fake_dbus.install(bus)
+	m = dbus_mqtt.DbusMqtt(read_max_age=read_max_age)
+	drain()
+	client = m._outputs[0]._client
+	if wildcard:
+		topics = ['R/{}/{}/#'.format(m._system_id, s) for s in sorted(m._services)]
+	else:
+		topics = ['R/' + item.fulltopic[2:] for item in m._items.values()]
+
+	bus.latency = latency
+	calls = bus.calls
+	client.published.clear()
+	started = monotonic()
+	for topic in topics:
+		client.deliver(topic, b'')
+	drain()
+	return len(topics), bus.calls - calls, len(client.published), (monotonic() - started) * 1000
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Cost of reading everything with R/')
+	parser.add_argument('--services', default=5, type=int)
+	parser.add_argument('--items', default=100, type=int, help='items per service')
+	parser.add_argument('--latency', default=0.001, type=float, help='seconds per D-Bus call')
+	args = parser.parse_args()
+
+	print('{:>10} {:>6} {:>10} {:>12} {:>10} {:>10}'.format('reads', 'cache', 'requests', 'D-Bus calls',
+		'replies', 'time (ms)'))
+	for wildcard in (False, True):
+		for read_max_age in (0, 60):
+			requests, calls, replies, elapsed = run(args.services, args.items, args.latency, read_max_age,
+				wildcard)
+			print('{:>10} {:>6} {:>10} {:>12} {:>10} {:>10.1f}'.format('wildcard' if wildcard else 'per path',
+				'yes' if read_max_age else 'no', requests, calls, replies, elapsed))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+""" Drive DbusMqtt in-process against a fake D-Bus (fake_dbus.FakeBus) and a
+    captured MQTT client, and report for a range of sizes:
+
+    - scan: start up and scan all services, in ms
+    - first: publish everything after the first keepalive, in ms
+    - all: _publish_all after the broker lost everything, in ms
+    - memory: memory allocated by DbusMqtt, in MB
+    - throughput: value changes published per second
+    - p50/p90/p99: latency from PropertiesChanged to publish, in ms
+
+    With --trace, a recorded trace is replayed instead of random changes. A
+    trace is either recorded with dbus_mqtt.py --record, or has one JSON
+    object per line, such as {"t": 0.25, "service":
+    "com.victronenergy.battery.ttyO1", "path": "/Soc", "value": 81.5},
+    with t in seconds since the start. """
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+from time import monotonic, sleep
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+import fake_dbus
+import signal_trace
+from signal_trace import VALUE, ITEMS, OWNER, REQUEST
+from fake_dbus import FakeBus, drain
+
+
+def start(bus, args):
+	fake_dbus.install(bus)
+	m = dbus_mqtt.DbusMqtt(async_scan=args.async_scan, async_requests=args.async_requests)
+	drain()
+	return m
+
+
+def subscribe(m):
+	m._outputs[0]._client.deliver('R/{}/keepalive'.format(m._system_id), b'')
+	drain()
+
+
+def targets(m):
+	""" (service, path, topic) of all items. """
+	r = []
+	for uid, item in m._items.items():
+		service, path = uid.split('/', 1)
+		r.append((service, '/' + path, item.fulltopic))
+	return r
+
+
+def measure_memory(bus, args):
+	gc.collect()
+	tracemalloc.start()
+	m = start(bus, args)
+	subscribe(m)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return size
+
+
+class Latency(object):
+	""" Tracks when a topic was first changed since it was last published,
+	    and counts what is published. """
+	def __init__(self, m):
+		self.pending = {}
+		self.latencies = []
+		self.published = 0
+		m._outputs[0]._client.on_publish = self.on_publish
+
+	def changed(self, topic):
+		self.pending.setdefault(topic, monotonic())
+
+	def on_publish(self, topic, payload, retain):
+		self.published += 1
+		t = self.pending.pop(topic, None)
+		if t is not None:
+			self.latencies.append(monotonic() - t)
+
+	def percentile(self, p):
+		if not self.latencies:
+			return float('nan')
+		l = sorted(self.latencies)
+		return l[min(len(l) - 1, int(len(l) * p / 100))] * 1000
+
+
+def random_changes(bus, m, rate, duration, tick=0.01):
+	latency = Latency(m)
+	items = targets(m)
+	rnd = random.Random(1)
+	changes = 0
+	started = monotonic()
+	while True:
+		now = monotonic()
+		if now - started >= duration:
+			break
+		due = int((now - started) * rate) - changes
+		for _ in range(due):
+			service, path, topic = items[rnd.randrange(len(items))]
+			latency.changed(topic)
+			bus.emit_value(service, path, dbus.Double(rnd.random(), variant_level=1))
+		changes += due
+		drain()
+		sleep(max(0, tick - (monotonic() - now)))
+	drain()
+	return latency, monotonic() - started
+
+
+def load_trace(path):
+	""" Returns a list of (t, kind, data) as in signal_trace, with t in
+	    seconds since the first event. """
+	if signal_trace.is_trace(path):
+		events = list(signal_trace.read_trace(path))
+	else:
+		with open(path) as f:
+			events = [json.loads(l) for l in f if l.strip()]
+		events = [(e['t'], VALUE, (e['service'], e['path'], e['value'])) for e in events]
+		events.sort(key=lambda e: e[0])
+	if not events:
+		return events
+	first = events[0][0]
+	return [(t - first, kind, data) for t, kind, data in events]
+
+
+def trace_values(events):
+	""" Key: service, value: {path: value}. """
+	services = {}
+	for _, kind, data in events:
+		if kind == VALUE:
+			values = services.setdefault(data[0], {})
+			values.setdefault(data[1], dbus_mqtt.wrap_dbus_value(data[2]))
+		elif kind == ITEMS:
+			values = services.setdefault(data[0], {})
+			for path, value in data[1].items():
+				values.setdefault(path, dbus_mqtt.wrap_dbus_value(value))
+	return services
+
+
+def trace_bus(events):
+	""" A bus with the services and paths found in the trace, starting at
+	    their first value. """
+	bus = FakeBus()
+	for i, (name, values) in enumerate(sorted(trace_values(events).items())):
+		bus.add_service(name, values, device_instance=256 + i)
+	return bus
+
+
+def replay(bus, m, events, speed):
+	latency = Latency(m)
+	topics = {uid: item.fulltopic for uid, item in m._items.items()}
+	# Services that went away, so that they can come back
+	gone = {}
+	started = monotonic()
+	for t, kind, data in events:
+		if speed > 0 and started + t / speed > monotonic():
+			drain()
+			sleep(max(0, started + t / speed - monotonic()))
+		if kind == VALUE:
+			service, path, value = data
+			if service not in bus.services:
+				continue
+			topic = topics.get(service + path)
+			if topic is not None:
+				latency.changed(topic)
+			bus.emit_value(service, path, dbus_mqtt.wrap_dbus_value(value))
+		elif kind == ITEMS:
+			service, values = data
+			if service not in bus.services:
+				continue
+			for path in values:
+				topic = topics.get(service + path)
+				if topic is not None:
+					latency.changed(topic)
+			bus.emit_items(service, {p: dbus_mqtt.wrap_dbus_value(v) for p, v in values.items()})
+		elif kind == OWNER:
+			name, oldowner, newowner = data
+			if newowner == '' and name in bus.services:
+				gone[name] = bus.services[name].values
+				bus.remove_service(name)
+			elif newowner != '' and name in gone:
+				bus.add_service(name, gone.pop(name))
+				drain()
+				topics = {uid: item.fulltopic for uid, item in m._items.items()}
+		elif kind == REQUEST:
+			# Requests are for the portal id of the recording system
+			topic, payload = data
+			levels = topic.split('/', 2)
+			if len(levels) == 3:
+				levels[1] = m._system_id
+			m._outputs[0]._client.deliver('/'.join(levels), payload)
+	drain()
+	return latency, monotonic() - started
+
+
+def run(make_bus, paths, args, changes):
+	memory = measure_memory(make_bus(), args)
+
+	bus = make_bus()
+	started = monotonic()
+	m = start(bus, args)
+	scan = monotonic() - started
+
+	started = monotonic()
+	subscribe(m)
+	first = monotonic() - started
+
+	for output in m._outputs:
+		output._sent.clear()
+	started = monotonic()
+	m._publish_all()
+	drain()
+	republish = monotonic() - started
+
+	latency, elapsed = changes(bus, m)
+	print('{:>8} {:>9.0f} {:>9.0f} {:>9.0f} {:>9.1f} {:>11.0f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+		paths, scan * 1000, first * 1000, republish * 1000, memory / 1e6,
+		latency.published / elapsed, latency.percentile(50), latency.percentile(90),
+		latency.percentile(99)))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark DbusMqtt against a fake D-Bus')
+	parser.add_argument('--paths', default='10,100,1000,10000,100000',
+		help='comma separated numbers of paths to run with')
+	parser.add_argument('--items-per-service', default=100, type=int)
+	parser.add_argument('--rate', default=1000, type=float, help='value changes per second')
+	parser.add_argument('--duration', default=2, type=float, help='seconds of value changes per size')
+	parser.add_argument('--trace', default=None, help='replay this trace instead of random changes')
+	parser.add_argument('--speed', default=1, type=float, help='replay the trace this many times faster, 0 for as fast as possible')
+	parser.add_argument('--async-scan', action='store_true')
+	parser.add_argument('--async-requests', action='store_true')
+	args = parser.parse_args()
+
+	print('{:>8} {:>9} {:>9} {:>9} {:>9} {:>11} {:>8} {:>8} {:>8}'.format(
+		'paths', 'scan', 'first', 'all', 'memory', 'throughput', 'p50', 'p90', 'p99'))
+	if args.trace is not None:
+		events = load_trace(args.trace)
+		paths = sum(len(values) for values in trace_values(events).values())
+		run(lambda: trace_bus(events), paths, args,
+			lambda bus, m: replay(bus, m, events, args.speed))
+		return
+
+	for paths in (int(p) for p in args.paths.split(',')):
+		run(lambda: FakeBus.synthetic(paths, args.items_per_service), paths, args,
+			lambda bus, m: random_changes(bus, m, args.rate, args.duration))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+""" Microbenchmark for Subscriptions.match. Compares the trie against a flat
+    list of filters, as used before, at 10, 100 and 1000 keepalive filters. """
+import os
+import random
+import sys
+import timeit
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import outputs
+
+
+class ListSubscriptions(object):
+	""" The previous implementation: every filter is tried in turn. """
+	def __init__(self):
+		self.topics = []
+
+	def subscribe(self, topic):
+		levels = topic.split('/')
+		self.topics.append(outputs.Topic(levels, 60) if '+' in topic or '#' in topic \
+			else outputs.ExactTopic(levels, 60))
+
+	def match(self, t):
+		return any(topic.match(t) for topic in self.topics)
+
+
+def make_filters(n, rnd):
+	filters = []
+	for i in range(n):
+		kind = rnd.random()
+		if kind < 0.7:
+			filters.append('battery/{}/Dc/0/{}'.format(i, rnd.choice(['Voltage', 'Current', 'Power'])))
+		elif kind < 0.9:
+			filters.append('solarcharger/+/Pv/{}/V'.format(i))
+		else:
+			filters.append('vebus/{}/#'.format(i))
+	return filters
+
+
+def make_topics(n, rnd):
+	services = ['battery', 'solarcharger', 'vebus', 'system', 'settings']
+	paths = [('Dc', '0', 'Voltage'), ('Dc', '0', 'Current'), ('Pv', '3', 'V'),
+		('Ac', 'Out', 'L1', 'P'), ('Settings', 'CGwacs', 'BatteryLife', 'MinimumSocLimit')]
+	return [(rnd.choice(services), str(rnd.randrange(300))) + rnd.choice(paths) for _ in range(n)]
+
+
+def main():
+	rnd = random.Random(1)
+	topics = make_topics(10000, rnd)
+	print('{:>8} {:>14} {:>14}'.format('filters', 'list (us/op)', 'trie (us/op)'))
+	for n in (10, 100, 1000):
+		filters = make_filters(n, rnd)
+		old = ListSubscriptions()
+		new = outputs.Subscriptions()
+		for f in filters:
+			old.subscribe(f)
+			new.subscribe(f)
+		assert [old.match(t) for t in topics] == [new.match(t) for t in topics]
+
+		results = []
+		for s in (old, new):
+			match = s.match
+			elapsed = min(timeit.repeat(lambda: [match(t) for t in topics], number=1, repeat=5))
+			results.append(elapsed / len(topics) * 1e6)
+		print('{:>8} {:>14.2f} {:>14.2f}'.format(n, *results))
+
+
+if __name__ == '__main__':
+	main()
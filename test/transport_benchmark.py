@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+""" Publish-to-wire latency of MqttGObjectBridge, with the timer that
+    writes once a second and with the write watch. A minimal broker in a
+    thread accepts the connection and notes when each PUBLISH arrives. The
+    messages are published in bursts from the main loop, like the queue
+    does, with the default socket buffers and with small ones, as on a slow
+    link where paho often cannot write everything at once. Needs the real
+    paho and GLib. """
+import os
+import socket
+import struct
+import sys
+import threading
+from time import monotonic
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+from gi.repository import GLib
+from mqtt_gobject_bridge import MqttGObjectBridge
+
+PAYLOAD = '{"value": ' + '1' * 1000 + '}'
+
+
+class StubBroker(threading.Thread):
+	""" Accepts one client, acknowledges its CONNECT and answers pings.
+	    Arrivals maps the sequence number at the end of each published
+	    topic to the time it was received. """
+	def __init__(self, buffer_size=None):
+		super(StubBroker, self).__init__()
+		self.daemon = True
+		self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		if buffer_size is not None:
+			self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+		self._listener.bind(('127.0.0.1', 0))
+		self._listener.listen(1)
+		self.port = self._listener.getsockname()[1]
+		self.arrivals = {}
+
+	def run(self):
+		conn, _ = self._listener.accept()
+		buf = b''
+		while True:
+			data = conn.recv(65536)
+			if not data:
+				return
+			buf += data
+			while True:
+				packet = self._split(buf)
+				if packet is None:
+					break
+				kind, body, buf = packet
+				if kind == 1:
+					conn.sendall(b'\x20\x02\x00\x00')
+				elif kind == 3:
+					size, = struct.unpack('>H', body[:2])
+					self.arrivals[int(body[2:2 + size].rsplit(b'/', 1)[1])] = monotonic()
+				elif kind == 12:
+					conn.sendall(b'\xd0\x00')
+
+	@staticmethod
+	def _split(buf):
+		""" Returns (packet type, body, rest of buf), or None if buf does not
+		    hold a complete packet. """
+		length = 0
+		shift = 0
+		for i in range(1, 5):
+			if i >= len(buf):
+				return None
+			length += (buf[i] & 0x7f) << shift
+			shift += 7
+			if not buf[i] & 0x80:
+				break
+		end = i + 1 + length
+		if len(buf) < end:
+			return None
+		return buf[0] >> 4, buf[i + 1:end], buf[end:]
+
+
+class Bridge(MqttGObjectBridge):
+	def __init__(self, port, write_watch):
+		self.connected = False
+		self._port = port
+		MqttGObjectBridge.__init__(self, write_watch=write_watch)
+
+	def _init_mqtt(self):
+		self._client.connect('127.0.0.1', self._port, 60)
+		self._init_socket_handlers()
+		return False
+
+	def _on_connect(self, client, userdata, flags, rc):
+		MqttGObjectBridge._on_connect(self, client, userdata, flags, rc)
+		self.connected = True
+
+
+def iterate_until(condition, timeout):
+	context = GLib.MainContext.default()
+	deadline = monotonic() + timeout
+	while not condition() and monotonic() < deadline:
+		context.iteration(True)
+
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))] * 1000
+
+
+def measure(write_watch, bursts, buffer_size):
+	broker = StubBroker(buffer_size)
+	broker.start()
+	bridge = Bridge(broker.port, write_watch)
+	if buffer_size is not None:
+		bridge._client.socket().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+	iterate_until(lambda: bridge.connected, 5)
+	seq = 0
+	results = []
+	for burst in bursts:
+		sent = {}
+
+		def publish(first=seq):
+			for n in range(first, first + burst):
+				sent[n] = monotonic()
+				bridge._client.publish('bench/{}'.format(n), PAYLOAD)
+			bridge._flush()
+			return False
+
+		GLib.idle_add(publish)
+		seq += burst
+		iterate_until(lambda: len(sent) == burst and all(n in broker.arrivals for n in sent), 30)
+		latencies = [broker.arrivals[n] - t for n, t in sent.items() if n in broker.arrivals]
+		results.append((burst, len(latencies), percentile(latencies, 50), percentile(latencies, 99)))
+	return results
+
+
+def main():
+	bursts = (1, 10, 100, 1000, 10000)
+	print('{:>12} {:>8} {:>8} {:>10} {:>10} {:>10}'.format('transport', 'buffers', 'burst', 'received',
+		'p50 (ms)', 'p99 (ms)'))
+	for buffer_size in (None, 16384):
+		for name, write_watch in (('timer', False), ('write-watch', True)):
+			for burst, received, p50, p99 in measure(write_watch, bursts, buffer_size):
+				print('{:>12} {:>8} {:>8} {:>10} {:>10.2f} {:>10.2f}'.format(name, buffer_size or 'default',
+					burst, received, p50, p99))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+""" Throughput of the one-process and the two-process mode under a flood of
+    D-Bus signals. The signals are sent in batches from the main loop of
+    the ingest process, the time runs until the last one was handed to
+    the (captured) MQTT client, in whichever process that is. Also shows
+    the processor time each process used, and how many signals per second
+    the ingest process could take if it had a processor to itself. Every
+    run is done in a fresh process. Uses the fake D-Bus of
+    replay_benchmark.py. """
+import argparse
+import os
+import random
+import struct
+import sys
+from time import monotonic, sleep
+
+test_dir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(test_dir, '..'))
+import dbus
+import dbus_mqtt
+import outputs
+import fake_dbus
+from fake_dbus import FakeBus, drain
+from gi.repository import GLib
+from shm_ring import Ring
+
+SENTINEL = 'com.victronenergy.temperature.sentinel'
+_result = struct.Struct('=ddd')
+
+
+def make_bus(paths, items):
+	bus = FakeBus.synthetic(paths, items)
+	bus.add_service(SENTINEL, {'/Done': dbus.Int32(0, variant_level=1)}, device_instance=999)
+	fake_dbus.install(bus)
+	return bus
+
+
+def make_changes(bus, signals, paths):
+	""" Changes of the first paths of each service. """
+	rnd = random.Random(1)
+	services = sorted(s for s in bus.services if s != SENTINEL)
+	return [(rnd.choice(services), '/Path/{}'.format(rnd.randrange(paths)),
+		dbus.Double(rnd.random(), variant_level=1)) for _ in range(signals)]
+
+
+def watch_sentinel(output, done):
+	""" Subscribes to everything, and calls done once the sentinel was
+	    published. """
+	client = output._client
+	client.deliver('R/{}/keepalive'.format(output._system_id), b'')
+	def on_publish(topic, payload, retain):
+		if topic.endswith('/Done') and payload is not None and '1' in payload:
+			done()
+	client.on_publish = on_publish
+
+
+def flood(bus, changes, batch, finished):
+	""" Sends the changes, batch at a time with the main loop running in
+	    between, then the sentinel. Runs the main loop until finished()
+	    is True. """
+	for i in range(0, len(changes), batch):
+		for service, path, value in changes[i:i + batch]:
+			bus.emit_value(service, path, value)
+		drain()
+	bus.emit_value(SENTINEL, '/Done', dbus.Int32(1, variant_level=1))
+	while not finished():
+		if not GLib.MainContext.default().iteration(False):
+			sleep(0.0001)
+
+
+def cpu():
+	t = os.times()
+	return t.user + t.system
+
+
+def one_process(paths, items, changing, signals, batch):
+	bus = make_bus(paths, items)
+	m = dbus_mqtt.DbusMqtt()
+	drain()
+	changes = make_changes(bus, signals, changing)
+	done = []
+	watch_sentinel(m._outputs[0], lambda: done.append(monotonic()))
+	started = monotonic()
+	cpu_started = cpu()
+	flood(bus, changes, batch, lambda: done)
+	return done[0] - started, cpu() - cpu_started, 0
+
+
+def run_egress(changes, requests, result):
+	""" The egress process, writes when the sentinel was published and the
+	    processor time it used to result. """
+	mainloop = GLib.MainLoop()
+	egress = outputs.Egress(changes, requests, [{}], closed=mainloop.quit)
+	def done():
+		os.write(result, _result.pack(monotonic(), cpu(), 0))
+		mainloop.quit()
+	watch_sentinel(egress._outputs[0], done)
+	mainloop.run()
+	os._exit(0)
+
+
+def two_process(paths, items, changing, signals, batch, ring_size):
+	bus = make_bus(paths, items)
+	changes = Ring(ring_size)
+	requests = Ring(ring_size)
+	result = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(result[0])
+		run_egress(changes.reader(), requests.writer(), result[1])
+	os.close(result[1])
+	os.set_blocking(result[0], False)
+	m = dbus_mqtt.DbusMqtt(egress=(changes.writer(), requests.reader()))
+	drain()
+	changes = make_changes(bus, signals, changing)
+	reported = []
+	def finished():
+		try:
+			reported.append(os.read(result[0], _result.size))
+		except BlockingIOError:
+			pass
+		return reported
+	started = monotonic()
+	cpu_started = cpu()
+	flood(bus, changes, batch, finished)
+	ingest_cpu = cpu() - cpu_started
+	os.waitpid(pid, 0)
+	done, egress_cpu, _ = _result.unpack(reported[0])
+	return done - started, ingest_cpu, egress_cpu
+
+
+def isolated(run, *args):
+	""" Runs run in a child process, returns what it returned. """
+	result = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(result[0])
+		os.write(result[1], _result.pack(*run(*args)))
+		os._exit(0)
+	os.close(result[1])
+	data = os.read(result[0], _result.size)
+	os.close(result[0])
+	os.waitpid(pid, 0)
+	return _result.unpack(data)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Throughput of the one-process and two-process mode')
+	parser.add_argument('--paths', default=1000, type=int, help='number of paths on the bus')
+	parser.add_argument('--items', default=100, type=int, help='items per service')
+	parser.add_argument('--changing', default='10,100', help='comma separated numbers of paths per service that change')
+	parser.add_argument('--signals', default=100000, type=int, help='value changes to send')
+	parser.add_argument('--batch', default=1000, type=int, help='signals per main loop iteration')
+	parser.add_argument('--ring-size', default=dbus_mqtt.RING_SIZE, type=int)
+	args = parser.parse_args()
+
+	print('{:>9} {:>12} {:>10} {:>10} {:>16} {:>16} {:>16}'.format('changing', 'mode', 'time (ms)',
+		'signals/s', 'ingest cpu (ms)', 'egress cpu (ms)', 'ingest signals/s'))
+	for changing in (int(c) for c in args.changing.split(',')):
+		for mode in ('one', 'two'):
+			if mode == 'one':
+				elapsed, ingest, egress = isolated(one_process, args.paths, args.items, changing,
+					args.signals, args.batch)
+			else:
+				elapsed, ingest, egress = isolated(two_process, args.paths, args.items, changing,
+					args.signals, args.batch, args.ring_size)
+			print('{:>9} {:>12} {:>10.1f} {:>10.0f} {:>16.1f} {:>16.1f} {:>16.0f}'.format(changing,
+				mode + '-process', elapsed * 1000, args.signals / elapsed, ingest * 1000, egress * 1000,
+				args.signals / ingest))
+
+
+if __name__ == '__main__':
+	main()